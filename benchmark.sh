@@ -0,0 +1,16 @@
+#!/bin/bash
+#
+# pyjdb benchmark script.
+#
+# Usage:
+#  $ ./benchmark.sh
+# will run the benchmarks found in the source tree. unlike the tests, these
+# don't need a jvm.
+
+dir=$(dirname "$0")
+dir=$(cd "$dir" && pwd)
+
+cd "$dir" # ensure we're back where we started
+
+PYTHONPATH="." python -m pyjdb.pyjdwp_benchmark &&
+PYTHONPATH="." python -m pyjdb.pyjdb_benchmark "$@"
@@ -1,7 +1,13 @@
 """Python library for debugging java programs. Backed by pyjdwp, a wrapper of
 the Java Debug Wire Protocol (jdwp)"""
+import array
+import bisect
+import logging
 import pyjdwp
+import Queue
+import socket
 import threading
+import time
 
 
 class Error(Exception):
@@ -9,195 +15,1205 @@ class Error(Exception):
     pass
 
 
+class LineTable(object):
+    """A method's line table, as sorted parallel arrays rather than a list of
+    decoded dicts: code indices with the line each starts, and line numbers
+    with the code index of each of their locations."""
+
+    def __init__(self, entries):
+        """"entries" are (code index, line number) pairs, in any order"""
+        by_code_index = sorted(entries)
+        by_line = sorted((line_number, code_index)
+                for code_index, line_number in by_code_index)
+        self.code_indices = array.array("l",
+                [code_index for code_index, line_number in by_code_index])
+        self.lines = array.array("l",
+                [line_number for code_index, line_number in by_code_index])
+        self.__sorted_lines = array.array("l",
+                [line_number for line_number, code_index in by_line])
+        self.__code_indices_by_line = array.array("l",
+                [code_index for line_number, code_index in by_line])
+
+    def __len__(self):
+        return len(self.code_indices)
+
+    def entries(self):
+        """Returns the (code index, line number) pairs, by code index"""
+        return zip(self.code_indices, self.lines)
+
+    def line_at(self, code_index):
+        """Returns the line the code at "code_index" is on, or None"""
+        i = bisect.bisect_right(self.code_indices, code_index) - 1
+        if i < 0:
+            return None
+        return self.lines[i]
+
+    def code_indices_at(self, line_number):
+        """Returns the code indices of the locations on a line (none if the
+        line has no code)"""
+        start = bisect.bisect_left(self.__sorted_lines, line_number)
+        end = bisect.bisect_right(self.__sorted_lines, line_number, start)
+        return list(self.__code_indices_by_line[start:end])
+
+    def next_line_at_or_after(self, line_number):
+        """Returns the first line with code from "line_number" on, or None"""
+        i = bisect.bisect_left(self.__sorted_lines, line_number)
+        if i == len(self.__sorted_lines):
+            return None
+        return self.__sorted_lines[i]
+
+
+class FrameCache(object):
+    """Stack frames of suspended threads, kept a page ("page_size" frames) at
+    a time as they're fetched, and good until the thread resumes. "hits" and
+    "misses" count the pages asked for that were and weren't cached."""
+
+    def __init__(self, page_size=20):
+        self.page_size = page_size
+        self.hits = 0
+        self.misses = 0
+        # thread id -> frame count
+        self.__counts = {}
+        # thread id -> page number -> frames
+        self.__pages = {}
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def count(self, thread_id):
+        """Returns the cached frame count of the thread, or None"""
+        return self.__counts.get(thread_id)
+
+    def store_count(self, thread_id, count):
+        self.__counts[thread_id] = count
+
+    def lookup(self, thread_id, page):
+        """Returns the cached frames of page "page" of the thread's stack, or
+        None"""
+        frames = self.__pages.get(thread_id, {}).get(page)
+        if frames is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return frames
+
+    def store(self, thread_id, page, frames):
+        if thread_id not in self.__pages:
+            self.__pages[thread_id] = {}
+        self.__pages[thread_id][page] = frames
+
+    def invalidate(self, thread_id=None):
+        """Forgets the frames of the thread (default: of all threads)"""
+        if thread_id is None:
+            self.__counts.clear()
+            self.__pages.clear()
+        else:
+            self.__counts.pop(thread_id, None)
+            self.__pages.pop(thread_id, None)
+
+
+class MetadataLoader(object):
+    """Worker threads that load the metadata of newly prepared classes, so
+    the event notifier thread can get on with handing out events rather than
+    wait on metadata requests.
+
+    Classes are queued by put; one that's queued or being loaded already
+    isn't queued again. A worker takes whatever is queued (up to "max_batch"
+    classes) and loads it in one go with "load(classes)" (or if that fails,
+    one class at a time, so one bad class doesn't cost the others theirs),
+    then calls the "on_ready" callbacks of the puts whose classes are all
+    loaded."""
+
+    __STOP = object()
+
+    def __init__(self, load, num_workers=2, max_batch=256,
+            name="pyjdb_metadata_loader"):
+        self.__load = load
+        self.__max_batch = max_batch
+        self.__queue = Queue.Queue()
+        self.__lock = threading.Condition()
+        self.__running = False
+        # typeID -> the puts waiting on the class, each a [number of classes
+        # not loaded yet, on_ready] list; guarded by self.__lock
+        self.__pending = {}
+        self.__workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self.__load_loop,
+                    name="%s-%d" % (name, i))
+            worker.setDaemon(True)
+            self.__workers.append(worker)
+        # stats, guarded by self.__lock
+        self.__max_queue_depth = 0
+        self.__loaded = 0
+        self.__batches = 0
+        self.__max_batch_size = 0
+
+    def start(self):
+        with self.__lock:
+            if self.__running:
+                return
+            self.__running = True
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self):
+        with self.__lock:
+            if not self.__running:
+                return
+            self.__running = False
+        for worker in self.__workers:
+            self.__queue.put(self.__STOP)
+        for worker in self.__workers:
+            if threading.current_thread() is not worker:
+                worker.join()
+
+    def put(self, classes, on_ready=None):
+        """Queues "classes" (Pyjdb class dicts) to be loaded, and calls
+        "on_ready()" on a worker thread once they all are"""
+        waiter = [0, on_ready]
+        to_queue = []
+        with self.__lock:
+            for cls in classes:
+                class_id = cls["typeID"]
+                if class_id not in self.__pending:
+                    self.__pending[class_id] = []
+                    to_queue.append(cls)
+                self.__pending[class_id].append(waiter)
+                waiter[0] += 1
+        for cls in to_queue:
+            self.__queue.put(cls)
+        depth = self.__queue.qsize()
+        with self.__lock:
+            self.__max_queue_depth = max(self.__max_queue_depth, depth)
+        if not waiter[0] and on_ready is not None:
+            on_ready()
+
+    def wait_idle(self, timeout=None):
+        """Blocks until every class queued so far is loaded, or "timeout"
+        seconds pass. Returns whether it's idle."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__lock:
+            while self.__pending:
+                if deadline is None:
+                    self.__lock.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self.__lock.wait(deadline - time.time())
+            return True
+
+    def stats(self):
+        with self.__lock:
+            return {
+                    "queue_depth": self.__queue.qsize(),
+                    "max_queue_depth": self.__max_queue_depth,
+                    "pending": len(self.__pending),
+                    "loaded": self.__loaded,
+                    "batches": self.__batches,
+                    "max_batch_size": self.__max_batch_size}
+
+    def __load_loop(self):
+        while True:
+            batch = [self.__queue.get()]
+            while (batch[-1] is not self.__STOP and
+                    len(batch) < self.__max_batch):
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is self.__STOP:
+                self.__load_batch(batch[ : -1])
+                return
+            self.__load_batch(batch)
+
+    def __load_batch(self, classes):
+        if not classes:
+            return
+        if not self.__try_load(classes) and len(classes) > 1:
+            for cls in classes:
+                self.__try_load([cls])
+        ready = []
+        with self.__lock:
+            for cls in classes:
+                for waiter in self.__pending.pop(cls["typeID"], []):
+                    waiter[0] -= 1
+                    if not waiter[0] and waiter[1] is not None:
+                        ready.append(waiter[1])
+            self.__loaded += len(classes)
+            self.__batches += 1
+            self.__max_batch_size = max(self.__max_batch_size, len(classes))
+            self.__lock.notify_all()
+        for on_ready in ready:
+            try:
+                on_ready()
+            except Exception:
+                logging.exception("Error in metadata loader callback")
+
+    def __try_load(self, classes):
+        """Returns whether "classes" loaded without error"""
+        try:
+            self.__load(classes)
+            return True
+        except (pyjdwp.Error, socket.error) as e:
+            # e.g. one of them was unloaded meanwhile, or we've disconnected
+            logging.warning("Couldn't load metadata of %d classes: %s",
+                    len(classes), e)
+        except Exception:
+            logging.exception("Couldn't load metadata of %d classes",
+                    len(classes))
+        return False
+
+
+class DebugState(object):
+    """A consistent view of a Pyjdb's classes and threads, as of one version
+    of its state (see Pyjdb.snapshot). It's shared, so don't change it."""
+
+    def __init__(self, version, classes_by_id, class_ids_by_sig,
+            class_ids_by_source_file, threads):
+        self.version = version
+        self.classes_by_id = classes_by_id
+        self.class_ids_by_sig = class_ids_by_sig
+        self.class_ids_by_source_file = class_ids_by_source_file
+        self.threads = threads
+
+
 class Pyjdb(object):
+    """A debugging session with a jvm.
 
-    def __init__(self, host="localhost", port=5005, sourcepath="."):
+    Single lookups in the indexes (classes_by_id, class_ids_by_sig,
+    class_ids_by_source_file, threads and deferred_breakpoints) may be made
+    from any thread without locking. Writers hold a lock while they update
+    them, but never while waiting on the jvm, and copy rather than change
+    what's in them: once published, a class or thread entry, or a set or
+    list in an index, is replaced rather than modified. The indexes
+    themselves are updated in place, though, so iterate over them through
+    snapshot(), which also gives a consistent view of several at once, and
+    use get() for ids found through another index (e.g. a class may be
+    unloaded between looking up its id by source file and its entry)."""
+
+    def __init__(self, host="localhost", port=5005, sourcepath=".",
+            max_in_flight=64, lazy_metadata=False, track_new_classes=False,
+            metadata_workers=2, reply_cache=None):
+        # held to update the indexes below, never across a jvm round trip
         self.__debug_state_lock = threading.Condition()
-        self.jdwp = pyjdwp.Jdwp(host, port)
+        # bumped by every change to the indexes
+        self.__version = 0
+        self.__snapshot = None
+        # a pyjdwp.ReplyCache to answer repeated requests from (e.g. for
+        # classes whose source files were fetched before their metadata), or
+        # None; unloaded classes are dropped from it
+        self.jdwp = pyjdwp.Jdwp(host, port, reply_cache=reply_cache)
         self.sourcepath = sourcepath
+        # how many metadata requests to keep outstanding while loading classes
+        self.max_in_flight = max_in_flight
+        # if set, only signatures are loaded at attach and the rest of a
+        # class's metadata when it's first needed (see load_classes)
+        self.lazy_metadata = lazy_metadata
+        # if set, the jvm reports every class prepared after we attach, so
+        # classes_by_id stays complete; otherwise it only reports those
+        # defined in files with deferred breakpoints
+        self.track_new_classes = track_new_classes
+        # how many threads load the metadata of classes prepared after we
+        # attach (see MetadataLoader); 0 loads it on the event notifier
+        # thread, holding up other events until it's done
+        self.metadata_workers = metadata_workers
+        self.__metadata_loader = None
+        self.__capabilities = None
+        # source file name -> ids of the CLASS_PREPARE requests for the
+        # classes defined in it (none while the first is being made)
+        self.__class_prepare_request_ids = {}
+        # the names of the classes whose nested classes we've asked for (see
+        # __request_nested_class_prepares)
+        self.__nested_class_prepare_names = set()
+        # ids of our event requests that don't suspend anything
+        self.__passive_request_ids = set()
+        self.__subscribed = False
         self.class_blacklist = ["Lsun/misc/PostVMInitHook;"]
         self.classes_by_id = {}
         self.class_ids_by_sig = {}
+        # thread id -> {"name", "thread_group_id"}, kept up to date by thread
+        # start and death events; "status" and "is_suspended" are
+        # fetched on demand (see get_thread and refresh_threads)
         self.threads = {}
-        self.line_index = {}
+        # frames of suspended threads, fetched on demand (see get_frames)
+        self.frame_cache = FrameCache()
+        # ids of the threads whose status may have changed since we last
+        # fetched it (all of them after a resume, and running threads always)
+        self.__dirty_thread_ids = set()
+        # bumped whenever threads are marked dirty, so a status or frames
+        # fetched from before then aren't taken as current
+        self.__thread_epoch = 0
+        # source file name ("Foo.java") and package qualified path
+        # ("com/foo/Foo.java") -> set of ids of the classes defined in it
+        self.class_ids_by_source_file = {}
+        # source file name -> (filename, line number) of the breakpoints
+        # waiting for a class defined in that file to be prepared
+        self.deferred_breakpoints = {}
         self.class_prepare_listeners = []
+        self.__loaded_class_ids = set()
+        # id of each class whose metadata is being fetched -> the thread
+        # fetching it
+        self.__loading_class_ids = {}
+        self.__class_ids_by_simple_name = {}
+
+    @property
+    def profiler(self):
+        """pyjdwp.PhaseProfiler with the time, requests and bytes spent in each
+        phase of the last initialize (and of class loads since)"""
+        return self.jdwp.profiler
 
     def initialize(self):
-        try:
-            self.jdwp.initialize()
-        except pyjdwp.Error as e:
-            raise e
-        self.jdwp.register_event_callback(self.handle_event)
-        # load up runtime metadata like known classes and running threads
-        self.__initialize_event_subscriptions()
-        self.__initialize_jvm_state()
+        self.profiler.reset()
+        with self.profiler.phase("Pyjdb.initialize"):
+            try:
+                self.jdwp.initialize()
+            except pyjdwp.Error as e:
+                raise e
+            if self.metadata_workers:
+                self.__metadata_loader = MetadataLoader(
+                        self.__load_prepared_classes, self.metadata_workers)
+                self.__metadata_loader.start()
+            self.jdwp.register_event_batch_callback(self.handle_events)
+            # load up runtime metadata like known classes and running threads
+            with self.profiler.phase("event_subscriptions"):
+                self.__initialize_event_subscriptions()
+            self.__initialize_jvm_state()
+        logging.info("Pyjdb initialized:\n%s", self.profiler.report())
+
+    def snapshot(self):
+        """Returns a DebugState with the classes and threads as of now. It's
+        only copied when the state has changed since the last snapshot."""
+        with self.__debug_state_lock:
+            if (self.__snapshot is None or
+                    self.__snapshot.version != self.__version):
+                # the entries are never changed once published, so shallow
+                # copies will do
+                self.__snapshot = DebugState(self.__version,
+                        dict(self.classes_by_id), dict(self.class_ids_by_sig),
+                        dict(self.class_ids_by_source_file),
+                        dict(self.threads))
+            return self.__snapshot
 
     def resume(self):
+        self.jdwp.VirtualMachine.Resume()
         with self.__debug_state_lock:
-            self.jdwp.VirtualMachine.Resume()
-            for thread_id in self.threads.keys():
-                self.__update_thread_status(thread_id)
+            # don't ask every thread how it's doing now; most won't be
+            # looked at before the next stop
+            self.__mark_threads_dirty()
 
-    def set_breakpoint_at_line(self, filename, line_number):
-        print("Setting breakpoint at %s:%d" % (filename, line_number))
-        index_key = (filename, line_number)
+    def get_thread(self, thread_id):
+        """Returns the entry in self.threads for "thread_id", fetching its
+        status first if it may have changed"""
+        self.refresh_threads([thread_id])
+        return self.threads[thread_id]
+
+    def get_threads(self):
+        """Returns a copy of self.threads, with every thread's status up to
+        date"""
+        self.refresh_threads()
+        return self.snapshot().threads
+
+    def refresh_threads(self, thread_ids=None):
+        """Fetches the status of those of "thread_ids" (default: all threads)
+        whose status may have changed, pipelining the requests"""
         with self.__debug_state_lock:
-            if index_key in self.line_index:
-                line_index_entry = self.line_index[(filename, line_number)]
-                event_request_modifier = {
-                        "modKind": 7,
-                        "typeTag": self.jdwp.TypeTag.CLASS,
-                        "classID": line_index_entry[0],
-                        "methodID": line_index_entry[1],
-                        "index": line_index_entry[2]}
-                resp = self.jdwp.EventRequest.Set({
-                    "eventKind": self.jdwp.EventKind.BREAKPOINT,
-                    "suspendPolicy": self.jdwp.SuspendPolicy.ALL,
-                    "modifiers": [event_request_modifier]})
+            if thread_ids is None:
+                thread_ids = list(self.__dirty_thread_ids)
+            thread_ids = [thread_id for thread_id in thread_ids
+                    if thread_id in self.__dirty_thread_ids and
+                            thread_id in self.threads]
+            epoch = self.__thread_epoch
+        def on_status(resp, thread_id):
+            thread = self.threads.get(thread_id)
+            if thread is None:
+                # it's died since
                 return
-        # if we get here we should set the deferred breakpoint
-        self.set_deferred_breakpoint_at_line(filename, line_number)
-
-    def set_deferred_breakpoint_at_line(self, filename, line_number):
-        index_key = (filename, line_number)
-        print("Setting deferred breakpoint at %s:%d" % index_key)
-        def matches(cls, filename=filename):
-            return cls["source_file"] == filename
-        def notify(cls, filename=filename, line_number=line_number):
-            should_set_breakpoint = False
+            self.threads[thread_id] = dict(thread,
+                    status=resp["threadStatus"],
+                    is_suspended=resp["suspendStatus"])
+            # a running thread's status may change any time, but a suspended
+            # one's only once it's resumed, which marks it dirty again
+            if epoch == self.__thread_epoch and resp["suspendStatus"]:
+                self.__dirty_thread_ids.discard(thread_id)
+            self.__changed()
+        def on_error(error, thread_id):
+            # left dirty, to try again next time
+            logging.warning("Couldn't get status of thread %d: %s",
+                    thread_id, error)
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight,
+                self.__debug_state_lock)
+        for thread_id in thread_ids:
+            pipeline.submit("ThreadReference", "Status", {"thread": thread_id},
+                    lambda resp, thread_id=thread_id: on_status(
+                            resp, thread_id),
+                    lambda error, thread_id=thread_id: on_error(
+                            error, thread_id))
+        pipeline.run()
+
+    def frame_count(self, thread_id):
+        """Returns the number of frames on a suspended thread's stack"""
+        with self.__debug_state_lock:
+            count = self.frame_cache.count(thread_id)
+            epoch = self.__thread_epoch
+        if count is None:
+            count = self.jdwp.ThreadReference.FrameCount({
+                "thread": thread_id})["frameCount"]
             with self.__debug_state_lock:
-                if index_key in self.line_index:
-                    should_set_breakpoint = True
-            if should_set_breakpoint:
-                self.set_breakpoint_at_line(filename, line_number)
-        self.class_prepare_listeners.append((matches, notify))
+                if epoch == self.__thread_epoch:
+                    self.frame_cache.store_count(thread_id, count)
+        return count
+
+    def get_frames(self, thread_id, start_frame=0, length=None):
+        """Returns "length" frames (default: all the rest) of a suspended
+        thread's stack from "start_frame" on, top frame first. Only the pages
+        of frames that aren't cached already are fetched."""
+        count = self.frame_count(thread_id)
+        end_frame = count
+        if length is not None:
+            end_frame = min(count, start_frame + length)
+        if start_frame >= end_frame:
+            return []
+        page_size = self.frame_cache.page_size
+        pages = range(start_frame // page_size,
+                (end_frame - 1) // page_size + 1)
+        frames_by_page = {}
+        with self.__debug_state_lock:
+            epoch = self.__thread_epoch
+            for page in pages:
+                frames = self.frame_cache.lookup(thread_id, page)
+                if frames is not None:
+                    frames_by_page[page] = frames
+        def on_frames(resp, page):
+            frames_by_page[page] = resp["frames"]
+            if epoch == self.__thread_epoch:
+                self.frame_cache.store(thread_id, page, resp["frames"])
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight,
+                self.__debug_state_lock)
+        for page in pages:
+            if page in frames_by_page:
+                continue
+            pipeline.submit("ThreadReference", "Frames", {
+                    "thread": thread_id,
+                    "startFrame": page * page_size,
+                    "length": min(page_size, count - page * page_size)},
+                    lambda resp, page=page: on_frames(resp, page))
+        pipeline.run()
+        frames = []
+        for page in pages:
+            frames += frames_by_page[page]
+        offset = start_frame - pages[0] * page_size
+        return frames[offset : offset + end_frame - start_frame]
+
+    def set_breakpoint_at_line(self, filename, line_number, nearest=False):
+        """Breaks at a source line. "filename" is a source file name
+        ("Foo.java"), or a package qualified path ("com/foo/Foo.java") to pick
+        one of several files with that name. If "nearest", a line without
+        code breaks at the next line that has some instead."""
+        print("Setting breakpoint at %s:%d" % (filename, line_number))
+        locations = self.find_line_locations(filename, line_number, nearest)
+        if locations:
+            self.__set_breakpoints(locations)
+            return
+        # if we get here we should set the deferred breakpoint
+        self.set_deferred_breakpoint_at_line(filename, line_number, nearest)
+
+    def set_deferred_breakpoint_at_line(self, filename, line_number,
+            nearest=False):
+        """Breaks at a source line in classes defined in "filename" when
+        they're prepared (from now on, as there may be several, e.g. nested
+        classes or the same class from other class loaders)"""
+        print("Setting deferred breakpoint at %s:%d" % (filename, line_number))
+        source_file = filename.rsplit("/", 1)[-1]
+        with self.__debug_state_lock:
+            self.deferred_breakpoints[source_file] = (
+                    self.deferred_breakpoints.get(source_file, []) +
+                    [(filename, line_number, nearest)])
+            self.__changed()
+            request_class_prepares = (self.__subscribed and
+                    source_file not in self.__class_prepare_request_ids)
+            if request_class_prepares:
+                self.__class_prepare_request_ids[source_file] = []
+        if request_class_prepares:
+            self.__request_class_prepares(source_file)
+
+    def __set_breakpoints(self, locations):
+        # a line may map to several locations (e.g. in more than one
+        # method, or class); break at all of them
+        for line_index_entry in locations:
+            event_request_modifier = {
+                    "modKind": 7,
+                    "typeTag": self.jdwp.TypeTag.CLASS,
+                    "classID": line_index_entry[0],
+                    "methodID": line_index_entry[1],
+                    "index": line_index_entry[2]}
+            resp = self.jdwp.EventRequest.Set({
+                "eventKind": self.jdwp.EventKind.BREAKPOINT,
+                "suspendPolicy": self.jdwp.SuspendPolicy.ALL,
+                "modifiers": [event_request_modifier]})
+
+    def __resolve_deferred_breakpoints(self, cls):
+        """Sets the deferred breakpoints in (just) the newly loaded "cls" """
+        for filename, line_number, nearest in self.deferred_breakpoints.get(
+                cls["source_file"], []):
+            if cls["typeID"] not in self.class_ids_by_source_file.get(
+                    filename, ()):
+                continue
+            self.__set_breakpoints(self.__line_locations([cls], line_number,
+                    nearest))
+
+    def wait_for_metadata(self, timeout=None):
+        """Blocks until the metadata of the classes prepared so far is loaded
+        (and their deferred breakpoints are set), or "timeout" seconds pass.
+        Returns whether it's all loaded."""
+        if self.__metadata_loader is None:
+            return True
+        return self.__metadata_loader.wait_idle(timeout)
 
     def disconnect(self):
         self.jdwp.disconnect()
+        if self.__metadata_loader is not None:
+            self.__metadata_loader.stop()
 
     def handle_event(self, event_list):
+        self.handle_events([event_list])
+
+    def handle_events(self, event_lists):
+        # events come in bursts (e.g. class prepares at startup); take the
+        # lock once per burst, just to update our state, and only then ask
+        # the jvm for what else we need
+        started_thread_ids = []
+        actions = []
+        with self.__debug_state_lock:
+            for event_list in event_lists:
+                actions += self.__handle_event_list(event_list,
+                        started_thread_ids)
+        for action in actions:
+            action()
+        if started_thread_ids:
+            self.__fetch_thread_info(started_thread_ids)
+
+    def __handle_event_list(self, event_list, started_thread_ids):
+        """Updates our state from an event composite, adding the ids of the
+        threads started to "started_thread_ids". Returns what's left to do
+        once the lock is released, as a list of functions."""
+        our_request_ids = set(request_id
+                for request_ids in self.__class_prepare_request_ids.values()
+                for request_id in request_ids)
+        # the thread suspended for our class prepare requests, if any, and
+        # whether any other request (e.g. a breakpoint) may want it to stay
+        # suspended; events from our requests that don't suspend (e.g. the
+        # one tracking every new class) don't count
+        prepared_thread_id = None
+        suspended_for_others = False
+        prepared_class_ids = set()
+        prepared_classes = []
+        unloaded_signatures = []
+        for event in event_list["events"]:
+            [data] = [data for data in event.values() if isinstance(data, dict)]
+            if data["requestID"] in our_request_ids:
+                prepared_thread_id = data["thread"]
+            elif data["requestID"] not in self.__passive_request_ids:
+                suspended_for_others = True
+            if event["eventKind"] == self.jdwp.EventKind.CLASS_PREPARE:
+                class_entry = event["ClassPrepare"]
+                # a class matching several requests is reported for each
+                if class_entry["typeID"] in prepared_class_ids:
+                    continue
+                prepared_class_ids.add(class_entry["typeID"])
+                cls = self.__record_class(class_entry)
+                if cls is not None:
+                    prepared_classes.append(cls)
+            elif event["eventKind"] == self.jdwp.EventKind.THREAD_START:
+                thread_id = event["ThreadStart"]["thread"]
+                if self.__add_thread(thread_id):
+                    started_thread_ids.append(thread_id)
+            elif event["eventKind"] == self.jdwp.EventKind.THREAD_DEATH:
+                # THREAD_END is the same event kind, under the same name
+                thread_id = event["ThreadDeath"]["thread"]
+                self.threads.pop(thread_id, None)
+                self.__dirty_thread_ids.discard(thread_id)
+                self.frame_cache.invalidate(thread_id)
+                self.__changed()
+            elif event["eventKind"] == self.jdwp.EventKind.CLASS_UNLOAD:
+                # (reported by signature only; see __forget_unloaded_classes)
+                unloaded_signatures.append(event["ClassUnload"]["signature"])
+        on_ready = None
+        if (event_list["suspendPolicy"] !=
+                self.jdwp.SuspendPolicy.EVENT_THREAD or
+                prepared_thread_id is None or suspended_for_others):
+            self.__mark_suspended_threads_dirty(event_list)
+        # (0 if the jvm prepared the class itself, suspending no thread)
+        elif prepared_thread_id:
+            # resume it once the classes' breakpoints are set
+            on_ready = lambda: self.__resume_thread(prepared_thread_id)
+        actions = []
+        if unloaded_signatures:
+            actions.append(lambda: self.__forget_unloaded_classes(
+                    unloaded_signatures))
+        if not prepared_classes and on_ready is None:
+            return actions
+        if self.__metadata_loader is not None:
+            actions.append(lambda: self.__metadata_loader.put(
+                    prepared_classes, on_ready))
+            return actions
+        def load():
+            self.__load_prepared_classes(prepared_classes)
+            if on_ready is not None:
+                on_ready()
+        actions.append(load)
+        return actions
+
+    def __forget_unloaded_classes(self, signatures):
+        """Drops unloaded classes from our indexes, and from the reply cache.
+        The jvm only tells us their signatures, and classes of the same name
+        from different class loaders share one, so we ask the jvm which of
+        our classes with them are gone (even if we know of just one, as the
+        one unloaded may be a copy we never heard of)."""
+        signatures = set(signatures)
+        class_ids_by_signature = {}
+        with self.__debug_state_lock:
+            for class_id, cls in self.classes_by_id.items():
+                if cls["signature"] not in signatures:
+                    continue
+                if cls["signature"] not in class_ids_by_signature:
+                    class_ids_by_signature[cls["signature"]] = []
+                class_ids_by_signature[cls["signature"]].append(class_id)
+        gone = []
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight)
+        for class_ids in class_ids_by_signature.values():
+            for class_id in class_ids:
+                pipeline.submit("ReferenceType", "Status",
+                        {"refType": class_id}, lambda resp: None,
+                        lambda error, class_id=class_id: gone.append(
+                                class_id))
+        pipeline.run()
+        # (first, so a class we no longer have isn't still cached)
+        if self.jdwp.reply_cache is not None:
+            for class_id in gone:
+                self.jdwp.reply_cache.invalidate_type(class_id)
         with self.__debug_state_lock:
-            for event in event_list["events"]:
-                if event["eventKind"] in [self.jdwp.EventKind.CLASS_PREPARE,
-                        self.jdwp.EventKind.CLASS_UNLOAD]:
-                    self.__update_class_metadata(event["ClassPrepare"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_START:
-                    self.__update_thread_status(event["ThreadStart"]["thread"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_END:
-                    self.__update_thread_status(event["ThreadEnd"]["thread"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_DEATH:
-                    self.__update_thread_status(event["ThreadDeath"]["thread"])
+            for class_id in gone:
+                self.__forget_class(class_id)
+            for signature, class_ids in class_ids_by_signature.items():
+                survivors = [class_id for class_id in class_ids
+                        if class_id not in gone]
+                if survivors and signature not in self.class_ids_by_sig:
+                    self.class_ids_by_sig[signature] = survivors[-1]
+
+    def __forget_class(self, class_id):
+        """Removes a class from our indexes. Call holding the lock."""
+        cls = self.classes_by_id.pop(class_id, None)
+        if cls is None:
+            return
+        if self.class_ids_by_sig.get(cls["signature"]) == class_id:
+            del self.class_ids_by_sig[cls["signature"]]
+        simple_name = self.__signature_to_simple_name(cls["signature"])
+        class_ids = [other_id
+                for other_id in self.__class_ids_by_simple_name.get(
+                        simple_name, [])
+                if other_id != class_id]
+        if class_ids:
+            self.__class_ids_by_simple_name[simple_name] = class_ids
+        else:
+            self.__class_ids_by_simple_name.pop(simple_name, None)
+        for key in self.__source_file_keys(cls):
+            class_ids = self.class_ids_by_source_file.get(key, set()) - set(
+                    [class_id])
+            if class_ids:
+                self.class_ids_by_source_file[key] = class_ids
+            else:
+                self.class_ids_by_source_file.pop(key, None)
+        self.__loaded_class_ids.discard(class_id)
+        self.__changed()
+
+    def __resume_thread(self, thread_id):
+        try:
+            self.jdwp.ThreadReference.Resume({"thread": thread_id})
+        except pyjdwp.Error as e:
+            logging.warning("Couldn't resume thread %d: %s", thread_id, e)
+
+    def __request_class_prepares(self, source_file):
+        """Asks the jvm to report the classes defined in "source_file" as
+        they're prepared, suspending the preparing thread until we've set
+        our breakpoints in them (see __handle_event_list)"""
+        if self.__capability("canUseSourceNameFilters"):
+            modifier = {"modKind": 12, "sourceNamePattern": source_file}
+        else:
+            # no source name filters before jdwp 1.6; go by the class name,
+            # which misses classes not named after their file (and, until
+            # it's prepared, those nested in the one that is)
+            modifier = {"modKind": 5,
+                    "classPattern": "*" + source_file.split(".")[0]}
+        self.__add_class_prepare_request(source_file, modifier)
+
+    def __request_nested_class_prepares(self, classes):
+        """Without source name filters, asks for the classes nested in those
+        of "classes" with deferred breakpoints. Class patterns may only begin
+        or end with "*", so they're asked for by the outer class's full name
+        ("com.foo.Foo$*") once it's known."""
+        if self.__capability("canUseSourceNameFilters"):
+            return
+        to_request = []
+        with self.__debug_state_lock:
+            for cls in classes:
+                cls = self.classes_by_id.get(cls["typeID"])
+                if (cls is None or "$" in cls["signature"] or
+                        cls.get("source_file") not in
+                                self.deferred_breakpoints):
+                    continue
+                class_name = cls["signature"][1 : -1].replace("/", ".")
+                if class_name in self.__nested_class_prepare_names:
+                    continue
+                self.__nested_class_prepare_names.add(class_name)
+                to_request.append((cls["source_file"], class_name))
+        for source_file, class_name in to_request:
+            self.__add_class_prepare_request(source_file,
+                    {"modKind": 5, "classPattern": class_name + "$*"})
+
+    def __add_class_prepare_request(self, source_file, modifier):
+        resp = self.jdwp.EventRequest.Set({
+            "eventKind": self.jdwp.EventKind.CLASS_PREPARE,
+            "suspendPolicy": self.jdwp.SuspendPolicy.EVENT_THREAD,
+            "modifiers": [modifier]})
+        with self.__debug_state_lock:
+            self.__class_prepare_request_ids[source_file] = (
+                    self.__class_prepare_request_ids[source_file] +
+                    [resp["requestID"]])
+
+    def __capability(self, name):
+        if self.__capabilities is None:
+            self.__capabilities = self.jdwp.VirtualMachine.CapabilitiesNew()
+        return self.__capabilities[name]
 
     def __class_name_to_signature(self, class_name):
         return "L%s;" % class_name.replace(".", "/")
 
     def __initialize_event_subscriptions(self):
-        with self.__debug_state_lock:
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.CLASS_UNLOAD,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.CLASS_PREPARE,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_START,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_END,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_DEATH,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.EXCEPTION,
+        event_kinds = [self.jdwp.EventKind.CLASS_UNLOAD]
+        if self.track_new_classes:
+            event_kinds.append(self.jdwp.EventKind.CLASS_PREPARE)
+        event_kinds += [
+                self.jdwp.EventKind.THREAD_START,
+                self.jdwp.EventKind.THREAD_DEATH,
+                self.jdwp.EventKind.EXCEPTION]
+        for event_kind in event_kinds:
+            resp = self.jdwp.EventRequest.Set({
+                "eventKind": event_kind,
                 "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
                 "modifiers": []})
+            with self.__debug_state_lock:
+                self.__passive_request_ids.add(resp["requestID"])
+        with self.__debug_state_lock:
+            source_files = [source_file
+                    for source_file in self.deferred_breakpoints
+                    if source_file not in self.__class_prepare_request_ids]
+            for source_file in source_files:
+                self.__class_prepare_request_ids[source_file] = []
+            self.__subscribed = True
+        for source_file in source_files:
+            self.__request_class_prepares(source_file)
 
     def __initialize_jvm_state(self):
-        with self.__debug_state_lock:
-            self.threads = {}
+        with self.profiler.phase("threads"):
+            with self.__debug_state_lock:
+                self.threads = {}
+                self.__dirty_thread_ids = set()
+                self.__changed()
             threads_resp = self.jdwp.VirtualMachine.AllThreads()
-            for entry in threads_resp["threads"]:
-                thread_id = entry["thread"]
-                thread_name = self.jdwp.ThreadReference.Name({
-                    "thread": thread_id})["threadName"]
-                thread_group_id = self.jdwp.ThreadReference.ThreadGroup({
-                    "thread": thread_id})["group"]
-                self.threads[thread_id] = {
-                    "name": thread_name,
-                    "thread_group_id": thread_group_id}
-                self.__update_thread_status(thread_id)
-            classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()["classes"]
-            for entry in classes:
-                self.__update_class_metadata(entry)
-
-    def __update_class_metadata(self, class_entry):
+            with self.__debug_state_lock:
+                thread_ids = [entry["thread"]
+                        for entry in threads_resp["threads"]
+                        if self.__add_thread(entry["thread"])]
+            self.__fetch_thread_info(thread_ids)
+        with self.profiler.phase("all_classes"):
+            classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()[
+                    "classes"]
+        with self.profiler.phase("class_metadata"):
+            if self.lazy_metadata:
+                with self.__debug_state_lock:
+                    for entry in classes:
+                        self.__record_class(entry)
+            else:
+                self.__load_class_metadata(classes)
+
+    def __load_prepared_classes(self, classes):
+        """Loads the metadata of classes prepared since we attached. Runs on
+        a MetadataLoader worker (or if there's none, the event notifier
+        thread)."""
+        with self.__debug_state_lock:
+            lazy = self.lazy_metadata and not self.class_prepare_listeners
+            if lazy and not self.deferred_breakpoints:
+                # nobody's waiting on new classes; load them when needed
+                return
+        if lazy:
+            # load those that may have deferred breakpoints in them now
+            self.__fetch_source_files(classes)
+            classes = [self.classes_by_id.get(cls["typeID"]) for cls in classes]
+            classes = [cls for cls in classes if cls is not None and
+                    cls["source_file"] in self.deferred_breakpoints]
+        self.__load_class_metadata(classes)
+        self.__request_nested_class_prepares(classes)
+
+    def __record_class(self, class_entry):
+        """Adds the class to classes_by_id (without fetching its metadata) and
+        returns it, or None if it's blacklisted. Call holding the lock."""
         if class_entry["signature"] in self.class_blacklist:
-            return
+            return None
         class_id = class_entry["typeID"]
-        if class_id not in self.classes_by_id:
-            self.classes_by_id[class_id] = {"typeID": class_id}
-        self.class_ids_by_sig[class_entry["signature"]] = class_id
-        cls = self.classes_by_id[class_id]
-        cls["signature"] = class_entry["signature"]
-        cls["refTypeTag"] = class_entry["signature"]
-        self.__fetch_class_info(cls)
+        cls = self.classes_by_id.get(class_id)
+        if cls is None:
+            cls = {
+                    "typeID": class_id,
+                    "signature": class_entry["signature"],
+                    "refTypeTag": class_entry["refTypeTag"]}
+            self.classes_by_id[class_id] = cls
+            simple_name = self.__signature_to_simple_name(
+                    class_entry["signature"])
+            self.__class_ids_by_simple_name[simple_name] = (
+                    self.__class_ids_by_simple_name.get(simple_name, []) +
+                    [class_id])
+            self.__changed()
+        if self.class_ids_by_sig.get(class_entry["signature"]) != class_id:
+            self.class_ids_by_sig[class_entry["signature"]] = class_id
+            self.__changed()
+        return cls
+
+    def __load_class_metadata(self, class_entries):
+        """Fetches modifiers, fields, methods, source file and line tables for
+        "class_entries" (AllClassesWithGeneric or ClassPrepare entries, or
+        classes) not loaded or being loaded already, keeping up to
+        self.max_in_flight requests outstanding rather than waiting a round
+        trip for each. Each class is filled in privately and published once
+        it's complete; a class whose metadata can't be fetched (e.g. it was
+        unloaded meanwhile) is left out, and fetched again when next asked
+        for. Then sets the classes' deferred breakpoints and notifies the
+        class prepare listeners."""
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight,
+                self.__debug_state_lock)
+        loading = []
+        with self.__debug_state_lock:
+            for class_entry in class_entries:
+                recorded = self.__record_class(class_entry)
+                if (recorded is None or
+                        recorded["typeID"] in self.__loaded_class_ids or
+                        recorded["typeID"] in self.__loading_class_ids):
+                    continue
+                cls = dict(recorded)
+                self.__submit_class_info(pipeline, cls)
+                loading.append(cls)
+                self.__loading_class_ids[cls["typeID"]] = (
+                        threading.current_thread())
         try:
-            cls["source_file"] = self.jdwp.ReferenceType.SourceFile({
-                "refType": cls["typeID"]})["sourceFile"]
-        except pyjdwp.Error as e:
+            pipeline.run()
+        finally:
+            with self.__debug_state_lock:
+                for cls in loading:
+                    del self.__loading_class_ids[cls["typeID"]]
+                    if self.classes_by_id.get(cls["typeID"]) is cls:
+                        self.__loaded_class_ids.add(cls["typeID"])
+                self.__debug_state_lock.notify_all()
+            # (even if some failed to load, for those that didn't)
+            for cls in loading:
+                if (self.classes_by_id.get(cls["typeID"]) is cls and
+                        cls.get("source_file") is not None):
+                    self.__resolve_deferred_breakpoints(cls)
+                    self.__notify_class_prepare_listeners(cls)
+
+    def load_classes(self, class_ids):
+        """Makes sure the metadata (methods, line tables, ...) of the given
+        known classes is loaded, fetching what's missing, and returns the
+        classes (but not those unloaded meanwhile). Needed before using a
+        class in lazy_metadata mode."""
+        with self.__debug_state_lock:
+            self.__wait_for_loads(class_ids)
+            to_load = [self.classes_by_id[class_id] for class_id in
+                    set(class_ids) - self.__loaded_class_ids
+                    if class_id not in self.__loading_class_ids and
+                            class_id in self.classes_by_id]
+        if to_load:
+            with self.profiler.phase("lazy_class_metadata"):
+                self.__load_class_metadata(to_load)
+            with self.__debug_state_lock:
+                # someone else may have started on some of them meanwhile
+                self.__wait_for_loads(class_ids)
+        classes = [self.classes_by_id.get(class_id) for class_id in class_ids]
+        return [cls for cls in classes if cls is not None]
+
+    def __wait_for_loads(self, class_ids):
+        """Waits for the other threads loading any of "class_ids" (but not
+        on ourselves, e.g. from a class prepare listener). Call holding the
+        lock."""
+        current_thread = threading.current_thread()
+        while [class_id for class_id in class_ids
+                if self.__loading_class_ids.get(class_id,
+                        current_thread) is not current_thread]:
+            self.__debug_state_lock.wait()
+
+    def find_line_locations(self, filename, line_number, nearest=False):
+        """Returns the (classID, methodID, codeIndex) locations of a source
+        line (or if "nearest", of the first line from there on with code),
+        loading the metadata of the classes that may be defined in "filename"
+        first if needed"""
+        locations = self.__indexed_line_locations(filename, line_number,
+                nearest)
+        if self.lazy_metadata and not locations:
+            # a class is usually named after its source file (or nested in
+            # such a class), so try those first
+            simple_name = filename.rsplit("/", 1)[-1].split(".")[0]
+            self.load_classes(
+                    self.__class_ids_by_simple_name.get(simple_name, []))
+            locations = self.__indexed_line_locations(filename,
+                    line_number, nearest)
+            if not locations:
+                self.load_classes(self.__find_class_ids_by_source_file(
+                        filename))
+                locations = self.__indexed_line_locations(filename,
+                        line_number, nearest)
+        return locations
+
+    def __indexed_line_locations(self, filename, line_number, nearest):
+        class_ids = self.class_ids_by_source_file.get(filename, ())
+        classes = [self.classes_by_id.get(class_id)
+                for class_id in sorted(class_ids)]
+        return self.__line_locations([cls for cls in classes
+                if cls is not None], line_number, nearest)
+
+    def __line_locations(self, classes, line_number, nearest):
+        line_tables = [(cls["typeID"], method_entry["methodID"],
+                        method_entry["line_table"])
+                for cls in classes
+                for method_entry in cls.get("methods", [])
+                if "line_table" in method_entry]
+        if nearest:
+            next_lines = [line_table.next_line_at_or_after(line_number)
+                    for class_id, method_id, line_table in line_tables]
+            next_lines = [line for line in next_lines if line is not None]
+            if not next_lines:
+                return []
+            line_number = min(next_lines)
+        return [(class_id, method_id, code_index)
+                for class_id, method_id, line_table in line_tables
+                for code_index in line_table.code_indices_at(line_number)]
+
+    def source_line(self, class_id, method_id, code_index):
+        """Symbolizes a location (e.g. a stack frame's) as a (source file,
+        line number) pair, or None if there's no line info for it"""
+        classes = self.load_classes([class_id])
+        if not classes:
+            return None
+        [cls] = classes
+        for method_entry in cls.get("methods", []):
+            if method_entry["methodID"] != method_id:
+                continue
+            if "line_table" not in method_entry:
+                return None
+            line_number = method_entry["line_table"].line_at(code_index)
+            if line_number is None:
+                return None
+            return (cls["source_file"], line_number)
+        return None
+
+    def __find_class_ids_by_source_file(self, filename):
+        """Returns the ids of the classes whose metadata isn't loaded that are
+        defined in "filename", first fetching (just) the source file of every
+        such class. This is the fallback for classes not named after their
+        source file."""
+        with self.profiler.phase("lazy_source_files"):
+            self.__fetch_source_files([cls
+                    for class_id, cls in self.snapshot().classes_by_id.items()
+                    if class_id not in self.__loaded_class_ids])
+        return [class_id
+                for class_id in self.class_ids_by_source_file.get(filename, ())
+                if class_id not in self.__loaded_class_ids]
+
+    def __fetch_source_files(self, classes):
+        """Fetches the source file of those of "classes" we don't know it
+        for"""
+        def on_source_file(class_id, source_file):
+            cls = self.classes_by_id.get(class_id)
+            if cls is None or "source_file" in cls:
+                # unloaded or loaded meanwhile
+                return
+            cls = dict(cls, source_file=source_file)
+            self.classes_by_id[class_id] = cls
+            self.__index_source_file(cls)
+            self.__changed()
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight,
+                self.__debug_state_lock)
+        for cls in classes:
+            current = self.classes_by_id.get(cls["typeID"])
+            # (unloaded, or its source file is known already)
+            if current is None or "source_file" in current:
+                continue
+            pipeline.submit("ReferenceType", "SourceFile",
+                    {"refType": cls["typeID"]},
+                    lambda resp, class_id=cls["typeID"]: on_source_file(
+                            class_id, resp["sourceFile"]),
+                    # remember there's none, so we don't ask again
+                    lambda error, class_id=cls["typeID"]: on_source_file(
+                            class_id, None))
+        pipeline.run()
+
+    def __index_source_file(self, cls):
+        """Adds "cls" to class_ids_by_source_file. Call holding the lock."""
+        for key in self.__source_file_keys(cls):
+            class_ids = self.class_ids_by_source_file.get(key, set())
+            if cls["typeID"] not in class_ids:
+                self.class_ids_by_source_file[key] = class_ids | set(
+                        [cls["typeID"]])
+
+    def __source_file_keys(self, cls):
+        """Returns the class_ids_by_source_file keys "cls" is under"""
+        source_file = cls.get("source_file")
+        if source_file is None:
+            return ()
+        # the source file is in the directory of the class's package
+        package = cls["signature"][1:-1].rpartition("/")[0]
+        source_path = "/".join(part for part in (package, source_file) if part)
+        return (source_file, source_path)
+
+    def __signature_to_simple_name(self, signature):
+        # "Lcom/foo/Bar$Inner;" -> "Bar"
+        return signature[1:-1].rsplit("/", 1)[-1].split("$")[0]
+
+    def __submit_class_info(self, pipeline, cls):
+        ref_type = {"refType": cls["typeID"]}
+        failed = [False]
+        def on_error(error):
+            # drop just this class, not the rest of the pipeline's
+            if not failed[0]:
+                logging.warning("Couldn't load class %s: %s",
+                        cls["signature"], error)
+            failed[0] = True
+        def on_modifiers(resp):
+            cls["access_modifier_bits"] = resp["modBits"]
+        def on_fields(resp):
+            cls["fields"] = resp["declared"]
+        def on_methods(resp):
+            cls["methods"] = resp["declared"]
+        def on_source_file(resp):
+            # replies are handled in order, so the methods are known by now
+            if failed[0]:
+                return
+            cls["source_file"] = resp["sourceFile"]
+            self.__submit_line_tables(pipeline, cls)
+        def on_no_source_file(error):
             # No source info for class
-            return
-        source_file = cls["source_file"]
+            if failed[0]:
+                return
+            cls["source_file"] = None
+            self.__class_loaded(cls)
+        pipeline.submit("ReferenceType", "Modifiers", ref_type, on_modifiers,
+                on_error)
+        pipeline.submit("ReferenceType", "FieldsWithGeneric", ref_type,
+                on_fields, on_error)
+        pipeline.submit("ReferenceType", "MethodsWithGeneric", ref_type,
+                on_methods, on_error)
+        pipeline.submit("ReferenceType", "SourceFile", ref_type,
+                on_source_file, on_no_source_file)
+
+    def __submit_line_tables(self, pipeline, cls):
+        remaining = [len(cls["methods"])]
+        def on_method_done():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self.__class_loaded(cls)
         for method_entry in cls["methods"]:
-            try:
-                self.__fetch_method_info(cls, method_entry)
-            except pyjdwp.Error as e:
-                continue
-        # we save these to notify outside of the lock we're holding
-        to_notify = []
-        for matches, notify in self.class_prepare_listeners:
+            def on_line_table(resp, method_entry=method_entry):
+                method_entry["line_table"] = LineTable(
+                        (line["lineCodeIndex"], line["lineNumber"])
+                        for line in resp["lines"])
+                on_method_done()
+            def on_no_line_table(error):
+                on_method_done()
+            pipeline.submit("Method", "LineTable", {
+                "refType": cls["typeID"],
+                "methodID": method_entry["methodID"]},
+                on_line_table, on_no_line_table)
+        if not cls["methods"]:
+            self.__class_loaded(cls)
+
+    def __class_loaded(self, cls):
+        """Publishes a class whose metadata is all in, unless it's been
+        unloaded meanwhile"""
+        if cls["typeID"] not in self.classes_by_id:
+            return
+        self.classes_by_id[cls["typeID"]] = cls
+        self.__index_source_file(cls)
+        self.__changed()
+
+    def __notify_class_prepare_listeners(self, cls):
+        for matches, notify in list(self.class_prepare_listeners):
             if matches(cls):
-                to_notify.append(notify)
-        for notify in to_notify:
-            notify(cls)
-
-    def __fetch_class_info(self, cls):
-        cls["access_modifier_bits"] = self.jdwp.ReferenceType.Modifiers({
-            "refType": cls["typeID"]})["modBits"]
-        cls["fields"] = self.jdwp.ReferenceType.FieldsWithGeneric({
-            "refType": cls["typeID"]})["declared"]
-        cls["methods"] = self.jdwp.ReferenceType.MethodsWithGeneric({
-            "refType": cls["typeID"]})["declared"]
-
-    def __fetch_method_info(self, cls, method_entry):
-        method_id = method_entry["methodID"]
-        method_entry["line_table"] = self.jdwp.Method.LineTable({
-            "refType": cls["typeID"],
-            "methodID": method_id})["lines"]
-        for line in method_entry["line_table"]:
-            line_number = line["lineNumber"]
-            line_code_index = line["lineCodeIndex"]
-            index_key = (cls["source_file"], line_number)
-            if index_key not in self.line_index:
-                self.line_index[index_key] = []
-            self.line_index[index_key].append(
-                    (cls["typeID"], method_id, line_code_index))
-
-    def __update_thread_status(self, thread_id):
-        thread = self.threads[thread_id]
-        thread_status = self.jdwp.ThreadReference.Status({
-            "thread": thread_id})
-        thread["status"] = thread_status["threadStatus"]
-        thread["is_suspended"] = thread_status["suspendStatus"]
-        thread["frames"] = []
-        if thread["is_suspended"]:
-            frames = self.jdwp.ThreadReference.Frames({
-                "thread": thread_id,
-                "startFrame": 0,
-                "length": -1})["frames"]
+                notify(cls)
+
+    def __add_thread(self, thread_id):
+        """Adds a thread to self.threads, unless it's there already, and
+        returns whether it was added. Its name and group are fetched by
+        __fetch_thread_info, and its status when it's first asked for. Call
+        holding the lock."""
+        if thread_id in self.threads:
+            return False
+        self.threads[thread_id] = {"name": None, "thread_group_id": None}
+        self.__dirty_thread_ids.add(thread_id)
+        self.__changed()
+        return True
+
+    def __fetch_thread_info(self, thread_ids):
+        """Fetches the names and groups of "thread_ids" into self.threads"""
+        def on_info(thread_id, key, value):
+            thread = self.threads.get(thread_id)
+            if thread is not None:
+                self.threads[thread_id] = dict(thread, **{key: value})
+                self.__changed()
+        def on_error(error, thread_id):
+            # most likely it's died already, and we'll hear about it
+            logging.warning("Couldn't get info for thread %d: %s",
+                    thread_id, error)
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, self.max_in_flight,
+                self.__debug_state_lock)
+        for thread_id in thread_ids:
+            pipeline.submit("ThreadReference", "Name", {"thread": thread_id},
+                    lambda resp, thread_id=thread_id: on_info(
+                            thread_id, "name", resp["threadName"]),
+                    lambda error, thread_id=thread_id: on_error(
+                            error, thread_id))
+            pipeline.submit("ThreadReference", "ThreadGroup",
+                    {"thread": thread_id},
+                    lambda resp, thread_id=thread_id: on_info(
+                            thread_id, "thread_group_id", resp["group"]),
+                    lambda error, thread_id=thread_id: on_error(
+                            error, thread_id))
+        pipeline.run()
+
+    def __mark_threads_dirty(self, thread_ids=None):
+        """Notes that threads (default: all of them) may have changed state,
+        so their status and frames are fetched again when next asked for.
+        Call holding the lock."""
+        self.__thread_epoch += 1
+        if thread_ids is None:
+            self.__dirty_thread_ids.update(self.threads)
+            self.frame_cache.invalidate()
+            return
+        for thread_id in thread_ids:
+            self.__dirty_thread_ids.add(thread_id)
+            self.frame_cache.invalidate(thread_id)
+
+    def __mark_suspended_threads_dirty(self, event_list):
+        """Marks the threads an event suspended as dirty"""
+        if event_list["suspendPolicy"] == self.jdwp.SuspendPolicy.ALL:
+            self.__mark_threads_dirty()
+        elif (event_list["suspendPolicy"] ==
+                self.jdwp.SuspendPolicy.EVENT_THREAD):
+            self.__mark_threads_dirty([data["thread"]
+                    for event in event_list["events"]
+                    for data in event.values()
+                    if isinstance(data, dict) and data.get("thread")])
+
+    def __changed(self):
+        # call holding the lock
+        self.__version += 1
@@ -0,0 +1,471 @@
+"""End to end benchmarks for pyjdwp and pyjdb sessions, run against a fake jvm
+(see pyjdwp_fake) so they need no jvm and are repeatable. Run them with
+./benchmark.sh or
+
+  PYTHONPATH="." python -m pyjdb.pyjdb_benchmark [--classes 50000 ...]
+"""
+import argparse
+import logging
+import pyjdb
+import pyjdwp
+import pyjdwp_fake
+import sys
+import threading
+import time
+
+
+def start_fake_jvm(num_classes, num_threads, rtt, frames_per_thread=10):
+    jvm = pyjdwp_fake.FakeJvm(rtt=rtt)
+    jvm.populate(num_classes=num_classes, num_threads=num_threads,
+            frames_per_thread=frames_per_thread)
+    jvm.start_process()
+    return jvm
+
+
+def time_initialize(create_session, jvm):
+    """Returns the wall time of creating and initializing a session against
+    "jvm" (and disconnects it)"""
+    session = create_session(jvm.port)
+    start_time = time.time()
+    session.initialize()
+    elapsed = time.time() - start_time
+    session.disconnect()
+    return elapsed
+
+
+def benchmark_initialize_scaling(class_counts, num_threads, rtts,
+        max_in_flights, lazy_metadata=False):
+    """Initializes Jdwp and Pyjdb sessions against fake jvms of increasing size,
+    with and without artificial round trip time. Pyjdb is timed once per
+    metadata request window in "max_in_flights" (1 loads classes one request
+    at a time), and also in lazy_metadata mode if "lazy_metadata"."""
+    sessions = [("Pyjdb/%d" % max_in_flight,
+            lambda port, max_in_flight=max_in_flight: pyjdb.Pyjdb(
+                    "localhost", port, max_in_flight=max_in_flight))
+            for max_in_flight in max_in_flights]
+    if lazy_metadata:
+        sessions.append(("Pyjdb/lazy", lambda port: pyjdb.Pyjdb(
+                "localhost", port, lazy_metadata=True)))
+    print("Session initialize scaling (%d threads)" % num_threads)
+    print("%10s %8s %14s" % ("classes", "rtt", "Jdwp") + "".join(
+            " %14s" % label for label, create_session in sessions) +
+            " %14s" % "usec/class")
+    results = []
+    for rtt in rtts:
+        for num_classes in class_counts:
+            jvm = start_fake_jvm(num_classes, num_threads, rtt)
+            try:
+                jdwp_time = time_initialize(
+                        lambda port: pyjdwp.Jdwp("localhost", port), jvm)
+                pyjdb_times = [time_initialize(create_session, jvm)
+                        for label, create_session in sessions]
+            finally:
+                jvm.close()
+            results.append((num_classes, rtt, jdwp_time, pyjdb_times))
+            print("%10d %6.1fms %12.3fs" % (num_classes, rtt * 1e3, jdwp_time)
+                    + "".join(" %12.3fs" % pyjdb_time
+                            for pyjdb_time in pyjdb_times)
+                    + " %14.1f" % (min(pyjdb_times) / max(num_classes, 1) * 1e6))
+    return results
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory use of "obj" and everything it refers to (that's
+    not already in "seen"), in bytes"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def benchmark_line_table_memory(num_classes, methods_per_class=8,
+        lines_per_method=10):
+    """Compares the memory used by the line info of "num_classes" classes as
+    decoded line tables plus a line_index dict (how Pyjdb used to keep them)
+    and as pyjdb.LineTables plus the source file index"""
+    next_id = [0x7f0000000000]
+    def new_id():
+        next_id[0] += 8
+        return next_id[0]
+    classes = []
+    for i in range(num_classes):
+        methods = []
+        for j in range(methods_per_class):
+            first_line = 10 + j * (lines_per_method + 2)
+            methods.append((new_id(), [(k * 4, first_line + k)
+                    for k in range(lines_per_method)]))
+        classes.append((new_id(), "Class%d.java" % i,
+                "com/example/package%d/Class%d.java" % (i % 100, i), methods))
+    # as decoded, with the (source file, line) -> locations index
+    decoded_tables = []
+    line_index = {}
+    for class_id, source_file, source_path, methods in classes:
+        for method_id, lines in methods:
+            line_table = [{"lineCodeIndex": code_index,
+                    "lineNumber": line_number}
+                    for code_index, line_number in lines]
+            decoded_tables.append(line_table)
+            for line in line_table:
+                index_key = (source_file, line["lineNumber"])
+                if index_key not in line_index:
+                    line_index[index_key] = []
+                line_index[index_key].append(
+                        (class_id, method_id, line["lineCodeIndex"]))
+    seen = set()
+    decoded_size = deep_size(decoded_tables, seen) + deep_size(line_index, seen)
+    # as LineTables, with the source file -> class ids index
+    line_tables = []
+    class_ids_by_source_file = {}
+    for class_id, source_file, source_path, methods in classes:
+        for method_id, lines in methods:
+            line_tables.append(pyjdb.LineTable(lines))
+        for key in (source_file, source_path):
+            if key not in class_ids_by_source_file:
+                class_ids_by_source_file[key] = set()
+            class_ids_by_source_file[key].add(class_id)
+    seen = set()
+    compact_size = (deep_size(line_tables, seen) +
+            deep_size(class_ids_by_source_file, seen))
+    print("Line table memory (%d classes, %d methods/class, %d lines/method)" %
+            (num_classes, methods_per_class, lines_per_method))
+    print("%30s %14s %14s" % ("", "MB", "bytes/line"))
+    num_lines = num_classes * methods_per_class * lines_per_method
+    for name, size in [("decoded + line_index", decoded_size),
+            ("LineTable + source file index", compact_size)]:
+        print("%30s %14.1f %14.1f" % (name, size / 1e6,
+                float(size) / num_lines))
+    return decoded_size, compact_size
+
+
+def time_requests(session, operation):
+    """Returns the wall time of "operation()" and how many requests "session"
+    sent while it ran"""
+    packets_sent = session.jdwp.metrics.snapshot()["packets_sent"]
+    start_time = time.time()
+    operation()
+    elapsed = time.time() - start_time
+    return (elapsed,
+            session.jdwp.metrics.snapshot()["packets_sent"] - packets_sent)
+
+
+def benchmark_thread_tracking(thread_counts, rtts):
+    """Times what Pyjdb asks the jvm about its threads: at initialize, on each
+    resume, and for one thread's and every thread's status after a resume.
+    "poll all" is every thread's status asked for one at a time, which is what
+    each resume used to cost."""
+    operations = ["initialize", "resume", "get_thread", "get_threads",
+            "poll all"]
+    print("Thread tracking (seconds / requests)")
+    print("%10s %8s" % ("threads", "rtt") + "".join(
+            " %18s" % name for name in operations))
+    results = []
+    for rtt in rtts:
+        for num_threads in thread_counts:
+            jvm = start_fake_jvm(0, num_threads, rtt)
+            session = pyjdb.Pyjdb("localhost", jvm.port, lazy_metadata=True)
+            try:
+                thread_ids = []
+                def poll_all():
+                    for thread_id in thread_ids:
+                        session.jdwp.ThreadReference.Status(
+                                {"thread": thread_id})
+                timings = [time_requests(session, session.initialize)]
+                thread_ids.extend(session.snapshot().threads)
+                timings += [time_requests(session, operation) for operation in [
+                        session.resume,
+                        lambda: session.get_thread(thread_ids[0]),
+                        session.get_threads,
+                        poll_all]]
+            finally:
+                session.disconnect()
+                jvm.close()
+            results.append((num_threads, rtt, timings))
+            print("%10d %6.1fms" % (num_threads, rtt * 1e3) + "".join(
+                    " %10.3fs/%6d" % timing for timing in timings))
+    return results
+
+
+def benchmark_frames(num_threads, frames_per_thread, rtts):
+    """Times looking at a suspended jvm's stacks. "all stacks" is every
+    thread's status and whole stack (which is what refreshing thread status
+    used to fetch); the others are every thread's status, the top page of
+    one thread's stack, and that page again (from the frame cache)."""
+    operations = ["all stacks", "get_threads", "top frames", "again"]
+    print("Frames (%d threads, %d frames each; seconds / requests / bytes "
+            "received)" % (num_threads, frames_per_thread))
+    print("%8s" % "rtt" + "".join(" %26s" % name for name in operations))
+    results = []
+    for rtt in rtts:
+        jvm = start_fake_jvm(50, num_threads, rtt, frames_per_thread)
+        session = pyjdb.Pyjdb("localhost", jvm.port, lazy_metadata=True)
+        try:
+            session.initialize()
+            session.jdwp.VirtualMachine.Suspend()
+            thread_ids = list(session.snapshot().threads)
+            def all_stacks():
+                for thread_id in thread_ids:
+                    session.jdwp.ThreadReference.Status({"thread": thread_id})
+                    session.jdwp.ThreadReference.Frames({"thread": thread_id,
+                            "startFrame": 0, "length": -1})
+            top_frames = lambda: session.get_frames(thread_ids[0], 0,
+                    session.frame_cache.page_size)
+            timings = []
+            for operation in [all_stacks, session.get_threads, top_frames,
+                    top_frames]:
+                bytes_received = session.jdwp.metrics.snapshot()[
+                        "bytes_received"]
+                elapsed, requests = time_requests(session, operation)
+                timings.append((elapsed, requests,
+                        session.jdwp.metrics.snapshot()["bytes_received"] -
+                                bytes_received))
+        finally:
+            session.disconnect()
+            jvm.close()
+        results.append((rtt, timings))
+        print("%6.1fms" % (rtt * 1e3) + "".join(" %8.3fs/%6d/%9d" % timing
+                for timing in timings))
+    return results
+
+
+def benchmark_prepare_storm(num_classes, rtts, metadata_workers):
+    """Times how long a thread start event waits behind a burst of
+    "num_classes" class prepares (as at jvm start), and how long until the
+    metadata of those classes is loaded, once per number of background
+    metadata workers in "metadata_workers" (0 loads it on the event notifier
+    thread). The fake jvm runs in this process, as it sends the events."""
+    print("Class prepare storm (%d classes; seconds)" % num_classes)
+    print("%8s %8s %14s %14s" % ("rtt", "workers", "thread start",
+            "metadata"))
+    results = []
+    for rtt in rtts:
+        for num_workers in metadata_workers:
+            jvm = pyjdwp_fake.FakeJvm(rtt=rtt)
+            jvm.populate(num_classes=10, num_threads=10)
+            jvm.start()
+            session = pyjdb.Pyjdb("localhost", jvm.port,
+                    track_new_classes=True, metadata_workers=num_workers)
+            try:
+                session.initialize()
+                start_time = time.time()
+                for i in range(num_classes):
+                    jvm.prepare_class("Lcom/example/Prepared%d;" % i,
+                            "Prepared%d.java" % i,
+                            [("run", "()V", [(0, 1), (4, 2)])])
+                thread = jvm.start_thread("started")
+                while thread["thread"] not in session.threads:
+                    time.sleep(.001)
+                thread_start_time = time.time() - start_time
+                session.wait_for_metadata()
+                while len(session.classes_by_id) < 10 + num_classes:
+                    time.sleep(.001)
+                metadata_time = time.time() - start_time
+            finally:
+                session.disconnect()
+                jvm.close()
+            results.append((rtt, num_workers, thread_start_time,
+                    metadata_time))
+            print("%6.1fms %8d %13.3fs %13.3fs" % (rtt * 1e3, num_workers,
+                    thread_start_time, metadata_time))
+    return results
+
+
+def benchmark_concurrency(num_readers, rtts, duration=2.0):
+    """Times reads of a Pyjdb's state (a source_line, a find_line_locations
+    and a snapshot, as a UI or breakpoint lookup makes) on "num_readers"
+    threads for "duration" seconds, while the jvm keeps preparing classes and
+    starting threads, and a writer thread keeps resuming it and refreshing
+    every thread's status. "writes" is how many resume and refreshes the
+    writer got through. The fake jvm runs in this process, as it sends the
+    events."""
+    print("Concurrent reads (%d readers, %.0fs; read latency in ms)" % (
+            num_readers, duration))
+    print("%8s %10s %10s %10s %10s %10s" % ("rtt", "reads/s", "mean", "p99",
+            "max", "writes"))
+    results = []
+    for rtt in rtts:
+        jvm = pyjdwp_fake.FakeJvm(rtt=rtt)
+        jvm.populate(num_classes=100, num_threads=50)
+        jvm.start()
+        session = pyjdb.Pyjdb("localhost", jvm.port, track_new_classes=True)
+        latencies = []
+        writes = [0]
+        stop = threading.Event()
+        def read(cls):
+            method_id = cls["methods"][0]["methodID"]
+            thread_latencies = []
+            while not stop.is_set():
+                start_time = time.time()
+                session.source_line(cls["typeID"], method_id, 0)
+                session.find_line_locations(cls["sourceFile"], 10)
+                session.snapshot()
+                thread_latencies.append(time.time() - start_time)
+            latencies.extend(thread_latencies)
+        def prepare_classes():
+            i = 0
+            started = []
+            while not stop.is_set():
+                jvm.prepare_class("Lcom/example/Prepared%d;" % i,
+                        "Prepared%d.java" % i,
+                        [("run", "()V", [(0, 1), (4, 2)])])
+                started.append(jvm.start_thread("started-%d" % i))
+                # short lived, but not so short we can't look at them
+                if len(started) > 200:
+                    jvm.end_thread(started.pop(0))
+                i += 1
+                time.sleep(.001)
+        def write():
+            while not stop.is_set():
+                session.resume()
+                session.get_threads()
+                writes[0] += 1
+        # threads die before we've looked at them all the time here
+        logging.disable(logging.WARNING)
+        try:
+            session.initialize()
+            threads = [threading.Thread(target=read,
+                    args=(jvm.classes[i % len(jvm.classes)],))
+                    for i in range(num_readers)]
+            threads += [threading.Thread(target=prepare_classes),
+                    threading.Thread(target=write)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            session.disconnect()
+            jvm.close()
+            logging.disable(logging.NOTSET)
+        latencies.sort()
+        result = (len(latencies) / duration,
+                sum(latencies) / max(1, len(latencies)) * 1e3,
+                latencies[len(latencies) * 99 // 100] * 1e3,
+                latencies[-1] * 1e3, writes[0])
+        results.append((rtt, result))
+        print("%6.1fms %10d %10.3f %10.3f %10.3f %10d" % ((rtt * 1e3,) +
+                result))
+    return results
+
+
+def benchmark_reply_cache(num_threads, frames_per_thread, rtts, num_stops=3):
+    """Times a client that symbolizes every frame of every thread's stack,
+    asking the jvm for each frame's source file, methods and line table, at
+    each of "num_stops" stops (suspend, walk the stacks, resume), with and
+    without a pyjdwp.ReplyCache. The cache answers repeated questions about
+    a class without a round trip, and forgets the frames at each resume."""
+    print("Reply cache (%d threads, %d frames each, %d stops; seconds / "
+            "requests)" % (num_threads, frames_per_thread, num_stops))
+    print("%8s %18s %18s %10s" % ("rtt", "uncached", "cached", "hit rate"))
+    results = []
+    for rtt in rtts:
+        jvm = start_fake_jvm(50, num_threads, rtt, frames_per_thread)
+        timings = []
+        try:
+            for reply_cache in [None, pyjdwp.ReplyCache()]:
+                session = pyjdb.Pyjdb("localhost", jvm.port,
+                        lazy_metadata=True, reply_cache=reply_cache)
+                jdwp = session.jdwp
+                def walk_stacks():
+                    for stop in range(num_stops):
+                        jdwp.VirtualMachine.Suspend()
+                        for thread_id in session.snapshot().threads:
+                            for frame in jdwp.ThreadReference.Frames({
+                                    "thread": thread_id, "startFrame": 0,
+                                    "length": -1})["frames"]:
+                                ref_type = {"refType": frame["classID"]}
+                                jdwp.ReferenceType.SourceFile(ref_type)
+                                jdwp.ReferenceType.MethodsWithGeneric(ref_type)
+                                jdwp.Method.LineTable({
+                                        "refType": frame["classID"],
+                                        "methodID": frame["methodID"]})
+                        jdwp.VirtualMachine.Resume()
+                try:
+                    session.initialize()
+                    timings.append(time_requests(session, walk_stacks))
+                finally:
+                    session.disconnect()
+        finally:
+            jvm.close()
+        results.append((rtt, timings, reply_cache.hit_rate))
+        print("%6.1fms" % (rtt * 1e3) + "".join(" %10.3fs/%6d" % timing
+                for timing in timings) + " %9.1f%%" % (
+                        reply_cache.hit_rate * 100))
+    return results
+
+
+BENCHMARKS = ["initialize-scaling", "line-table-memory", "thread-tracking",
+        "frames", "prepare-storm", "concurrency", "reply-cache"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run, "
+            "of %s (default: all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--classes", type=int, nargs="+",
+            default=[100, 1000], help="fake jvm class counts to try")
+    parser.add_argument("--threads", type=int, default=100,
+            help="number of threads in the fake jvm")
+    parser.add_argument("--rtt", type=float, nargs="+", default=[0, .0005],
+            help="artificial round trip times (seconds) to try")
+    parser.add_argument("--max-in-flight", type=int, nargs="+",
+            default=[1, 64], help="Pyjdb metadata request windows to try")
+    parser.add_argument("--lazy-metadata", action="store_true",
+            help="also time Pyjdb in lazy_metadata mode")
+    parser.add_argument("--memory-classes", type=int, default=30000,
+            help="line-table-memory: number of classes")
+    parser.add_argument("--tracked-threads", type=int, nargs="+",
+            default=[100, 1500], help="thread-tracking: thread counts to try")
+    parser.add_argument("--frames-per-thread", type=int, default=300,
+            help="frames: stack depth of each thread")
+    parser.add_argument("--prepared-classes", type=int, default=2000,
+            help="prepare-storm: number of classes prepared")
+    parser.add_argument("--metadata-workers", type=int, nargs="+",
+            default=[0, 2], help="prepare-storm: metadata worker counts to try")
+    parser.add_argument("--readers", type=int, default=4,
+            help="concurrency: number of reader threads")
+    parser.add_argument("--stack-depth", type=int, default=20,
+            help="reply-cache: stack depth of each thread")
+    args = parser.parse_args()
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % benchmark)
+    benchmarks = args.benchmarks or BENCHMARKS
+    if "initialize-scaling" in benchmarks:
+        benchmark_initialize_scaling(args.classes, args.threads, args.rtt,
+                args.max_in_flight, args.lazy_metadata)
+        print("")
+    if "line-table-memory" in benchmarks:
+        benchmark_line_table_memory(args.memory_classes)
+        print("")
+    if "thread-tracking" in benchmarks:
+        benchmark_thread_tracking(args.tracked_threads, args.rtt)
+        print("")
+    if "frames" in benchmarks:
+        benchmark_frames(args.threads, args.frames_per_thread, args.rtt)
+        print("")
+    if "prepare-storm" in benchmarks:
+        benchmark_prepare_storm(args.prepared_classes, args.rtt,
+                args.metadata_workers)
+        print("")
+    if "concurrency" in benchmarks:
+        benchmark_concurrency(args.readers, args.rtt)
+        print("")
+    if "reply-cache" in benchmarks:
+        benchmark_reply_cache(args.threads, args.stack_depth, args.rtt)
+        print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,20 @@ import logging
 import os
 import pprint
 import pyjdb
+import pyjdwp
+import pyjdwp_fake
 import signal
 import socket
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 
 
 TEST_TMP_DIRNAME = tempfile.mkdtemp()
+# so the tests don't write to the user's spec cache
+os.environ["PYJDWP_CACHE_DIR"] = os.path.join(TEST_TMP_DIRNAME, "spec_cache")
 
 
 class PyjdbTestBase(unittest.TestCase):
@@ -132,5 +137,791 @@ class PyjdbTestBase(unittest.TestCase):
         time.sleep(5)
 
 
+
+class FakeJvmPyjdbTestBase(unittest.TestCase):
+    """Base class for tests running pyjdb against a fake jvm (see pyjdwp_fake),
+    so they don't need java.
+
+    setUp fills the jvm with a few classes and threads (see populate), then
+    starts it and attaches a session made by make_pyjdb, unless
+    "attach_in_setup" is unset, in which case tests call attach themselves.
+    """
+
+    # artificial round trip time of the fake jvm
+    rtt = 0.0
+    attach_in_setup = True
+
+    def setUp(self):
+        self.jvm = pyjdwp_fake.FakeJvm(rtt=self.rtt)
+        self.populate()
+        self.pyjdb = None
+        if self.attach_in_setup:
+            self.attach()
+
+    def tearDown(self):
+        if self.pyjdb is not None:
+            self.pyjdb.disconnect()
+        self.jvm.close()
+
+    def populate(self):
+        self.jvm.populate(num_classes=10, num_threads=2, methods_per_class=2,
+                lines_per_method=3)
+
+    def make_pyjdb(self, **kwargs):
+        """Returns a session with the fake jvm. Subclasses override this to
+        pass their own options."""
+        return pyjdb.Pyjdb("localhost", self.jvm.port, **kwargs)
+
+    def attach(self):
+        self.jvm.start()
+        self.pyjdb = self.make_pyjdb()
+        self.pyjdb.initialize()
+
+    def wait_until(self, predicate, timeout=5):
+        """Polls "predicate" until it returns something true or "timeout"
+        seconds pass, and returns what it last returned"""
+        deadline = time.time() + timeout
+        result = predicate()
+        while not result and time.time() < deadline:
+            time.sleep(.001)
+            result = predicate()
+        return result
+
+    def wait_for_thread_info(self, thread):
+        """Waits for pyjdb to hear of a thread the jvm started, and get its
+        name"""
+        self.wait_until(lambda: self.pyjdb.threads.get(
+                thread["thread"], {}).get("name") is not None)
+
+    def wait_for_unload(self, cls):
+        self.wait_until(lambda: cls["typeID"] not in self.pyjdb.classes_by_id)
+
+    def request_count(self, command_set_name, command_name):
+        return self.jvm.request_counts.get((command_set_name, command_name), 0)
+
+    def breakpoint_requests(self):
+        return [request for request in self.jvm.event_requests.values()
+                if request["eventKind"] == 2]
+
+
+class FakeJvmPyjdbTest(FakeJvmPyjdbTestBase):
+    """Runs pyjdb against a fake jvm"""
+
+    def test_initialize(self):
+        self.assertEquals(len(self.pyjdb.classes_by_id), 10)
+        self.assertEquals(len(self.pyjdb.threads), 2)
+        cls = self.jvm.classes[4]
+        self.assertEquals(self.pyjdb.class_ids_by_sig[cls["signature"]],
+                cls["typeID"])
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 16),
+                [(cls["typeID"], cls["methods"][1]["methodID"], 4)])
+
+    def test_initialize_profile(self):
+        phases = dict((phase["name"], phase)
+                for phase in self.pyjdb.profiler.as_dict()["phases"])
+        jdwp_initialize = phases["Pyjdb.initialize/Jdwp.initialize"]
+        self.assertEquals(jdwp_initialize["requests"], 2)
+        class_metadata = phases["Pyjdb.initialize/class_metadata"]
+        self.assertEquals(class_metadata["count"], 1)
+        self.assertEquals(class_metadata["requests_by_command"][
+                "ReferenceType.MethodsWithGeneric"], 10)
+        self.assertEquals(class_metadata["requests_by_command"][
+                "Method.LineTable"], 20)
+        self.assertEquals(class_metadata["requests"], 10 * 4 + 20)
+        self.assertTrue(class_metadata["bytes_received"] > 0)
+
+    def test_initialize_pipelined(self):
+        # keep the window smaller than the number of requests, and check
+        # classes without source info or line tables still load
+        self.jvm.add_class("Lcom/example/NoSource;",
+                methods=[("run", "()V", [(0, 1)])])
+        def no_line_table(request):
+            raise pyjdwp_fake.FakeJvmError(
+                    pyjdwp_fake.ERROR_ABSENT_INFORMATION)
+        self.jvm.set_handler("Method", "LineTable", no_line_table)
+        self.pyjdb.disconnect()
+        self.pyjdb = self.make_pyjdb(max_in_flight=3)
+        prepared = []
+        self.pyjdb.class_prepare_listeners.append(
+                (lambda cls: True, prepared.append))
+        self.pyjdb.initialize()
+        self.assertEquals(len(self.pyjdb.classes_by_id), 11)
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 16),
+                [])
+        self.assertEquals(len(prepared), 10)
+        cls = self.pyjdb.classes_by_id[self.jvm.classes[4]["typeID"]]
+        self.assertEquals(cls["source_file"], "Class4.java")
+        self.assertEquals([method["name"] for method in cls["methods"]],
+                ["method0", "method1"])
+
+    def test_initialize_with_a_failing_class(self):
+        # e.g. unloaded after it was listed; the others load regardless
+        gone = self.jvm.classes[5]
+        def modifiers(request):
+            cls = self.jvm.classes_by_id[request["refType"]]
+            if cls is gone:
+                raise pyjdwp_fake.FakeJvmError(
+                        pyjdwp_fake.ERROR_INVALID_CLASS)
+            return {"modBits": cls["modBits"]}
+        self.jvm.set_handler("ReferenceType", "Modifiers", modifiers)
+        self.pyjdb.disconnect()
+        self.pyjdb = self.make_pyjdb()
+        prepared = []
+        self.pyjdb.class_prepare_listeners.append(
+                (lambda cls: True, prepared.append))
+        self.pyjdb.initialize()
+        self.assertEquals(sorted(cls["typeID"] for cls in prepared),
+                sorted(cls["typeID"] for cls in self.jvm.classes
+                        if cls is not gone))
+        self.pyjdb.set_breakpoint_at_line("Class4.java", 16)
+        self.assertEquals(len(self.breakpoint_requests()), 1)
+
+    def test_set_breakpoint_at_line(self):
+        self.pyjdb.set_breakpoint_at_line("Class4.java", 16)
+        [request] = self.breakpoint_requests()
+        location = request["modifiers"][0]["LocationOnly"]
+        self.assertEquals(location["classID"], self.jvm.classes[4]["typeID"])
+        self.assertEquals(location["index"], 4)
+
+    def test_set_deferred_breakpoint_at_line(self):
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        self.assertEquals(self.breakpoint_requests(), [])
+        prepared = threading.Event()
+        self.pyjdb.class_prepare_listeners.append(
+                (lambda cls: True, lambda cls: prepared.set()))
+        self.jvm.prepare_class("Lcom/example/Later;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])])
+        prepared.wait(5)
+        [request] = self.breakpoint_requests()
+        self.assertEquals(request["modifiers"][0]["LocationOnly"]["index"], 3)
+
+    def test_deferred_breakpoint_in_each_prepared_class(self):
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        self.assertEquals(self.pyjdb.deferred_breakpoints,
+                {"Later.java": [("Later.java", 5, False)]})
+        prepared = threading.Semaphore(0)
+        self.pyjdb.class_prepare_listeners.append(
+                (lambda cls: True, lambda cls: prepared.release()))
+        outer = self.jvm.prepare_class("Lcom/example/Later;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])])
+        inner = self.jvm.prepare_class("Lcom/example/Later$Inner;",
+                "Later.java", [("run", "()V", [(0, 5)])])
+        prepared.acquire()
+        prepared.acquire()
+        # one breakpoint in each, not the first one again
+        self.assertEquals(sorted(
+                request["modifiers"][0]["LocationOnly"]["classID"]
+                for request in self.breakpoint_requests()),
+                [outer["typeID"], inner["typeID"]])
+
+    def test_class_ids_by_source_file(self):
+        cls = self.jvm.classes[4]
+        self.assertEquals(self.pyjdb.class_ids_by_source_file["Class4.java"],
+                set([cls["typeID"]]))
+        self.assertEquals(self.pyjdb.class_ids_by_source_file[
+                "com/example/package4/Class4.java"], set([cls["typeID"]]))
+
+    def test_find_nearest_line_locations(self):
+        # method1 of Class4 is on lines 15-17, method0 on 10-12
+        cls = self.jvm.classes[4]
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 13),
+                [])
+        self.assertEquals(
+                self.pyjdb.find_line_locations("Class4.java", 13, nearest=True),
+                [(cls["typeID"], cls["methods"][1]["methodID"], 0)])
+        self.assertEquals(
+                self.pyjdb.find_line_locations("Class4.java", 18, nearest=True),
+                [])
+
+    def test_source_line(self):
+        cls = self.jvm.classes[4]
+        method_id = cls["methods"][1]["methodID"]
+        self.assertEquals(self.pyjdb.source_line(cls["typeID"], method_id, 7),
+                ("Class4.java", 16))
+        self.assertEquals(self.pyjdb.source_line(cls["typeID"], method_id, 99),
+                ("Class4.java", 17))
+
+    def test_set_breakpoint_at_qualified_path(self):
+        self.pyjdb.set_breakpoint_at_line("com/example/package5/Class4.java",
+                16)
+        self.assertEquals(self.breakpoint_requests(), [])
+        self.assertEquals(self.pyjdb.deferred_breakpoints, {"Class4.java": [
+                ("com/example/package5/Class4.java", 16, False)]})
+        self.pyjdb.set_breakpoint_at_line("com/example/package4/Class4.java",
+                16)
+        [request] = self.breakpoint_requests()
+        location = request["modifiers"][0]["LocationOnly"]
+        self.assertEquals(location["classID"], self.jvm.classes[4]["typeID"])
+
+    def test_initialize_threads(self):
+        thread = self.jvm.threads[1]
+        self.assertEquals(self.pyjdb.threads[thread["thread"]],
+                {"name": "thread-1", "thread_group_id": thread["group"]})
+        # statuses are left until they're asked for
+        self.assertEquals(self.jvm.request_counts.get(
+                ("ThreadReference", "Status"), 0), 0)
+
+    def test_resume_marks_threads_dirty(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        self.pyjdb.jdwp.VirtualMachine.Suspend()
+        threads = self.pyjdb.get_threads()
+        self.assertEquals([thread["is_suspended"]
+                for thread in threads.values()], [1, 1])
+        # fetched already, so not asked again
+        self.pyjdb.get_thread(thread_id)
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Status")], 2)
+        self.pyjdb.resume()
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Status")], 2)
+        thread = self.pyjdb.get_thread(thread_id)
+        self.assertEquals(thread["is_suspended"], 0)
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Status")], 3)
+        # running, so asked again
+        self.pyjdb.get_threads()
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Status")], 5)
+        self.pyjdb.get_threads()
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Status")], 7)
+
+    def test_running_thread_status_is_refetched(self):
+        thread = self.jvm.threads[0]
+        self.assertEquals(self.pyjdb.get_thread(thread["thread"])["status"],
+                pyjdwp_fake.THREAD_STATUS_RUNNING)
+        # it may have blocked since, without telling us
+        thread["status"] = pyjdwp_fake.THREAD_STATUS_MONITOR
+        self.assertEquals(self.pyjdb.get_thread(thread["thread"])["status"],
+                pyjdwp_fake.THREAD_STATUS_MONITOR)
+
+    def test_class_unloaded_during_lookup(self):
+        cls = self.jvm.classes[4]
+        classes_by_id = self.pyjdb.classes_by_id
+        class UnloadingIndex(dict):
+            def get(self, key, default=None):
+                class_ids = dict.get(self, key, default)
+                # as if the class were unloaded right after this lookup
+                classes_by_id.pop(cls["typeID"], None)
+                return class_ids
+        self.pyjdb.class_ids_by_source_file = UnloadingIndex(
+                self.pyjdb.class_ids_by_source_file)
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 16),
+                [])
+
+    def test_thread_start_and_death(self):
+        thread = self.jvm.start_thread("started")
+        self.wait_for_thread_info(thread)
+        self.assertEquals(self.pyjdb.get_thread(thread["thread"])["status"],
+                pyjdwp_fake.THREAD_STATUS_RUNNING)
+        self.jvm.end_thread(thread)
+        self.wait_until(lambda: thread["thread"] not in self.pyjdb.threads)
+        self.assertEquals(len(self.pyjdb.threads), 2)
+        self.assertFalse(thread["thread"] in self.pyjdb.get_threads())
+
+    def test_suspending_event_marks_threads_dirty(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        self.assertEquals(self.pyjdb.get_thread(thread_id)["is_suspended"], 0)
+        self.pyjdb.jdwp.VirtualMachine.Suspend()
+        self.jvm.send_event(pyjdwp_fake.SUSPEND_POLICY_ALL, [{
+                "eventKind": 2,
+                "Breakpoint": {"requestID": 99, "thread": thread_id,
+                        "typeTag": 1, "classID": 1, "methodID": 1,
+                        "index": 0}}])
+        self.wait_until(
+                lambda: self.pyjdb.get_thread(thread_id)["is_suspended"])
+        self.assertEquals(self.pyjdb.get_thread(thread_id)["is_suspended"], 1)
+
+    def test_get_frames(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        self.pyjdb.frame_cache.page_size = 3
+        self.pyjdb.jdwp.VirtualMachine.Suspend()
+        all_frames = self.pyjdb.jdwp.ThreadReference.Frames({
+                "thread": thread_id, "startFrame": 0, "length": -1})["frames"]
+        self.assertEquals(len(all_frames), 10)
+        self.assertEquals(self.pyjdb.get_frames(thread_id, 0, 2),
+                all_frames[0 : 2])
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Frames")], 2)
+        # the first page is cached, the second isn't
+        self.assertEquals(self.pyjdb.get_frames(thread_id, 1, 4),
+                all_frames[1 : 5])
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Frames")], 3)
+        self.assertEquals(self.pyjdb.get_frames(thread_id), all_frames)
+        self.assertEquals(self.pyjdb.get_frames(thread_id, 8, 5),
+                all_frames[8 : 10])
+        self.assertEquals(self.pyjdb.get_frames(thread_id, 10), [])
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Frames")], 5)
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "FrameCount")], 1)
+        self.assertEquals((self.pyjdb.frame_cache.hits,
+                self.pyjdb.frame_cache.misses), (5, 4))
+        self.assertEquals(self.pyjdb.frame_cache.hit_rate, 5 / 9.0)
+
+    def test_resume_invalidates_frames(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        self.pyjdb.jdwp.VirtualMachine.Suspend()
+        self.assertEquals(len(self.pyjdb.get_frames(thread_id)), 10)
+        self.pyjdb.resume()
+        self.assertRaises(pyjdwp.Error, self.pyjdb.get_frames, thread_id)
+        self.pyjdb.jdwp.VirtualMachine.Suspend()
+        self.assertEquals(len(self.pyjdb.get_frames(thread_id, 0, 1)), 1)
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "FrameCount")], 3)
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Frames")], 2)
+
+    def test_reads_dont_wait_on_writers(self):
+        cls = self.jvm.classes[4]
+        method_id = cls["methods"][1]["methodID"]
+        entered = threading.Event()
+        release = threading.Event()
+        def slow_resume(request):
+            entered.set()
+            # (longer than the reads are given)
+            release.wait(10)
+            return {}
+        self.jvm.set_handler("VirtualMachine", "Resume", slow_resume)
+        writer = threading.Thread(target=self.pyjdb.resume)
+        writer.start()
+        self.assertTrue(entered.wait(5))
+        reads = []
+        read = threading.Event()
+        def reader():
+            reads.append(self.pyjdb.source_line(cls["typeID"], method_id, 7))
+            reads.append(len(self.pyjdb.find_line_locations("Class4.java",
+                    16)))
+            reads.append(len(self.pyjdb.snapshot().threads))
+            read.set()
+        try:
+            # answered from what's loaded while resume is still held up by
+            # the jvm (which is only released below)
+            threading.Thread(target=reader).start()
+            self.assertTrue(read.wait(5))
+            self.assertTrue(writer.is_alive())
+            self.assertEquals(reads, [("Class4.java", 16), 1, 2])
+        finally:
+            release.set()
+            writer.join(10)
+
+    def test_snapshot(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        snapshot = self.pyjdb.snapshot()
+        self.assertEquals(snapshot.classes_by_id, self.pyjdb.classes_by_id)
+        self.assertEquals(snapshot.class_ids_by_source_file,
+                self.pyjdb.class_ids_by_source_file)
+        # unchanged, so not copied again
+        self.assertTrue(self.pyjdb.snapshot() is snapshot)
+        thread = self.jvm.start_thread("started")
+        self.wait_for_thread_info(thread)
+        self.pyjdb.get_thread(thread_id)
+        later = self.pyjdb.snapshot()
+        self.assertTrue(later.version > snapshot.version)
+        self.assertEquals(later.threads[thread["thread"]]["name"], "started")
+        self.assertEquals(later.threads[thread_id]["is_suspended"], 0)
+        # entries are replaced rather than changed, so the earlier snapshot
+        # is as it was
+        self.assertFalse(thread["thread"] in snapshot.threads)
+        self.assertFalse("is_suspended" in snapshot.threads[thread_id])
+
+    def test_class_unload(self):
+        self.pyjdb.jdwp.reply_cache = pyjdwp.ReplyCache()
+        cls = self.jvm.classes[4]
+        self.pyjdb.jdwp.ReferenceType.SourceFile({"refType": cls["typeID"]})
+        self.jvm.unload_class(cls)
+        self.wait_for_unload(cls)
+        self.assertFalse(cls["typeID"] in self.pyjdb.classes_by_id)
+        self.assertFalse(cls["signature"] in self.pyjdb.class_ids_by_sig)
+        self.assertFalse("Class4.java" in self.pyjdb.class_ids_by_source_file)
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 10),
+                [])
+        self.assertEquals(self.pyjdb.jdwp.reply_cache.stats()["entries"], 0)
+
+    def test_class_unload_of_unknown_copy(self):
+        cls = self.jvm.classes[4]
+        # the same class, from another class loader, which (not tracking new
+        # classes) we don't hear of
+        self.jvm.unload_class(self.jvm.prepare_class(cls["signature"]))
+        # events are handled in order, so once this is gone so is that
+        other = self.jvm.classes[5]
+        self.jvm.unload_class(other)
+        self.assertTrue(self.wait_until(
+                lambda: other["typeID"] not in self.pyjdb.classes_by_id))
+        self.assertTrue(cls["typeID"] in self.pyjdb.classes_by_id)
+        self.assertEquals(self.pyjdb.class_ids_by_sig[cls["signature"]],
+                cls["typeID"])
+
+
+class LineTableTest(unittest.TestCase):
+    def setUp(self):
+        # a loop: line 11 has code at two places
+        self.line_table = pyjdb.LineTable(
+                [(0, 10), (4, 11), (9, 13), (12, 11), (15, 14)])
+
+    def test_line_at(self):
+        self.assertEquals(self.line_table.line_at(0), 10)
+        self.assertEquals(self.line_table.line_at(5), 11)
+        self.assertEquals(self.line_table.line_at(12), 11)
+        self.assertEquals(self.line_table.line_at(100), 14)
+        self.assertEquals(pyjdb.LineTable([(3, 1)]).line_at(2), None)
+
+    def test_code_indices_at(self):
+        self.assertEquals(self.line_table.code_indices_at(11), [4, 12])
+        self.assertEquals(self.line_table.code_indices_at(13), [9])
+        self.assertEquals(self.line_table.code_indices_at(12), [])
+
+    def test_next_line_at_or_after(self):
+        self.assertEquals(self.line_table.next_line_at_or_after(1), 10)
+        self.assertEquals(self.line_table.next_line_at_or_after(11), 11)
+        self.assertEquals(self.line_table.next_line_at_or_after(12), 13)
+        self.assertEquals(self.line_table.next_line_at_or_after(15), None)
+
+    def test_entries(self):
+        self.assertEquals(len(self.line_table), 5)
+        self.assertEquals(self.line_table.entries(),
+                [(0, 10), (4, 11), (9, 13), (12, 11), (15, 14)])
+
+
+class LazyMetadataPyjdbTest(FakeJvmPyjdbTestBase):
+    """Runs pyjdb in lazy_metadata mode against a fake jvm"""
+
+    def populate(self):
+        FakeJvmPyjdbTestBase.populate(self)
+        # not named after its source file
+        self.helper = self.jvm.add_class("Lcom/example/Helper;",
+                "Class4.java", [("help", "()V", [(0, 100)])])
+
+    def make_pyjdb(self, **kwargs):
+        return FakeJvmPyjdbTestBase.make_pyjdb(self, lazy_metadata=True,
+                **kwargs)
+
+    def test_initialize(self):
+        self.assertEquals(len(self.pyjdb.classes_by_id), 11)
+        cls = self.jvm.classes[4]
+        self.assertEquals(self.pyjdb.class_ids_by_sig[cls["signature"]],
+                cls["typeID"])
+        self.assertEquals([cls for cls in self.pyjdb.classes_by_id.values()
+                if "methods" in cls], [])
+        self.assertEquals(
+                self.request_count("ReferenceType", "MethodsWithGeneric"), 0)
+        self.assertEquals(self.request_count("Method", "LineTable"), 0)
+
+    def test_set_breakpoint_at_line(self):
+        self.pyjdb.set_breakpoint_at_line("Class4.java", 16)
+        [request] = self.breakpoint_requests()
+        location = request["modifiers"][0]["LocationOnly"]
+        self.assertEquals(location["classID"], self.jvm.classes[4]["typeID"])
+        self.assertEquals(location["index"], 4)
+        # only the class named after the file was loaded
+        self.assertEquals(
+                self.request_count("ReferenceType", "MethodsWithGeneric"), 1)
+        self.assertEquals(self.request_count("ReferenceType", "SourceFile"), 1)
+
+    def test_find_line_locations_falls_back_to_source_files(self):
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 100),
+                [(self.helper["typeID"],
+                        self.helper["methods"][0]["methodID"], 0)])
+        self.assertEquals(
+                self.request_count("ReferenceType", "MethodsWithGeneric"), 2)
+        self.assertEquals(self.request_count("ReferenceType", "SourceFile"),
+                1 + 10 + 1)
+        # source files are remembered
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 99),
+                [])
+        self.assertEquals(self.request_count("ReferenceType", "SourceFile"),
+                1 + 10 + 1)
+
+    def test_deferred_breakpoint(self):
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        methods_requests = self.request_count(
+                "ReferenceType", "MethodsWithGeneric")
+        # only the class defined in Later.java (which isn't named after it)
+        # gets loaded
+        self.jvm.prepare_class("Lcom/example/Unrelated;", "Unrelated.java",
+                [("run", "()V", [(0, 5)])])
+        self.jvm.prepare_class("Lcom/example/LaterHelper;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])])
+        [request] = self.wait_until(self.breakpoint_requests)
+        self.assertEquals(request["modifiers"][0]["LocationOnly"]["index"], 3)
+        self.assertEquals(
+                self.request_count("ReferenceType", "MethodsWithGeneric"),
+                methods_requests + 1)
+
+    def test_source_line(self):
+        cls = self.jvm.classes[4]
+        method_id = cls["methods"][1]["methodID"]
+        self.assertEquals(
+                self.pyjdb.source_line(cls["typeID"], method_id, 5),
+                ("Class4.java", 16))
+        self.assertEquals(
+                self.pyjdb.source_line(cls["typeID"], method_id, 8),
+                ("Class4.java", 17))
+        self.pyjdb.source_line(cls["typeID"], method_id, 0)
+        # loaded once
+        self.assertEquals(self.request_count("Method", "LineTable"), 2)
+
+    def test_load_classes_with_a_failing_class(self):
+        cls = self.jvm.classes[4]
+        gone = self.jvm.classes[5]
+        # unloaded, but we haven't heard yet
+        del self.jvm.classes_by_id[gone["typeID"]]
+        loaded = self.pyjdb.load_classes([gone["typeID"], cls["typeID"]])
+        self.assertEquals([loaded_cls["typeID"] for loaded_cls in loaded],
+                [gone["typeID"], cls["typeID"]])
+        self.assertFalse("methods" in loaded[0])
+        self.assertEquals(len(loaded[1]["methods"]), len(cls["methods"]))
+        self.assertEquals(self.pyjdb.find_line_locations("Class4.java", 16),
+                [(cls["typeID"], cls["methods"][1]["methodID"], 4)])
+        # the failed class is tried again next time
+        self.jvm.classes_by_id[gone["typeID"]] = gone
+        [loaded_cls] = self.pyjdb.load_classes([gone["typeID"]])
+        self.assertEquals(len(loaded_cls["methods"]), len(gone["methods"]))
+
+
+class FilteredClassPreparePyjdbTest(FakeJvmPyjdbTestBase):
+    """Runs pyjdb against a fake jvm without tracking every new class, so it
+    only hears about the classes its deferred breakpoints are waiting for"""
+
+    attach_in_setup = False
+
+    def make_pyjdb(self, **kwargs):
+        return FakeJvmPyjdbTestBase.make_pyjdb(self, track_new_classes=False,
+                **kwargs)
+
+    def class_prepare_requests(self):
+        return [request for request in self.jvm.event_requests.values()
+                if request["eventKind"] == 8]
+
+    def wait_for_breakpoint_requests(self, count):
+        self.assertTrue(self.wait_until(
+                lambda: len(self.breakpoint_requests()) >= count))
+
+    def test_deferred_breakpoint(self):
+        self.attach()
+        self.assertEquals(self.class_prepare_requests(), [])
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        self.pyjdb.set_breakpoint_at_line("Later.java", 4)
+        [request] = self.class_prepare_requests()
+        self.assertEquals(request["suspendPolicy"],
+                self.pyjdb.jdwp.SuspendPolicy.EVENT_THREAD)
+        self.assertEquals(request["modifiers"],
+                [{"modKind": 12, "SourceNameMatch": {
+                        "sourceNamePattern": "Later.java"}}])
+        thread = self.jvm.threads[0]
+        methods_requests = self.jvm.request_counts[
+                ("ReferenceType", "MethodsWithGeneric")]
+        unrelated = self.jvm.prepare_class("Lcom/example/Unrelated;",
+                "Unrelated.java", thread=thread["thread"])
+        cls = self.jvm.prepare_class("Lcom/example/LaterHelper;",
+                "Later.java", [("run", "()V", [(0, 4), (3, 5)])],
+                thread=thread["thread"])
+        self.wait_for_breakpoint_requests(2)
+        # the unrelated class wasn't reported, and the thread that prepared
+        # the other one gets resumed
+        self.assertTrue(cls["typeID"] in self.pyjdb.classes_by_id)
+        self.assertFalse(unrelated["typeID"] in self.pyjdb.classes_by_id)
+        self.assertEquals(self.jvm.request_counts[
+                ("ReferenceType", "MethodsWithGeneric")], methods_requests + 1)
+        self.wait_until(lambda: not thread["suspendCount"])
+        self.assertEquals(thread["suspendCount"], 0)
+
+    def test_deferred_before_attach(self):
+        self.pyjdb = self.make_pyjdb()
+        self.pyjdb.set_deferred_breakpoint_at_line("Later.java", 5)
+        self.jvm.start()
+        self.pyjdb.initialize()
+        self.assertEquals(len(self.class_prepare_requests()), 1)
+
+    def test_without_source_name_filters(self):
+        self.jvm.capabilities["canUseSourceNameFilters"] = False
+        self.attach()
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        [request] = self.class_prepare_requests()
+        self.assertEquals(request["modifiers"],
+                [{"modKind": 5, "ClassMatch": {"classPattern": "*Later"}}])
+        thread = self.jvm.threads[0]
+        self.jvm.prepare_class("Lcom/example/Later;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])], thread=thread["thread"])
+        self.wait_for_breakpoint_requests(1)
+        # the classes nested in it are asked for by its name, which we know
+        # now, before the thread that prepared it can go on to prepare them
+        self.wait_until(lambda: not thread["suspendCount"])
+        self.assertEquals(sorted(request["modifiers"][0]["ClassMatch"]
+                for request in self.class_prepare_requests()),
+                [{"classPattern": "*Later"},
+                        {"classPattern": "com.example.Later$*"}])
+        nested = self.jvm.prepare_class("Lcom/example/Later$1;", "Later.java",
+                [("run", "()V", [(0, 5)])], thread=thread["thread"])
+        self.wait_for_breakpoint_requests(2)
+        self.assertEquals(sorted(
+                request["modifiers"][0]["LocationOnly"]["classID"]
+                for request in self.breakpoint_requests())[-1],
+                nested["typeID"])
+        self.wait_until(lambda: not thread["suspendCount"])
+        self.assertEquals(thread["suspendCount"], 0)
+
+
+class TrackNewClassesPyjdbTest(FakeJvmPyjdbTestBase):
+    """Runs pyjdb against a fake jvm, tracking every class prepared after it
+    attaches"""
+
+    def make_pyjdb(self, **kwargs):
+        return FakeJvmPyjdbTestBase.make_pyjdb(self, track_new_classes=True,
+                **kwargs)
+
+    def test_deferred_breakpoint_resumes_thread(self):
+        # reported both for the request tracking every new class and for the
+        # deferred breakpoint's, which suspends the thread preparing it
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        thread = self.jvm.threads[0]
+        self.jvm.prepare_class("Lcom/example/Later;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])], thread=thread["thread"])
+        self.wait_until(lambda: not thread["suspendCount"])
+        self.assertEquals(thread["suspendCount"], 0)
+        self.assertEquals(len(self.breakpoint_requests()), 1)
+
+    def test_class_unload_from_one_class_loader(self):
+        cls = self.jvm.classes[4]
+        # the same class, from another class loader
+        other = self.jvm.prepare_class(cls["signature"], "Class4.java")
+        self.assertTrue(self.wait_until(
+                lambda: self.pyjdb.class_ids_by_sig[cls["signature"]] ==
+                        other["typeID"]))
+        self.pyjdb.wait_for_metadata(5)
+        self.jvm.unload_class(other)
+        self.wait_for_unload(other)
+        self.assertFalse(other["typeID"] in self.pyjdb.classes_by_id)
+        self.assertEquals(self.pyjdb.class_ids_by_sig[cls["signature"]],
+                cls["typeID"])
+        self.assertEquals(
+                self.pyjdb.class_ids_by_source_file["Class4.java"],
+                set([cls["typeID"]]))
+
+
+class MetadataLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.release = threading.Event()
+        self.loader = pyjdb.MetadataLoader(self.load, num_workers=1)
+        self.loader.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.loader.stop()
+
+    def load(self, classes):
+        self.release.wait(5)
+        self.loaded.append([cls["typeID"] for cls in classes])
+
+    def test_put(self):
+        ready = []
+        self.loader.put([{"typeID": 1}, {"typeID": 2}],
+                lambda: ready.append("both"))
+        # already queued, so only waited on
+        self.loader.put([{"typeID": 2}], lambda: ready.append("again"))
+        self.loader.put([], lambda: ready.append("none"))
+        self.assertEquals(ready, ["none"])
+        self.assertFalse(self.loader.wait_idle(.01))
+        self.release.set()
+        self.assertTrue(self.loader.wait_idle(5))
+        self.assertEquals(sorted(sum(self.loaded, [])), [1, 2])
+        self.assertEquals(sorted(ready), ["again", "both", "none"])
+        stats = self.loader.stats()
+        self.assertEquals(stats["loaded"], 2)
+        self.assertEquals(stats["pending"], 0)
+
+    def test_failed_load_is_ready(self):
+        def fail(classes):
+            raise pyjdwp.Error("disconnected")
+        loader = pyjdb.MetadataLoader(fail)
+        loader.start()
+        ready = threading.Event()
+        loader.put([{"typeID": 1}], ready.set)
+        self.assertTrue(ready.wait(5))
+        self.assertTrue(loader.wait_idle(5))
+        loader.stop()
+
+    def test_failed_class_is_left_out(self):
+        loaded = []
+        def load(classes):
+            class_ids = [cls["typeID"] for cls in classes]
+            if 2 in class_ids:
+                raise pyjdwp.Error("JDWP error: 21")
+            loaded.extend(class_ids)
+        loader = pyjdb.MetadataLoader(load, num_workers=1)
+        ready = threading.Event()
+        # queued before the worker starts, so loaded as one batch
+        loader.put([{"typeID": 1}, {"typeID": 2}, {"typeID": 3}], ready.set)
+        loader.start()
+        self.assertTrue(ready.wait(5))
+        self.assertEquals(sorted(loaded), [1, 3])
+        self.assertEquals(loader.stats()["batches"], 1)
+        loader.stop()
+
+
+class BackgroundMetadataPyjdbTest(FakeJvmPyjdbTestBase):
+    """Checks events are handled while the metadata of prepared classes is
+    loaded in the background"""
+
+    rtt = .02
+
+    def make_pyjdb(self, **kwargs):
+        # one request at a time, so loading takes a while
+        return FakeJvmPyjdbTestBase.make_pyjdb(self, max_in_flight=1,
+                metadata_workers=1, track_new_classes=True, **kwargs)
+
+    def test_events_not_held_up(self):
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        classes = [self.jvm.prepare_class("Lcom/example/Later%d;" % i,
+                "Later.java", [("run", "()V", [(0, 4), (3, 5)])])
+                for i in range(10)]
+        thread = self.jvm.start_thread("started")
+        self.wait_for_thread_info(thread)
+        self.assertEquals(self.pyjdb.threads[thread["thread"]]["name"],
+                "started")
+        self.assertFalse(self.pyjdb.wait_for_metadata(0))
+        self.assertTrue(self.pyjdb.wait_for_metadata(10))
+        for cls in classes:
+            self.assertEquals(
+                    self.pyjdb.classes_by_id[cls["typeID"]]["source_file"],
+                    "Later.java")
+        self.assertEquals(len(self.breakpoint_requests()), 10)
+
+    def test_failing_class_prepared_alongside(self):
+        def modifiers(request):
+            cls = self.jvm.classes_by_id[request["refType"]]
+            if cls["signature"] == "Lcom/example/Gone;":
+                raise pyjdwp_fake.FakeJvmError(
+                        pyjdwp_fake.ERROR_INVALID_CLASS)
+            return {"modBits": cls["modBits"]}
+        self.jvm.set_handler("ReferenceType", "Modifiers", modifiers)
+        self.pyjdb.set_breakpoint_at_line("Later.java", 5)
+        # the other two are queued while the loader is busy with the first,
+        # so are loaded as one batch
+        classes = [self.jvm.prepare_class(signature, "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])])
+                for signature in ("Lcom/example/First;", "Lcom/example/Gone;",
+                        "Lcom/example/Later;")]
+        self.assertTrue(self.wait_until(
+                lambda: len(self.breakpoint_requests()) >= 2))
+        self.assertTrue(self.pyjdb.wait_for_metadata(10))
+        self.assertEquals(sorted(
+                request["modifiers"][0]["LocationOnly"]["classID"]
+                for request in self.breakpoint_requests()),
+                [classes[0]["typeID"], classes[2]["typeID"]])
+
+    def test_load_classes_waits_for_loader(self):
+        cls = self.jvm.prepare_class("Lcom/example/Later;", "Later.java",
+                [("run", "()V", [(0, 4), (3, 5)])])
+        self.wait_until(lambda: cls["typeID"] in self.pyjdb.classes_by_id)
+        [loaded] = self.pyjdb.load_classes([cls["typeID"]])
+        self.assertEquals(len(loaded["methods"]), 1)
+        # fetched once, by the loader
+        self.assertEquals(self.jvm.request_counts[
+                ("ReferenceType", "MethodsWithGeneric")], 11)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,17 @@
+import collections
+import contextlib
+import errno
+import hashlib
+import heapq
 import logging
-import pkg_resources
-import pyparsing
+import marshal
+import os
 import Queue
 import re
+import select
 import socket
 import struct
+import tempfile
 import threading
 import time
 
@@ -16,8 +23,18 @@ class Timeout(Error):
     """Pyjdwp module-level error used specificallly for timeouts"""
     pass
 
+class Cancelled(Error):
+    """Pyjdwp module-level error raised when waiting on a cancelled request"""
+    pass
+
+# keep in sync with setup.py
+VERSION = "0.1"
+
 JDWP_PACKET_HEADER_LENGTH = 11
 
+# length, id, flags, error code (or command set and command, for commands)
+JDWP_PACKET_HEADER = struct.Struct(">IIBH")
+
 STRUCT_FMTS_BY_SIZE_UNSIGNED = {1: "B", 4: "I", 8: "Q"}
 
 STRUCT_FMT_BY_TYPE_TAG = {
@@ -42,11 +59,29 @@ class GenericService(object):
     def __init__(self, jdwp, command_set):
         self.__jdwp = jdwp
         self.__command_set = command_set
-        for cmd_name in self.__command_set.commands:
-            def create_lambda(name):
-                return lambda data={}: self.__jdwp.command_request(
-                        self.__command_set.name, name, data)
-            setattr(self, cmd_name, create_lambda(cmd_name))
+
+    def __getattr__(self, cmd_name):
+        # commands are bound (and their spec built) the first time they're
+        # used; after that they're regular attributes and we aren't called
+        if (cmd_name.startswith("_") or
+                cmd_name not in self.__command_set.commands):
+            raise AttributeError(cmd_name)
+        command_set_name = self.__command_set.name
+        jdwp = self.__jdwp
+        command = lambda data={}: jdwp.command_request(
+                command_set_name, cmd_name, data)
+        setattr(self, cmd_name, command)
+        return command
+
+    def __dir__(self):
+        return sorted(set(dir(type(self)) + self.__dict__.keys() +
+                self.__command_set.commands.keys()))
+
+    def submit(self, cmd_name, data={}):
+        """Non-blocking version of calling the command; returns a
+        CommandFuture"""
+        return self.__jdwp.command_request_async(
+                self.__command_set.name, cmd_name, data)
 
 
 class GenericConstantSet(object):
@@ -56,6 +91,42 @@ class GenericConstantSet(object):
             setattr(self, constant_name, constant.value)
 
 
+class LazyMapping(collections.Mapping):
+    """Read-only mapping whose values are built from raw entries (by calling
+    "factory(entry)") the first time they're looked up"""
+
+    def __init__(self, entries, factory):
+        self.__entries = entries
+        self.__factory = factory
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def __getitem__(self, key):
+        try:
+            return self.__values[key]
+        except KeyError:
+            pass
+        entry = self.__entries[key]
+        with self.__lock:
+            if key not in self.__values:
+                self.__values[key] = self.__factory(entry)
+            return self.__values[key]
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __iter__(self):
+        return iter(self.__entries)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def built_keys(self):
+        """Keys whose values have been built so far"""
+        return self.__values.keys()
+
+
 class RequestIdGenerator(object):
     def __init__(self):
         self.__lock = threading.RLock()
@@ -74,21 +145,1082 @@ class RequestIdGenerator(object):
             self._next_id = value
 
 
+class PendingReply(object):
+    """A reply we're waiting on from the jvm. Signalled by ReplyDispatcher as
+    soon as the reply packet comes in, or when it is cancelled or its deadline
+    passes."""
+
+    def __init__(self, req_id, deadline=None):
+        self.req_id = req_id
+        self.deadline = deadline
+        self.__condition = threading.Condition()
+        self.__done = False
+        self.__err = None
+        self.__payload = None
+        self.__exception = None
+        self.__callbacks = []
+
+    def done(self):
+        with self.__condition:
+            return self.__done
+
+    def add_done_callback(self, callback):
+        """Calls "callback(pending_reply)" once we're done, or right away if
+        we already are. Callbacks usually run on the jdwp_listener thread, so
+        they should return quickly."""
+        with self.__condition:
+            if not self.__done:
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancelled(self):
+        with self.__condition:
+            return self.__done and isinstance(self.__exception, Cancelled)
+
+    @property
+    def reply_size(self):
+        """Size of the reply payload (0 until it arrives)"""
+        with self.__condition:
+            return len(self.__payload) if self.__payload is not None else 0
+
+    @property
+    def error_code(self):
+        """The reply's jdwp error code (None until it arrives)"""
+        with self.__condition:
+            return self.__err
+
+    @property
+    def exception(self):
+        """Why we're done without a reply (timeout, cancellation, closed
+        connection), if we are"""
+        with self.__condition:
+            return self.__exception
+
+    def set_reply(self, err, payload):
+        with self.__condition:
+            if self.__done:
+                return False
+            self.__err = err
+            self.__payload = payload
+            self.__done = True
+            self.__condition.notify_all()
+        self.__run_callbacks()
+        return True
+
+    def set_exception(self, exception):
+        with self.__condition:
+            if self.__done:
+                return False
+            self.__exception = exception
+            self.__done = True
+            self.__condition.notify_all()
+        self.__run_callbacks()
+        return True
+
+    def wait(self):
+        """Blocks until a reply is received; raises pyjdwp.Error if err != 0
+        (or if the request timed out or was cancelled), returns reply payload
+        otherwise"""
+        with self.__condition:
+            # no timeout here: ReplyDispatcher's reaper wakes us up at the
+            # deadline, so we don't need to poll
+            while not self.__done:
+                self.__condition.wait()
+        if self.__exception is not None:
+            raise self.__exception
+        if self.__err != 0:
+            raise Error("JDWP error: %s" % self.__err)
+        return self.__payload
+
+    def __run_callbacks(self):
+        callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.exception("Error in reply callback: %s", e)
+
+
+class ReplyReaper(object):
+    """Times out PendingReplys whose deadline has passed. Runs a single thread,
+    which may be shared by many ReplyDispatchers (see JdwpMultiplexer)."""
+
+    def __init__(self, name="jdwp_reply_reaper"):
+        self.__name = name
+        self.__condition = threading.Condition()
+        self.__deadlines = []
+        self.__sequence = 0
+        self.__running = True
+        self.__thread = None
+
+    def schedule(self, dispatcher, pending):
+        """Calls "dispatcher.expire(pending)" once pending.deadline passes"""
+        with self.__condition:
+            if not self.__running:
+                return
+            self.__sequence += 1
+            heapq.heappush(self.__deadlines,
+                    (pending.deadline, self.__sequence, dispatcher, pending))
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                        target = self.__reap_loop, name = self.__name)
+                self.__thread.setDaemon(True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    def close(self):
+        with self.__condition:
+            self.__running = False
+            self.__deadlines = []
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join(1.0)
+
+    def __reap_loop(self):
+        while True:
+            expired = []
+            with self.__condition:
+                if not self.__running:
+                    return
+                if not self.__deadlines:
+                    # nothing to time out; sleep until someone schedules
+                    self.__condition.wait()
+                    continue
+                now = time.time()
+                if self.__deadlines[0][0] > now:
+                    self.__condition.wait(self.__deadlines[0][0] - now)
+                    continue
+                while self.__deadlines and self.__deadlines[0][0] <= now:
+                    _, _, dispatcher, pending = heapq.heappop(self.__deadlines)
+                    expired.append((dispatcher, pending))
+            for dispatcher, pending in expired:
+                dispatcher.expire(pending)
+
+
+class ReplyDispatcher(object):
+    """Routes reply packets to the PendingReply waiting for them.
+
+    Replies are registered before their request is sent. A ReplyReaper fails
+    any pending reply whose deadline has passed and forgets its req_id, so
+    replies that arrive after a timeout (or for cancelled requests) are
+    dropped rather than kept around forever.
+    """
+
+    def __init__(self, timeout=None, reaper=None):
+        self.__timeout = timeout
+        self.__condition = threading.Condition()
+        self.__pending = {}
+        self.__running = True
+        self.__owns_reaper = reaper is None
+        if reaper is None:
+            reaper = ReplyReaper()
+        self.__reaper = reaper
+
+    def register(self, req_id, timeout=None):
+        if timeout is None:
+            timeout = self.__timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        pending = PendingReply(req_id, deadline)
+        with self.__condition:
+            if not self.__running:
+                raise Error("Connection closed")
+            if req_id in self.__pending:
+                raise Error("Request id %d already pending" % req_id)
+            self.__pending[req_id] = pending
+        if deadline is not None:
+            self.__reaper.schedule(self, pending)
+        return pending
+
+    def dispatch(self, req_id, err, payload):
+        """Hands a reply to whoever is waiting on it. Returns False if nobody
+        is (anymore)."""
+        with self.__condition:
+            pending = self.__pending.pop(req_id, None)
+        if pending is None:
+            return False
+        return pending.set_reply(err, payload)
+
+    def cancel(self, req_id):
+        with self.__condition:
+            pending = self.__pending.pop(req_id, None)
+        if pending is None:
+            return False
+        return pending.set_exception(Cancelled("Request %d cancelled" % req_id))
+
+    def expire(self, pending):
+        """Fails "pending" with a Timeout, if it's still waiting"""
+        with self.__condition:
+            # the req_id may have been answered (and even reused) since; only
+            # expire the entry the deadline belongs to
+            if self.__pending.get(pending.req_id) is not pending:
+                return False
+            del self.__pending[pending.req_id]
+        return pending.set_exception(Timeout(
+                "Timed out waiting for reply to request %d" % pending.req_id))
+
+    @property
+    def pending_count(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def close(self):
+        with self.__condition:
+            self.__running = False
+            pending = self.__pending.values()
+            self.__pending = {}
+        for entry in pending:
+            entry.set_exception(Error("Connection closed"))
+        if self.__owns_reaper:
+            self.__reaper.close()
+
+
+class CommandFuture(object):
+    """Handle to a command request that's been sent to the jvm but whose reply
+    may not have arrived yet. Returned by Jdwp.command_request_async.
+    "on_payload(payload)" is called with the reply payload the first time
+    result gets one, before it returns."""
+
+    def __init__(self, dispatcher, command, pending, metrics=None,
+            on_payload=None):
+        self.command = command
+        self.__dispatcher = dispatcher
+        self.__pending = pending
+        self.__metrics = metrics
+        self.__on_payload = on_payload
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__decoded = False
+
+    @property
+    def req_id(self):
+        return self.__pending.req_id
+
+    def done(self):
+        return self.__pending.done()
+
+    def cancelled(self):
+        return self.__pending.cancelled()
+
+    def cancel(self):
+        return self.__dispatcher.cancel(self.__pending.req_id)
+
+    def add_done_callback(self, callback):
+        """Calls "callback(future)" when the reply arrives (or the request
+        fails). See PendingReply.add_done_callback."""
+        self.__pending.add_done_callback(lambda pending: callback(self))
+
+    def result(self):
+        """Blocks until the reply arrives and returns it decoded; raises
+        pyjdwp.Error on jdwp errors, timeouts and cancellation"""
+        payload = self.__pending.wait()
+        with self.__lock:
+            if not self.__decoded:
+                if self.__on_payload is not None:
+                    self.__on_payload(payload)
+                start_time = time.time()
+                self.__result = self.command.decode(payload)
+                self.__decoded = True
+                if self.__metrics is not None:
+                    self.__metrics.record_decode(self.command.label,
+                            time.time() - start_time)
+            return self.__result
+
+
+def gather(futures):
+    """Waits for all of "futures" and returns their results in order. Raises
+    the first error encountered, after all futures are done."""
+    results = []
+    first_error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Error as e:
+            results.append(None)
+            if first_error is None:
+                first_error = e
+    if first_error is not None:
+        raise first_error
+    return results
+
+
+class RequestPipeline(object):
+    """Streams many command requests to the jvm keeping at most
+    "max_in_flight" outstanding at once. Requests are queued with submit and
+    sent by run, which hands each reply to its callback, on the calling thread
+    and in submission order, as soon as it arrives. Callbacks may submit
+    follow-up requests (e.g. a line table per method once the methods are
+    known); run returns when the queue is empty and every reply is handled.
+    If "callback_lock" is given, callbacks are called holding it, but run
+    doesn't hold it while waiting for replies."""
+
+    def __init__(self, jdwp, max_in_flight=64, callback_lock=None):
+        if max_in_flight < 1:
+            raise Error("max_in_flight must be positive, got %d" %
+                    max_in_flight)
+        self.__jdwp = jdwp
+        self.__max_in_flight = max_in_flight
+        self.__callback_lock = callback_lock
+        self.__queued = collections.deque()
+        self.__in_flight = collections.deque()
+
+    @property
+    def max_in_flight(self):
+        return self.__max_in_flight
+
+    def submit(self, command_set_name, command_name, data, on_reply,
+            on_error=None):
+        """Queues a request. "on_reply(result)" gets the decoded reply;
+        "on_error(error)" gets the pyjdwp.Error if the request fails, or if
+        on_error is None the error is raised out of run."""
+        self.__queued.append(
+                (command_set_name, command_name, data, on_reply, on_error))
+
+    def run(self):
+        try:
+            while self.__queued or self.__in_flight:
+                while (self.__queued and
+                        len(self.__in_flight) < self.__max_in_flight):
+                    (command_set_name, command_name, data, on_reply,
+                            on_error) = self.__queued.popleft()
+                    future = self.__jdwp.command_request_async(
+                            command_set_name, command_name, data)
+                    self.__in_flight.append((future, on_reply, on_error))
+                future, on_reply, on_error = self.__in_flight.popleft()
+                try:
+                    result = future.result()
+                except Error as e:
+                    if on_error is None:
+                        raise
+                    self.__call(on_error, e)
+                    continue
+                self.__call(on_reply, result)
+        except:
+            # don't leave requests behind for a caller that's given up
+            for future, on_reply, on_error in self.__in_flight:
+                future.cancel()
+            self.__in_flight.clear()
+            self.__queued.clear()
+            raise
+
+    def __call(self, callback, arg):
+        if self.__callback_lock is None:
+            callback(arg)
+            return
+        with self.__callback_lock:
+            callback(arg)
+
+
+class PhaseProfiler(object):
+    """Times named phases of work (e.g. the steps of attaching to a jvm) and
+    counts the requests made, and bytes sent and received, during each. Phases
+    nest; a request counts towards every phase active on the thread that sent
+    it. Entering a phase again adds to its totals."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self.__stack()
+        path = "/".join([record["name"] for record in stack[-1 : ]] + [name])
+        with self.__lock:
+            if path not in self.__phases:
+                self.__phases[path] = {
+                        "name": path,
+                        "depth": len(stack),
+                        "seconds": 0.0,
+                        "count": 0,
+                        "requests": 0,
+                        "bytes_sent": 0,
+                        "bytes_received": 0,
+                        "requests_by_command": {}}
+            record = self.__phases[path]
+        stack.append(record)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            stack.pop()
+            with self.__lock:
+                record["seconds"] += elapsed
+                record["count"] += 1
+
+    @property
+    def active(self):
+        """Whether the calling thread is in a phase"""
+        return bool(self.__stack())
+
+    def reset(self):
+        with self.__lock:
+            self.__phases = collections.OrderedDict()
+
+    def request_sent(self, command_name, num_bytes):
+        """Counts a request against the calling thread's active phases; returns
+        a token to pass to reply_received"""
+        records = tuple(self.__stack())
+        if records:
+            with self.__lock:
+                for record in records:
+                    record["requests"] += 1
+                    record["bytes_sent"] += num_bytes
+                    by_command = record["requests_by_command"]
+                    by_command[command_name] = by_command.get(command_name, 0) + 1
+        return records
+
+    def reply_received(self, token, num_bytes):
+        if token:
+            with self.__lock:
+                for record in token:
+                    record["bytes_received"] += num_bytes
+
+    def as_dict(self):
+        """Returns the phases' totals, in the order they were first entered"""
+        with self.__lock:
+            phases = []
+            for record in self.__phases.values():
+                record = dict(record)
+                record["requests_by_command"] = dict(
+                        record["requests_by_command"])
+                phases.append(record)
+            return {"phases": phases}
+
+    def report(self):
+        lines = ["%-44s %10s %7s %9s %12s %12s" % ("phase", "seconds",
+                "count", "requests", "bytes sent", "bytes recv")]
+        for record in self.as_dict()["phases"]:
+            indent = "  " * record["depth"]
+            lines.append("%-44s %10.3f %7d %9d %12d %12d" % (
+                    indent + record["name"].split("/")[-1], record["seconds"],
+                    record["count"], record["requests"], record["bytes_sent"],
+                    record["bytes_received"]))
+            by_command = record["requests_by_command"]
+            for command_name in sorted(by_command,
+                    key=lambda name: -by_command[name]):
+                lines.append("%-44s %28d" % (indent + "    " + command_name,
+                        by_command[command_name]))
+        return "\n".join(lines)
+
+    def __stack(self):
+        if not hasattr(self.__local, "stack"):
+            self.__local.stack = []
+        return self.__local.stack
+
+
+class JdwpMetrics(object):
+    """Running counters for a jdwp session's traffic: per command requests,
+    replies, errors, bytes, encode/decode time and send-to-reply latency (as
+    a histogram with power of two microsecond buckets), plus packet, event and
+    error code totals. Updates are a few dict operations under one lock, so
+    it's cheap enough to leave on. Read it with snapshot()."""
+
+    LATENCY_BUCKETS = 32
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__dump_thread = None
+        self.__dump_stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__start_time = time.time()
+            self.__commands = {}
+            self.__in_flight = 0
+            self.__max_in_flight = 0
+            self.__packets_sent = 0
+            self.__packets_received = 0
+            self.__bytes_sent = 0
+            self.__bytes_received = 0
+            self.__events_by_kind = {}
+            self.__errors_by_code = {}
+
+    def record_request(self, command_name, num_bytes, encode_seconds=0.0):
+        with self.__lock:
+            command = self.__command(command_name)
+            command["requests"] += 1
+            command["bytes_out"] += num_bytes
+            command["encode_seconds"] += encode_seconds
+            self.__in_flight += 1
+            self.__max_in_flight = max(self.__max_in_flight, self.__in_flight)
+
+    def record_reply(self, command_name, latency, num_bytes, error_code=0):
+        bucket = min(int(latency * 1e6).bit_length(), self.LATENCY_BUCKETS - 1)
+        with self.__lock:
+            self.__in_flight -= 1
+            command = self.__command(command_name)
+            command["replies"] += 1
+            command["bytes_in"] += num_bytes
+            command["latency_seconds"] += latency
+            command["max_latency_seconds"] = max(
+                    command["max_latency_seconds"], latency)
+            command["latency_histogram"][bucket] += 1
+            if error_code:
+                command["errors"] += 1
+                self.__errors_by_code[error_code] = (
+                        self.__errors_by_code.get(error_code, 0) + 1)
+
+    def record_no_reply(self, command_name, timed_out):
+        """Records a request that timed out, or was cancelled (or failed with
+        the connection), before its reply arrived"""
+        with self.__lock:
+            self.__in_flight -= 1
+            command = self.__command(command_name)
+            command["timeouts" if timed_out else "cancelled"] += 1
+
+    def record_decode(self, command_name, decode_seconds):
+        with self.__lock:
+            self.__command(command_name)["decode_seconds"] += decode_seconds
+
+    def record_event(self, event_kind):
+        with self.__lock:
+            self.__events_by_kind[event_kind] = (
+                    self.__events_by_kind.get(event_kind, 0) + 1)
+
+    def record_packet_sent(self, num_bytes):
+        with self.__lock:
+            self.__packets_sent += 1
+            self.__bytes_sent += num_bytes
+
+    def record_packets_received(self, packets):
+        """Records packets as returned by PacketReader.read"""
+        num_bytes = 0
+        for _, _, _, payload in packets:
+            num_bytes += JDWP_PACKET_HEADER_LENGTH + len(payload)
+        with self.__lock:
+            self.__packets_received += len(packets)
+            self.__bytes_received += num_bytes
+
+    def snapshot(self):
+        """Returns a copy of the counters as a dict. Latency histograms map
+        each bucket's upper bound in microseconds to its count (empty buckets
+        are left out)."""
+        with self.__lock:
+            commands = {}
+            for command_name, command in self.__commands.items():
+                command = dict(command)
+                histogram = command.pop("latency_histogram")
+                command["latency_histogram_us"] = dict(
+                        (1 << bucket, count)
+                        for bucket, count in enumerate(histogram) if count)
+                commands[command_name] = command
+            return {
+                    "seconds": time.time() - self.__start_time,
+                    "commands": commands,
+                    "in_flight": self.__in_flight,
+                    "max_in_flight": self.__max_in_flight,
+                    "packets_sent": self.__packets_sent,
+                    "packets_received": self.__packets_received,
+                    "bytes_sent": self.__bytes_sent,
+                    "bytes_received": self.__bytes_received,
+                    "events_by_kind": dict(self.__events_by_kind),
+                    "errors_by_code": dict(self.__errors_by_code)}
+
+    def report(self, snapshot=None):
+        """Formats a snapshot (by default, a new one) as a table"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = ["%.1fs: %d packets (%d bytes) sent, %d packets (%d bytes) "
+                "received, %d in flight (max %d)" % (snapshot["seconds"],
+                snapshot["packets_sent"], snapshot["bytes_sent"],
+                snapshot["packets_received"], snapshot["bytes_received"],
+                snapshot["in_flight"], snapshot["max_in_flight"])]
+        lines.append("%-44s %8s %7s %10s %10s %10s %10s" % ("command",
+                "requests", "errors", "mean ms", "max ms", "bytes in",
+                "bytes out"))
+        commands = snapshot["commands"]
+        for command_name in sorted(commands):
+            command = commands[command_name]
+            mean_latency = (command["latency_seconds"] / command["replies"]
+                    if command["replies"] else 0.0)
+            lines.append("%-44s %8d %7d %10.3f %10.3f %10d %10d" % (
+                    command_name, command["requests"], command["errors"],
+                    mean_latency * 1e3, command["max_latency_seconds"] * 1e3,
+                    command["bytes_in"], command["bytes_out"]))
+        if snapshot["events_by_kind"]:
+            lines.append("events by kind: %s" % snapshot["events_by_kind"])
+        if snapshot["errors_by_code"]:
+            lines.append("errors by code: %s" % snapshot["errors_by_code"])
+        return "\n".join(lines)
+
+    def start_periodic_dump(self, interval, dump=None):
+        """Calls "dump(snapshot)" every "interval" seconds (by default logging
+        a report) until stop_periodic_dump is called"""
+        if dump is None:
+            dump = lambda snapshot: logging.info(
+                    "jdwp metrics:\n%s", self.report(snapshot))
+        self.stop_periodic_dump()
+        self.__dump_stop = threading.Event()
+        self.__dump_thread = threading.Thread(target = self.__dump_loop,
+                args = (interval, dump, self.__dump_stop),
+                name = "jdwp_metrics_dump")
+        self.__dump_thread.setDaemon(True)
+        self.__dump_thread.start()
+
+    def stop_periodic_dump(self):
+        if self.__dump_thread is None:
+            return
+        self.__dump_stop.set()
+        if threading.current_thread() is not self.__dump_thread:
+            self.__dump_thread.join()
+        self.__dump_thread = None
+
+    def __dump_loop(self, interval, dump, stop):
+        while not stop.wait(interval):
+            try:
+                dump(self.snapshot())
+            except Exception as e:
+                logging.exception("Error dumping metrics: %s", e)
+
+    def __command(self, command_name):
+        if command_name not in self.__commands:
+            self.__commands[command_name] = {
+                    "requests": 0,
+                    "replies": 0,
+                    "errors": 0,
+                    "timeouts": 0,
+                    "cancelled": 0,
+                    "bytes_out": 0,
+                    "bytes_in": 0,
+                    "encode_seconds": 0.0,
+                    "decode_seconds": 0.0,
+                    "latency_seconds": 0.0,
+                    "max_latency_seconds": 0.0,
+                    "latency_histogram": [0] * self.LATENCY_BUCKETS}
+        return self.__commands[command_name]
+
+
+class EventNotifier(object):
+    """Background thread for handing event packets to the Jdwp sessions they
+    belong to. We use a separate thread for this so that the thread reading
+    packets off the wire need not block while we handle events. One notifier
+    may be shared by many sessions (see JdwpMultiplexer).
+
+    The thread blocks on the queue while there's nothing to do. When it wakes
+    up it drains whatever else is queued (up to "max_batch" events) and hands
+    each notify function its run of payloads in a single call, so bursts of
+    events (e.g. the class prepares at jvm start) are handled in batches."""
+
+    __STOP = object()
+
+    def __init__(self, name="jdwp_event_notifier", max_batch=256):
+        self.__events = Queue.Queue()
+        self.__max_batch = max_batch
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__thread = threading.Thread(target = self.__notify_loop, name = name)
+        self.__thread.setDaemon(True)
+        # stats, guarded by self.__lock
+        self.__max_queue_depth = 0
+        self.__dispatched = 0
+        self.__batches = 0
+        self.__max_batch_size = 0
+        self.__total_latency = 0.0
+        self.__max_latency = 0.0
+
+    def start(self):
+        with self.__lock:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__lock:
+            if not self.__running:
+                return
+            self.__running = False
+        self.__events.put(self.__STOP)
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def put(self, notify, event_payload):
+        """Queues "notify([event_payload, ...])" to be called on the notifier
+        thread"""
+        self.__events.put((notify, event_payload, time.time()))
+        depth = self.__events.qsize()
+        if depth > self.__max_queue_depth:
+            with self.__lock:
+                self.__max_queue_depth = max(self.__max_queue_depth, depth)
+
+    def stats(self):
+        """Returns a dict of queue depth and dispatch latency (seconds from
+        put to notify) statistics"""
+        with self.__lock:
+            return {
+                    "queue_depth": self.__events.qsize(),
+                    "max_queue_depth": self.__max_queue_depth,
+                    "dispatched": self.__dispatched,
+                    "batches": self.__batches,
+                    "max_batch_size": self.__max_batch_size,
+                    "mean_latency": (self.__total_latency / self.__dispatched
+                            if self.__dispatched else 0.0),
+                    "max_latency": self.__max_latency}
+
+    def __notify_loop(self):
+        while True:
+            batch = [self.__events.get()]
+            while batch[-1] is not self.__STOP and len(batch) < self.__max_batch:
+                try:
+                    batch.append(self.__events.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is self.__STOP:
+                self.__notify(batch[ : -1])
+                return
+            self.__notify(batch)
+
+    def __notify(self, batch):
+        if not batch:
+            return
+        now = time.time()
+        latencies = [now - enqueued for _, _, enqueued in batch]
+        with self.__lock:
+            self.__dispatched += len(batch)
+            self.__batches += 1
+            self.__max_batch_size = max(self.__max_batch_size, len(batch))
+            self.__total_latency += sum(latencies)
+            self.__max_latency = max(self.__max_latency, max(latencies))
+        # hand each notify function its consecutive run of payloads
+        start = 0
+        while start < len(batch):
+            notify = batch[start][0]
+            end = start + 1
+            while end < len(batch) and batch[end][0] == notify:
+                end += 1
+            try:
+                notify([event_payload for _, event_payload, _ in batch[start : end]])
+            except Exception as e:
+                logging.exception("Error notifying event: %s", e)
+            start = end
+
+
+class JdwpMultiplexer(object):
+    """Drives any number of jdwp sessions from a few shared threads: one that
+    reads packets for all of their connections (using select), one
+    EventNotifier that calls all of their event callbacks and one ReplyReaper
+    that times out all of their requests. Without one, each Jdwp session runs
+    its own threads for these.
+
+        multiplexer = pyjdwp.JdwpMultiplexer()
+        sessions = [pyjdwp.Jdwp(host, port, multiplexer=multiplexer)
+                for host, port in targets]
+
+    Since event callbacks for all sessions run on the same thread, a slow
+    callback in one session delays event delivery for the others.
+    """
+
+    def __init__(self):
+        self.notifier = EventNotifier("jdwp_multiplexed_event_notifier")
+        self.reaper = ReplyReaper("jdwp_multiplexed_reply_reaper")
+        self.__lock = threading.Lock()
+        self.__connections = {}
+        self.__running = True
+        # written to whenever the set of connections changes, to wake up the
+        # reader thread's select call
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        self.__reader_thread = threading.Thread(
+                target = self.__listen, name = "jdwp_multiplexed_listener")
+        self.__reader_thread.setDaemon(True)
+        self.__reader_thread.start()
+        self.notifier.start()
+
+    def register(self, connection):
+        with self.__lock:
+            self.__connections[connection.fileno()] = connection
+        self.__wakeup()
+
+    def unregister(self, connection):
+        with self.__lock:
+            for fd, registered in self.__connections.items():
+                if registered is connection:
+                    del self.__connections[fd]
+        self.__wakeup()
+
+    def close(self):
+        self.__running = False
+        self.__wakeup()
+        self.__reader_thread.join(1.0)
+        self.notifier.stop()
+        self.reaper.close()
+        os.close(self.__wakeup_read)
+        os.close(self.__wakeup_write)
+
+    def __wakeup(self):
+        os.write(self.__wakeup_write, b"x")
+
+    def __listen(self):
+        while self.__running:
+            with self.__lock:
+                connections = dict(self.__connections)
+            try:
+                readable, _, _ = select.select(
+                        connections.keys() + [self.__wakeup_read], [], [])
+            except (select.error, socket.error, ValueError) as e:
+                # a connection was closed out from under us; it will have
+                # unregistered itself, so just try again
+                logging.info("Multiplexed select failed: %s", e)
+                continue
+            for fd in readable:
+                if fd == self.__wakeup_read:
+                    os.read(fd, 4096)
+                    continue
+                connection = connections[fd]
+                if not connection.read_available():
+                    logging.info("Connection closed by jvm")
+                    self.unregister(connection)
+
+
+# commands whose replies don't change for as long as their type is loaded
+# (and not redefined), by the request field naming the type
+REPLY_CACHE_IMMUTABLE_COMMANDS = {
+        "ReferenceType.Signature": "refType",
+        "ReferenceType.SignatureWithGeneric": "refType",
+        "ReferenceType.ClassLoader": "refType",
+        "ReferenceType.Modifiers": "refType",
+        "ReferenceType.Fields": "refType",
+        "ReferenceType.Methods": "refType",
+        "ReferenceType.FieldsWithGeneric": "refType",
+        "ReferenceType.MethodsWithGeneric": "refType",
+        "ReferenceType.SourceFile": "refType",
+        "ReferenceType.SourceDebugExtension": "refType",
+        "ReferenceType.Interfaces": "refType",
+        "ReferenceType.ClassObject": "refType",
+        "ReferenceType.ClassFileVersion": "refType",
+        "ReferenceType.ConstantPool": "refType",
+        "ClassType.Superclass": "clazz",
+        "Method.LineTable": "refType",
+        "Method.VariableTable": "refType",
+        "Method.VariableTableWithGeneric": "refType",
+        "Method.Bytecodes": "refType"}
+
+# commands whose replies don't change while their (suspended) thread stays
+# suspended, by the request field naming the thread
+REPLY_CACHE_SUSPENSION_COMMANDS = {
+        "ThreadReference.Frames": "thread",
+        "ThreadReference.FrameCount": "thread",
+        "ThreadReference.OwnedMonitors": "thread",
+        "ThreadReference.CurrentContendedMonitor": "thread",
+        "ThreadReference.OwnedMonitorsStackDepthInfo": "thread",
+        "StackFrame.GetValues": "thread",
+        "StackFrame.ThisObject": "thread"}
+
+# commands that let threads run or change their frames, by the request field
+# naming the thread, or None if they may affect every thread
+REPLY_CACHE_RESUMING_COMMANDS = {
+        "VirtualMachine.Resume": None,
+        "VirtualMachine.Dispose": None,
+        "VirtualMachine.RedefineClasses": None,
+        "ThreadReference.Resume": "thread",
+        "StackFrame.SetValues": "thread",
+        "StackFrame.PopFrames": "thread",
+        "ClassType.InvokeMethod": None,
+        "ClassType.NewInstance": None,
+        "InterfaceType.InvokeMethod": None,
+        "ObjectReference.InvokeMethod": None}
+
+
+class ReplyCache(object):
+    """Bounded LRU cache of command replies that can't have changed since they
+    were received, so asking again needn't cost a round trip (see Jdwp's
+    "reply_cache").
+
+    Replies to REPLY_CACHE_IMMUTABLE_COMMANDS (a type's methods, line tables,
+    ...) are kept until their type is unloaded (see invalidate_type, which
+    Pyjdb calls on CLASS_UNLOAD) or redefined. Replies to
+    REPLY_CACHE_SUSPENSION_COMMANDS (a suspended thread's frames and their
+    values) are kept until a REPLY_CACHE_RESUMING_COMMAND lets the thread run
+    again. Other commands, and errors, aren't cached. A reply is cached when
+    its CommandFuture's result is first read. Entries are keyed by the
+    encoded request, and the least recently used are evicted once there are
+    more than "max_entries" of them or their replies add up to more than
+    "max_bytes"."""
+
+    def __init__(self, max_entries=100000, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        # (command label, request payload) -> (scope, reply payload), least
+        # recently used first. A scope is ("type", refType) for immutable
+        # replies, and ("thread", thread) for suspension scoped ones.
+        self.__entries = collections.OrderedDict()
+        self.__keys_by_scope = {}
+        # bumped when a scope's entries are dropped, so a reply to a request
+        # sent before then isn't cached (see stamp)
+        self.__scope_epochs = {}
+        # the resume epoch: bumped when every thread's entries are dropped
+        self.__resume_epoch = 0
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def scope(self, command_label, data):
+        """Returns what a command's reply depends on, or None if it mustn't be
+        cached"""
+        if command_label in REPLY_CACHE_IMMUTABLE_COMMANDS:
+            return ("type", data[REPLY_CACHE_IMMUTABLE_COMMANDS[command_label]])
+        if command_label in REPLY_CACHE_SUSPENSION_COMMANDS:
+            return ("thread",
+                    data[REPLY_CACHE_SUSPENSION_COMMANDS[command_label]])
+        return None
+
+    def lookup(self, command_label, request_payload):
+        """Returns the cached reply payload for a request, or None"""
+        key = (command_label, bytes(request_payload))
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # most recently used now
+            self.__entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def stamp(self, scope):
+        """Returns a token to pass to store with the reply to a request sent
+        now, so it's only cached if "scope" isn't invalidated meanwhile"""
+        with self.__lock:
+            return (self.__scope_epochs.get(scope, 0),
+                    self.__resume_epoch if scope[0] == "thread" else 0)
+
+    def store(self, command_label, request_payload, scope, stamp,
+            reply_payload):
+        key = (command_label, bytes(request_payload))
+        size = len(key[1]) + len(reply_payload)
+        with self.__lock:
+            if (stamp != (self.__scope_epochs.get(scope, 0),
+                    self.__resume_epoch if scope[0] == "thread" else 0) or
+                    key in self.__entries or size > self.max_bytes):
+                return
+            self.__entries[key] = (scope, reply_payload)
+            if scope not in self.__keys_by_scope:
+                self.__keys_by_scope[scope] = set()
+            self.__keys_by_scope[scope].add(key)
+            self.__bytes += size
+            while (len(self.__entries) > self.max_entries or
+                    self.__bytes > self.max_bytes):
+                self.__drop(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def command_sent(self, command_label, data):
+        """Drops the entries a command is about to invalidate (see
+        REPLY_CACHE_RESUMING_COMMANDS)"""
+        if command_label not in REPLY_CACHE_RESUMING_COMMANDS:
+            return
+        if command_label == "VirtualMachine.RedefineClasses":
+            for class_def in data["classes"]:
+                self.invalidate_type(class_def["refType"])
+        field = REPLY_CACHE_RESUMING_COMMANDS[command_label]
+        if field is None:
+            self.invalidate_threads()
+        else:
+            self.invalidate_thread(data[field])
+
+    def invalidate_type(self, type_id):
+        """Drops the immutable replies about a type, e.g. as it's unloaded"""
+        self.__invalidate(("type", type_id))
+
+    def invalidate_thread(self, thread_id):
+        """Drops the suspension scoped replies about a thread"""
+        self.__invalidate(("thread", thread_id))
+
+    def invalidate_threads(self):
+        """Drops every thread's suspension scoped replies, starting a new
+        resume epoch"""
+        with self.__lock:
+            self.__resume_epoch += 1
+            for scope in [scope for scope in self.__keys_by_scope
+                    if scope[0] == "thread"]:
+                self.__drop_scope(scope)
+
+    def clear(self):
+        with self.__lock:
+            self.__resume_epoch += 1
+            for scope in list(self.__keys_by_scope):
+                self.__drop_scope(scope)
+
+    def stats(self):
+        """Returns a dict of the cache's size and hit statistics"""
+        with self.__lock:
+            return {
+                    "entries": len(self.__entries),
+                    "bytes": self.__bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hit_rate,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "resume_epoch": self.__resume_epoch}
+
+    def __invalidate(self, scope):
+        with self.__lock:
+            self.__drop_scope(scope)
+
+    def __drop_scope(self, scope):
+        # call holding the lock
+        self.__scope_epochs[scope] = self.__scope_epochs.get(scope, 0) + 1
+        for key in list(self.__keys_by_scope.get(scope, ())):
+            self.__drop(key)
+            self.invalidations += 1
+
+    def __drop(self, key):
+        # call holding the lock
+        scope, reply_payload = self.__entries.pop(key)
+        self.__bytes -= len(key[1]) + len(reply_payload)
+        keys = self.__keys_by_scope[scope]
+        keys.discard(key)
+        if not keys:
+            del self.__keys_by_scope[scope]
+
+
 class Jdwp(object):
-    def __init__(self, host="localhost", port=5005, timeout=10):
+    def __init__(self, host="localhost", port=5005, timeout=10,
+            multiplexer=None, compile_codecs=False, metrics_dump_interval=None,
+            reply_cache=None):
         logging.info("Create jdwp object for %s:%d", host, port)
         self.__timeout = timeout
+        self.__compile_codecs = compile_codecs
+        # a ReplyCache to answer repeated requests from, or None
+        self.reply_cache = reply_cache
+        # counters for the session's traffic (see JdwpMetrics), logged every
+        # metrics_dump_interval seconds if that's set
+        self.metrics = JdwpMetrics()
+        self.__metrics_dump_interval = metrics_dump_interval
+        # times the phases of initialize (and of anything else run in a
+        # profiler.phase), counting the requests sent and bytes moved
+        self.profiler = PhaseProfiler()
         self.__request_id_generator = RequestIdGenerator()
         self.__event_cbs = []
-        self.__conn = JdwpConnection(host, port, self.handle_packet)
-        self.__replies = {}
+        self.__event_batch_cbs = []
+        self.__conn = JdwpConnection(
+                host, port, self.handle_packet, multiplexer, self.metrics)
+        self.__replies = ReplyDispatcher(
+                timeout, multiplexer.reaper if multiplexer else None)
+        # events that arrive before we're initialized (e.g., vm_start) wait
+        # here; after that they go straight to self.__notifier
         self.__events = Queue.Queue()
-        # background thread for calling self.__event_cbs as new events come in.
-        # we use a separate thread for this so that JdwpConnection's
-        # __reader_thread need not block while we handle events.
-        self.__notifier_thread = threading.Thread(
-                target = self.__event_notify_loop, name = "jdwp_event_notifier")
-        self.__notifier_thread.setDaemon(True)
+        self.__events_lock = threading.Lock()
+        self.__initialized = False
+        # notifier for calling self.__event_cbs as new events come in. sessions
+        # sharing a multiplexer share its notifier.
+        if multiplexer is None:
+            self.__notifier = EventNotifier()
+        else:
+            self.__notifier = multiplexer.notifier
+        self.__owns_notifier = multiplexer is None
         logging.info("Jdwp object created")
 
     def register_event_callback(self, event_cb):
@@ -99,56 +1231,131 @@ class Jdwp(object):
         logging.info("Unregister event callback")
         self.__event_cbs.remove(event_cb)
 
+    def register_event_batch_callback(self, event_batch_cb):
+        """Registers "event_batch_cb([event, ...])" to be called with runs of
+        events as they're delivered, rather than one call per event"""
+        logging.info("Register event batch callback")
+        self.__event_batch_cbs.append(event_batch_cb)
+
+    def unregister_event_batch_callback(self, event_batch_cb):
+        logging.info("Unregister event batch callback")
+        self.__event_batch_cbs.remove(event_batch_cb)
+
+    @property
+    def event_stats(self):
+        """Queue depth and dispatch latency stats of the event notifier (which
+        is shared by all sessions on a multiplexer)"""
+        return self.__notifier.stats()
+
     def initialize(self):
-        logging.info("Unregister event callback")
+        # report on our own phases, unless we're part of a bigger initialize
+        # (e.g. Pyjdb's) that will report on them
+        standalone = not self.profiler.active
+        if standalone:
+            self.profiler.reset()
+        with self.profiler.phase("Jdwp.initialize"):
+            self.__initialize()
+        if standalone:
+            logging.info("Jdwp initialized:\n%s", self.profiler.report())
+
+    def __initialize(self):
         # As soon as we call this, events (e.g., vm_start) may be incoming.
-        self.__conn.initialize()
-        self.__await_vm_start()
-        version = self.__hardcoded_version_request()
-        id_sizes = self.__hardcoded_id_sizes_request()
-        self.jdwp_spec = JdwpSpec(version, id_sizes)
-        for command_set_name in self.jdwp_spec.command_sets:
-            command_set = self.jdwp_spec.command_sets[command_set_name]
-            setattr(self, command_set_name, GenericService(self, command_set))
-        for constant_set_name in self.jdwp_spec.constant_sets:
-            constant_set = self.jdwp_spec.constant_sets[constant_set_name]
-            setattr(self, constant_set_name, GenericConstantSet(constant_set))
-        self.__notifier_running = True
-        self.__notifier_thread.start()
+        with self.profiler.phase("connect"):
+            self.__conn.initialize()
+        with self.profiler.phase("await_vm_start"):
+            self.__await_vm_start()
+        with self.profiler.phase("version_and_id_sizes"):
+            version = self.__hardcoded_version_request()
+            id_sizes = self.__hardcoded_id_sizes_request()
+        with self.profiler.phase("load_spec"):
+            self.jdwp_spec = JdwpSpec(version, id_sizes, self.__compile_codecs)
+            for command_set_name in self.jdwp_spec.command_sets:
+                command_set = self.jdwp_spec.command_sets[command_set_name]
+                setattr(self, command_set_name,
+                        GenericService(self, command_set))
+            for constant_set_name in self.jdwp_spec.constant_sets:
+                constant_set = self.jdwp_spec.constant_sets[constant_set_name]
+                setattr(self, constant_set_name,
+                        GenericConstantSet(constant_set))
+        with self.__events_lock:
+            while not self.__events.empty():
+                _, event_payload = self.__events.get()
+                self.__notifier.put(self.__event_notify, event_payload)
+            self.__initialized = True
+        self.__notifier.start()
+        if self.__metrics_dump_interval:
+            self.metrics.start_periodic_dump(self.__metrics_dump_interval)
 
     def command_request(self, command_set_name, command_name, data):
+        return self.command_request_async(
+                command_set_name, command_name, data).result()
+
+    def command_request_async(self, command_set_name, command_name, data):
+        """Sends a command request without waiting for its reply; returns a
+        CommandFuture. Any number of requests may be in flight at once, so
+        callers can issue many requests and then collect the replies (see
+        pyjdwp.gather) rather than paying a round trip for each one."""
         command = self.jdwp_spec.lookup_command(command_set_name, command_name)
         req_id = self.__request_id_generator.next_id
         command_set_id = command.command_set_id
         command_id = command.id
+        start_time = time.time()
         payload = command.encode(data)
-        self.__conn.send(req_id, command_set_id, command_id, payload)
-        reply_payload = self.__await_reply(req_id)
-        return command.decode(reply_payload)
+        encode_seconds = time.time() - start_time
+        reply_cache = self.reply_cache
+        scope = None
+        if reply_cache is not None:
+            reply_cache.command_sent(command.label, data)
+            scope = reply_cache.scope(command.label, data)
+        if scope is not None:
+            reply_payload = reply_cache.lookup(command.label, payload)
+            if reply_payload is not None:
+                pending = PendingReply(req_id)
+                pending.set_reply(0, reply_payload)
+                return CommandFuture(self.__replies, command, pending,
+                        self.metrics)
+            stamp = reply_cache.stamp(scope)
+        pending = self.__send_request(req_id, command_set_id, command_id,
+                payload, command.label, encode_seconds)
+        on_payload = None
+        if scope is not None:
+            # cached as it's read, so whoever asked can't ask again first
+            on_payload = lambda reply_payload: reply_cache.store(
+                    command.label, payload, scope, stamp, reply_payload)
+        return CommandFuture(self.__replies, command, pending, self.metrics,
+                on_payload)
 
     def disconnect(self):
-        self.__notifier_running = False;
+        self.metrics.stop_periodic_dump()
         self.__conn.disconnect()
+        # fail outstanding requests first so that an event callback blocked on
+        # a reply can't hold up stopping the notifier
+        self.__replies.close()
+        if self.__owns_notifier:
+            self.__notifier.stop()
 
     def handle_packet(self, req_id, flags, err, payload):
         if err == 0x4064:
-            self.__events.put((req_id, payload))
+            with self.__events_lock:
+                if self.__initialized:
+                    self.__notifier.put(self.__event_notify, payload)
+                else:
+                    self.__events.put((req_id, payload))
             return
-        if req_id in self.__replies:
-            raise Error("More than one reply packet for req_id %d" % req_id)
-        self.__replies[req_id] = (err, payload)
-
-    def __event_notify_loop(self):
-        while True:
-            if not self.__notifier_running:
-                return
-            if not self.__events.empty():
-                self.__event_notify()
+        if not self.__replies.dispatch(req_id, err, payload):
+            # timed out, cancelled, or a duplicate; nobody is listening
+            logging.warning("Dropping unexpected reply for req_id %d", req_id)
 
-    def __event_notify(self):
-        while not self.__events.empty():
-            jvm_req_id, event_payload = self.__events.get()
-            event = self.__decode_event(event_payload)
+    def __event_notify(self, event_payloads):
+        start_time = time.time()
+        events = [self.__decode_event(payload) for payload in event_payloads]
+        self.metrics.record_decode("Event.Composite", time.time() - start_time)
+        for event in events:
+            for event_entry in event["events"]:
+                self.metrics.record_event(event_entry["eventKind"])
+        for event_batch_cb in self.__event_batch_cbs:
+            event_batch_cb(events)
+        for event in events:
             for event_cb in self.__event_cbs:
                 event_cb(event)
 
@@ -156,18 +1363,40 @@ class Jdwp(object):
         command = self.jdwp_spec.lookup_command("Event", "Composite")
         return command.decode(event_payload)
 
-    def __await_reply(self, req_id):
+    def __send_request(self, req_id, cmd_set_id, cmd_id, payload=None,
+            command_name=None, encode_seconds=0.0):
+        """Sends a request and returns the PendingReply for it"""
+        if command_name is None:
+            command_name = "%d.%d" % (cmd_set_id, cmd_id)
+        num_bytes = JDWP_PACKET_HEADER_LENGTH + len(payload or "")
+        # register before sending so a fast reply can't beat us to it
+        pending = self.__replies.register(req_id)
+        self.metrics.record_request(command_name, num_bytes, encode_seconds)
+        sent_time = time.time()
+        profiler_token = self.profiler.request_sent(command_name, num_bytes)
+        def on_done(pending):
+            if pending.error_code is None:
+                self.metrics.record_no_reply(command_name,
+                        isinstance(pending.exception, Timeout))
+                return
+            reply_bytes = JDWP_PACKET_HEADER_LENGTH + pending.reply_size
+            self.metrics.record_reply(command_name, time.time() - sent_time,
+                    reply_bytes, pending.error_code)
+            self.profiler.reply_received(profiler_token, reply_bytes)
+        pending.add_done_callback(on_done)
+        try:
+            self.__conn.send(req_id, cmd_set_id, cmd_id, payload)
+        except:
+            self.__replies.cancel(req_id)
+            raise
+        return pending
+
+    def __send_and_await_reply(self, req_id, cmd_set_id, cmd_id, payload=None,
+            command_name=None):
         """Blocks until a reply is received for "req_id"; raises pyjdwp.Error
         if err != 0, returns reply otherwise"""
-        start_time = time.time()
-        while req_id not in self.__replies:
-            if time.time() >= start_time + self.__timeout:
-                raise Timeout("Timed out")
-        err, reply = self.__replies[req_id]
-        del self.__replies[req_id]
-        if err != 0:
-            raise Error("JDWP error: %s" % err)
-        return reply
+        return self.__send_request(
+                req_id, cmd_set_id, cmd_id, payload, command_name).wait()
 
     def __await_vm_start(self):
         found_event = False
@@ -182,8 +1411,8 @@ class Jdwp(object):
 
     def __hardcoded_version_request(self):
         req_id = self.__request_id_generator.next_id
-        self.__conn.send(req_id, 1, 1)
-        version_data = self.__await_reply(req_id)
+        version_data = self.__send_and_await_reply(
+                req_id, 1, 1, command_name="VirtualMachine.Version")
         desc_len = 4 + struct.unpack(">I", version_data[0:4])[0]
         minor_version = struct.unpack(
                 ">I", version_data[desc_len + 4: desc_len + 8])[0]
@@ -191,8 +1420,8 @@ class Jdwp(object):
 
     def __hardcoded_id_sizes_request(self):
         req_id = self.__request_id_generator.next_id
-        self.__conn.send(req_id, 1, 7)
-        id_size_data = self.__await_reply(req_id);
+        id_size_data = self.__send_and_await_reply(
+                req_id, 1, 7, command_name="VirtualMachine.IDSizes")
         id_size_names = [
                 "fieldIDSize",
                 "methodIDSize",
@@ -204,7 +1433,8 @@ class Jdwp(object):
 
 
 class JdwpConnection(object):
-    def __init__(self, host, port, packet_callback=None):
+    def __init__(self, host, port, packet_callback=None, multiplexer=None,
+            metrics=None):
         # the host:port our target jvm is listening on for jdwp connections
         self.__host = host
         self.__port = port
@@ -216,13 +1446,19 @@ class JdwpConnection(object):
         # a response to a previous request). this should return quickly, as it
         # blocks self.__reader_thread
         self.__packet_callback = packet_callback
+        # JdwpMetrics to count packets and bytes in, if any
+        self.__metrics = metrics
         # lock for synchronizing requests (only one at a time outgoing to jvm)
         self.__request_lock = threading.Lock()
-        # background thread for receiving packets from jvm. runs as long as
-        # self.__listening == True
-        self.__reader_thread = threading.Thread(
-                target = self.__listen, name = "jdwp_listener")
-        self.__reader_thread.setDaemon(True)
+        # background thread for receiving packets from jvm, unless a
+        # multiplexer does that for us. runs as long as self.__listening == True
+        self.__multiplexer = multiplexer
+        self.__reader_thread = None
+        if multiplexer is None:
+            self.__reader_thread = threading.Thread(
+                    target = self.__listen, name = "jdwp_listener")
+            self.__reader_thread.setDaemon(True)
+        self.__reader = PacketReader(self.__socket)
 
     def initialize(self):
         logging.info("Initializing socket connection to jdwp host")
@@ -242,17 +1478,46 @@ class JdwpConnection(object):
         # jdwp handshake
         handshake = b"JDWP-Handshake"
         logging.info("Sending handshake")
-        self.__socket.send(handshake)
+        self.__socket.sendall(handshake)
         logging.info("Awaiting handshake")
-        data = self.__socket.recv(len(handshake))
+        data = b""
+        try:
+            while len(data) < len(handshake):
+                chunk = self.__socket.recv(len(handshake) - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except socket.error as e:
+            logging.error("Handshake failed: %s", e)
         if data != handshake:
             logging.error("Handshake failed; got something else.")
             self.__socket.close()
             raise Error("Handshake failed")
         # start listening for jdwp packets
         self.__listening = True
-        logging.info("Starting reader thread")
-        self.__reader_thread.start()
+        if self.__multiplexer is not None:
+            logging.info("Registering with multiplexer")
+            self.__multiplexer.register(self)
+        else:
+            logging.info("Starting reader thread")
+            self.__reader_thread.start()
+
+    def fileno(self):
+        return self.__socket.fileno()
+
+    def read_available(self):
+        """Reads whatever data is available without blocking and passes any
+        complete packets to the packet callback. Called by JdwpMultiplexer when
+        our socket is readable; returns False once the connection is closed."""
+        try:
+            packets = self.__reader.read()
+        except socket.timeout:
+            return True
+        except (socket.error, EOFError, Error) as e:
+            logging.info("Read failed: %s", e)
+            return False
+        self.__deliver(packets)
+        return True
 
     def send(self, req_id, cmd_set_id, cmd_id, payload=None):
         if payload is None:
@@ -260,52 +1525,315 @@ class JdwpConnection(object):
         length = JDWP_PACKET_HEADER_LENGTH + len(payload)
         header = struct.pack(">IIBBB", length, req_id, 0, cmd_set_id, cmd_id)
         with self.__request_lock:
-            self.__socket.send(header + payload)
+            self.__socket.sendall(header + payload)
+        if self.__metrics is not None:
+            self.__metrics.record_packet_sent(length)
 
     def disconnect(self):
-        self.__socket.close();
+        if self.__multiplexer is not None:
+            self.__multiplexer.unregister(self)
         self.__listening = False
-        self.__reader_thread.join(1.0)
+        # shutting the socket down (unlike closing it) wakes up the reader
+        # thread if it's blocked reading, so we needn't wait out its timeout
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        if self.__reader_thread is not None:
+            self.__reader_thread.join(1.0)
+        self.__socket.close()
 
     def __listen(self):
         while True:
             if not self.__listening:
                 return
             try:
-                header = self.__socket.recv(JDWP_PACKET_HEADER_LENGTH);
-            except socket.error as e:
-                continue
-            if len(header) != JDWP_PACKET_HEADER_LENGTH:
+                packets = self.__reader.read()
+            except socket.timeout:
                 continue
-            length, req_id, flags, err = struct.unpack(">IIBH", header)
-            remaining = length - JDWP_PACKET_HEADER_LENGTH
-            msg = bytearray()
-            while remaining > 0:
-                chunk = self.__socket.recv(min(remaining, 4096))
-                msg.extend(chunk)
-                remaining -= len(chunk)
-            # TODO(cgs): why do we need to do this string voodoo?
-            payload = "".join([chr(x) for x in msg])
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if self.__listening:
+                    logging.info("Read failed: %s", e)
+                return
+            except (EOFError, Error) as e:
+                logging.info("Read failed: %s", e)
+                return
+            self.__deliver(packets)
+
+    def __deliver(self, packets):
+        if self.__metrics is not None:
+            self.__metrics.record_packets_received(packets)
+        for req_id, flags, err, payload in packets:
             self.__packet_callback(req_id, flags, err, payload)
 
 
+class PacketReader(object):
+    """Frames jdwp packets out of a socket's byte stream.
+
+    Data is read with recv_into into a reusable buffer, so a single read can
+    pick up many small packets (or a partial one, which is completed by later
+    reads). Each payload is copied out of the buffer in one go and handed out
+    as a memoryview. Packets too big for the buffer are received straight into
+    a buffer of their own instead.
+    """
+
+    def __init__(self, sock, buffer_size=65536):
+        self.__socket = sock
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        # self.__buffer[self.__start : self.__end] is data read but not yet
+        # framed into packets
+        self.__start = 0
+        self.__end = 0
+        # header and body of a packet too big for self.__buffer, if we're in
+        # the middle of reading one
+        self.__large_header = None
+        self.__large_body = None
+        self.__large_filled = 0
+
+    def read(self):
+        """Does one read from the socket (blocking up to the socket's timeout)
+        and returns (req_id, flags, err, payload) for each packet that read
+        completed. Raises EOFError if the connection has been closed."""
+        if self.__large_body is not None:
+            return self.__read_large()
+        if self.__start == self.__end:
+            self.__start = self.__end = 0
+        elif self.__end == len(self.__buffer):
+            # out of room; move the unframed data to the front
+            remaining = self.__buffer[self.__start : self.__end]
+            self.__end -= self.__start
+            self.__start = 0
+            self.__buffer[0 : self.__end] = remaining
+        received = self.__socket.recv_into(self.__view[self.__end : ])
+        if received == 0:
+            raise EOFError("Connection closed")
+        self.__end += received
+        return self.__frame()
+
+    def __frame(self):
+        packets = []
+        while self.__end - self.__start >= JDWP_PACKET_HEADER_LENGTH:
+            header = JDWP_PACKET_HEADER.unpack_from(self.__buffer, self.__start)
+            length = header[0]
+            if length < JDWP_PACKET_HEADER_LENGTH:
+                raise Error("Bad jdwp packet length: %d" % length)
+            available = self.__end - self.__start
+            if length > len(self.__buffer):
+                self.__start_large(header, available)
+                break
+            if available < length:
+                break
+            body_start = self.__start + JDWP_PACKET_HEADER_LENGTH
+            payload = bytearray(self.__view[body_start : self.__start + length])
+            packets.append(header[1 : ] + (memoryview(payload),))
+            self.__start += length
+        return packets
+
+    def __start_large(self, header, available):
+        body_start = self.__start + JDWP_PACKET_HEADER_LENGTH
+        self.__large_header = header
+        self.__large_body = bytearray(header[0] - JDWP_PACKET_HEADER_LENGTH)
+        self.__large_filled = available - JDWP_PACKET_HEADER_LENGTH
+        self.__large_body[0 : self.__large_filled] = \
+                self.__view[body_start : self.__end]
+        self.__start = self.__end = 0
+
+    def __read_large(self):
+        view = memoryview(self.__large_body)
+        received = self.__socket.recv_into(view[self.__large_filled : ])
+        if received == 0:
+            raise EOFError("Connection closed")
+        self.__large_filled += received
+        if self.__large_filled < len(self.__large_body):
+            return []
+        packet = self.__large_header[1 : ] + (view,)
+        self.__large_header = None
+        self.__large_body = None
+        return [packet]
+
+
+# the spec's quoted strings are documentation, which we drop. quoted strings
+# may not span lines; a lone double quote is just part of an atom.
+SPEC_QUOTED_STRING = re.compile(
+        r'"(?:[^"\n\r\\]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*"')
+SPEC_ATOM = re.compile(r"[^()\s]+")
+SPEC_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def parse_spec_text(jdwp_text):
+    """Parses the text of a jdwp spec file into nested lists of strings.
+
+    The spec files are s-expressions whose atoms are names and Name=value
+    pairs (with optional whitespace around the "="), interspersed with quoted
+    doc strings and preceded by a C-style comment header. Doc strings and
+    comments are dropped. Raises pyjdwp.Error on malformed input.
+    """
+    text = re.sub("\s*=\s*", "=", jdwp_text)
+    # stack[-1] is the list we're currently adding to; stack[0] is the spec
+    stack = [[]]
+    pos = 0
+    while True:
+        pos = SPEC_WHITESPACE.match(text, pos).end()
+        if pos >= len(text):
+            break
+        char = text[pos]
+        if char == "(":
+            stack.append([])
+            pos += 1
+        elif char == ")":
+            if len(stack) == 1:
+                raise Error("Unbalanced ')' in spec at offset %d" % pos)
+            entry = stack.pop()
+            stack[-1].append(entry)
+            pos += 1
+        elif text.startswith("/*", pos):
+            end = text.find("*/", pos + 2)
+            if end < 0:
+                raise Error("Unterminated comment in spec at offset %d" % pos)
+            pos = end + 2
+        else:
+            if char == '"':
+                match = SPEC_QUOTED_STRING.match(text, pos)
+                if match:
+                    pos = match.end()
+                    continue
+            match = SPEC_ATOM.match(text, pos)
+            if not match:
+                raise Error("Unexpected %r in spec at offset %d" % (char, pos))
+            stack[-1].append(match.group())
+            pos = match.end()
+    if len(stack) != 1:
+        raise Error("Unterminated list in spec")
+    return stack[0]
+
+
+def pyparsing_spec_grammar():
+    """Returns the pyparsing grammar spec files used to be parsed with. Only
+    kept to check parse_spec_text against; needs pyparsing."""
+    import pyparsing
+    open_paren = pyparsing.Literal("(").suppress()
+    close_paren = pyparsing.Literal(")").suppress()
+    quoted_string = pyparsing.dblQuotedString.suppress()
+    spec_string = pyparsing.OneOrMore(quoted_string)
+    s_exp = pyparsing.Forward()
+    string = spec_string | pyparsing.Regex("([^()\s])+")
+    s_exp_list = pyparsing.Group(
+            open_paren + pyparsing.ZeroOrMore(s_exp) + close_paren)
+    s_exp << (string | s_exp_list)
+    return pyparsing.OneOrMore(s_exp)
+
+
+class SpecCache(object):
+    """On-disk cache of parsed spec files, so we only pay for parsing a spec
+    once rather than on every attach.
+
+    Each spec file gets one cache file, holding the parsed spec (marshalled)
+    behind a header line with the cache format, the pyjdwp version and sha1
+    checksums of both the spec text and the marshalled data. A cache file is
+    only used if all of those match; otherwise the spec is parsed again and
+    the cache file rewritten.
+    """
+
+    FORMAT = 2
+    MAGIC = "pyjdwp-spec-cache"
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("PYJDWP_CACHE_DIR",
+                    os.path.join(os.path.expanduser("~"), ".cache", "pyjdwp"))
+        self.cache_dir = cache_dir
+
+    def load(self, spec_name, jdwp_text):
+        """Returns the parsed spec for "jdwp_text", from the cache if we can"""
+        spec_hash = hashlib.sha1(jdwp_text).hexdigest()
+        cache_path = self.__cache_path(spec_name)
+        spec = self.__read(cache_path, spec_hash)
+        if spec is None:
+            logging.info("Parsing spec %s", spec_name)
+            spec = parse_spec_text(jdwp_text)
+            self.__write(cache_path, spec_hash, spec)
+        return spec
+
+    def __cache_path(self, spec_name):
+        return os.path.join(self.cache_dir, "%s.cache" % os.path.basename(spec_name))
+
+    def __header(self, spec_hash, data_hash):
+        return "%s %d %s %s %s\n" % (
+                self.MAGIC, self.FORMAT, VERSION, spec_hash, data_hash)
+
+    def __read(self, cache_path, spec_hash):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                header = cache_file.readline()
+                data = cache_file.read()
+        except IOError:
+            return None
+        if header != self.__header(spec_hash, hashlib.sha1(data).hexdigest()):
+            logging.info("Spec cache %s is stale", cache_path)
+            return None
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as e:
+            logging.warning("Corrupt spec cache %s: %s", cache_path, e)
+            return None
+
+    def __write(self, cache_path, spec_hash, spec):
+        data = marshal.dumps(spec)
+        header = self.__header(spec_hash, hashlib.sha1(data).hexdigest())
+        temp_path = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to a temp file and rename, so readers never see a partial
+            # cache file
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as cache_file:
+                cache_file.write(header)
+                cache_file.write(data)
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError) as e:
+            logging.warning("Couldn't write spec cache %s: %s", cache_path, e)
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+
 class JdwpSpec(object):
-    def __init__(self, version, id_sizes):
+    def __init__(self, version, id_sizes, compile_codecs=False, spec_cache=None):
         spec_file_name = "specs/jdwp.spec_openjdk_%d" % version
-        jdwp_text = pkg_resources.resource_string(__name__, spec_file_name)
-        self.__clean_spec_text = re.sub("\s*=\s*", "=", jdwp_text)
-        self.__spec = GRAMMAR_JDWP_SPEC.parseString(self.__clean_spec_text)
+        with open(os.path.join(
+                os.path.dirname(__file__), spec_file_name), "rb") as spec_file:
+            jdwp_text = spec_file.read()
+        if spec_cache is None:
+            spec_cache = SpecCache()
+        self.__spec = spec_cache.load(spec_file_name, jdwp_text)
         self.id_sizes = id_sizes
-        self.command_sets = {}
+        # when set, commands encode and decode with compiled codecs (see
+        # CodecCompiler) rather than by walking their args
+        self.codec_compiler = None
         self.constant_sets = {}
         for entry in self.__spec:
             if entry[0] == "ConstantSet":
                 constant_set = ConstantSet(entry)
                 self.constant_sets[constant_set.name] = constant_set
+        if compile_codecs:
+            self.codec_compiler = CodecCompiler(self)
+        # command sets (and their commands) are only built when first looked
+        # up; most sessions only use a handful of commands
+        command_set_entries = {}
+        self.__command_set_names_by_id = {}
         for entry in self.__spec:
             if entry[0] == "CommandSet":
-                command_set = CommandSet(self, entry)
-                self.command_sets[command_set.name] = command_set
+                name, command_set_id = entry[1].split("=")
+                command_set_entries[name] = entry
+                self.__command_set_names_by_id[int(command_set_id)] = name
+        self.command_sets = LazyMapping(command_set_entries,
+                lambda entry: CommandSet(self, entry))
 
     def lookup_command(self, command_set_name, command_name):
         if command_set_name not in self.command_sets:
@@ -316,6 +1844,16 @@ class JdwpSpec(object):
                     command_set_name, command_name))
         return command_set.commands[command_name]
 
+    def lookup_command_by_id(self, command_set_id, command_id):
+        if command_set_id not in self.__command_set_names_by_id:
+            raise Error("Unknown command set id: %d" % command_set_id)
+        command_set = self.command_sets[
+                self.__command_set_names_by_id[command_set_id]]
+        if command_id not in command_set.command_names_by_id:
+            raise Error("Unknown command id: %d.%d" % (
+                    command_set_id, command_id))
+        return command_set.commands[command_set.command_names_by_id[command_id]]
+
     def lookup_constant(self, constant_set_name, constant_name):
         if constant_set_name not in self.constant_sets:
             raise Error("Unknown constant set: %s" % constant_set_name)
@@ -384,7 +1922,8 @@ class JdwpSpec(object):
         }
         return lookup_fn_by_type_tag[type_tag](self.id_sizes)
 
-    def decode_value_bytes_for_type_tag(self, type_tag, value_bytes, count=1):
+    def decode_value_bytes_for_type_tag(self, type_tag, value_bytes, count=1,
+            offset=0):
         void_tag = self.lookup_constant("Tag", "VOID").value
         if type_tag == void_tag or value_bytes is None:
             return (None,)
@@ -392,13 +1931,12 @@ class JdwpSpec(object):
         struct_fmt = STRUCT_FMT_BY_TYPE_TAG[type_tag]
         if struct_fmt == "?":
             struct_fmt = "B%s" % STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len]
-            value_len += 1
             unpack_fmt = ">%s" % (struct_fmt * count)
-            result = struct.unpack(unpack_fmt, value_bytes[0 : count * value_len])
+            result = struct.unpack_from(unpack_fmt, value_bytes, offset)
             result = zip(result[::2], result[1::2])
         else:
             unpack_fmt = ">%s" % (struct_fmt * count)
-            result = struct.unpack(unpack_fmt, value_bytes[0 : count * value_len])
+            result = struct.unpack_from(unpack_fmt, value_bytes, offset)
         return result
 
     def encode_value_bytes_for_type_tag(self, type_tag, value):
@@ -409,7 +1947,7 @@ class JdwpSpec(object):
             '[': lambda val: struct.pack(
                     ">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len], val),
             'B': lambda val: struct.pack(">B", val),
-            'C': lambda val: chr(struct.pack(">H", val)),  # H = 2 byte ushort
+            'C': lambda val: struct.pack(">H", val),  # H = 2 byte ushort
             'L': lambda val: struct.pack(
                     ">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len], val),
             'F': lambda val: struct.pack(">f", val),
@@ -418,7 +1956,7 @@ class JdwpSpec(object):
             'J': lambda val: struct.pack(">q", val),
             'S': lambda val: struct.pack(">h", val),
             'V': lambda val: None,
-            'Z': lambda val: (struct.pack(">B", val) != 0),
+            'Z': lambda val: struct.pack(">B", int(val)),
             's': lambda val: struct.pack(
                     ">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len], val),
             't': lambda val: struct.pack(
@@ -461,18 +1999,25 @@ class CommandSet(object):
         self.spec = spec
         [self.name, self.id] = command_set[1].split("=")
         self.id = int(self.id)
-        self.commands = {}
+        # commands are only built when first looked up
+        command_entries = {}
+        self.command_names_by_id = {}
         for command_entry in command_set[2 : ]:
-            command = Command(spec, self.id, command_entry)
-            self.commands[command.name] = command
+            name, command_id = command_entry[1].split("=")
+            command_entries[name] = command_entry
+            self.command_names_by_id[int(command_id)] = name
+        self.commands = LazyMapping(command_entries,
+                lambda command_entry: Command(
+                        spec, self.id, command_entry, self.name))
 
 
 class Command(object):
-    def __init__(self, spec, command_set_id, command):
+    def __init__(self, spec, command_set_id, command, command_set_name=None):
         self.spec = spec
         self.command_set_id = command_set_id
         [self.name, self.id] = command[1].split("=")
         self.id = int(self.id)
+        self.label = "%s.%s" % (command_set_name, self.name)
         if command[2][0] == "Event":
             self.request = Request(spec, [])
             self.response = Response(spec, command[2])
@@ -481,13 +2026,30 @@ class Command(object):
             self.request = Request(spec, command[2])
             self.response = Response(spec, command[3])
             self.errors = [ ErrorRef(spec, error) for error in command[4] ]
+        self.compiled_encode = None
+        self.compiled_decode = None
+        if spec.codec_compiler is not None:
+            self.compiled_encode, self.compiled_decode = \
+                    spec.codec_compiler.compile_command(self)
 
     def encode(self, data):
+        if self.compiled_encode is not None:
+            return self.compiled_encode(data)
         return self.request.encode(data)
 
     def decode(self, data):
+        if self.compiled_decode is not None:
+            return self.compiled_decode(data)
         return self.response.decode(data)
 
+    # the jvm's side of the conversation, for stand-ins like pyjdwp_fake
+
+    def decode_request(self, data):
+        return self.request.decode(data)
+
+    def encode_reply(self, data):
+        return self.response.encode(data)
+
 
 def create_arg_from_spec(spec, arg):
     arg_type = arg[0]
@@ -518,39 +2080,55 @@ class Request(object):
             data, result = arg.encode(data, result)
         return result
 
+    def decode(self, data):
+        result = {}
+        offset = 0
+        for arg in self.args:
+            offset, result = arg.decode(data, offset, result)
+        return result
+
 
 class Response(object):
     def __init__(self, spec, response):
         self.spec = spec
         self.args = [ create_arg_from_spec(spec, arg) for arg in response[1 : ] ]
 
+    def encode(self, data):
+        result = bytearray()
+        for arg in self.args:
+            data, result = arg.encode(data, result)
+        return result
+
     def decode(self, data):
         result = {}
+        offset = 0
         for arg in self.args:
-            data, result = arg.decode(data, result)
+            offset, result = arg.decode(data, offset, result)
         return result
 
+# Decoders all take the whole reply payload and the offset into it at which to
+# start decoding, and return the offset just past what they decoded along with
+# the accumulated result. The payload is never sliced, so decoding is linear in
+# its size.
+
 class String(object):
     def __init__(self, spec, string):
         self.spec = spec
         self.name = string[1]
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
-        strlen = struct.unpack(">I", data[0 : 4])[0]
+        strlen = struct.unpack_from(">I", data, offset)[0]
         fmt = str(strlen) + "s"
-        subdata = data[4 : 4 + strlen]
-        string_value = struct.unpack(fmt, subdata)[0].decode("UTF-8")
+        string_value = struct.unpack_from(fmt, data, offset + 4)[0].decode("UTF-8")
         accum[self.name] = string_value
-        return data[4+strlen:], accum
+        return offset + 4 + strlen, accum
 
     def encode(self, data, accum):
-        value = data[self.name]
-        strlen = len(value)
-        fmt = str(strlen) + "s"
+        value = bytearray(data[self.name], "UTF-8")
         accum += struct.pack(">I", len(value))
-        accum += bytearray(value, "UTF-8")
+        accum += value
         return data, accum
 
 
@@ -559,25 +2137,27 @@ class Value(object):
         self.spec = spec
         self.name = value[1]
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
+        if accum is None:
+            accum = {}
         # first byte is the tag type
-        type_tag = data[0]
+        type_tag = data[offset]
         value_len = self.spec.lookup_value_size_by_type_tag(type_tag)
         void_tag = self.spec.lookup_constant("Tag", "VOID").value
         if type_tag == void_tag:
             accum[self.name] = {
                     "typeTag": void_tag,
                     "value": None}
-            return data[1 : ], accum
+            return offset + 1, accum
         struct_fmt = STRUCT_FMT_BY_TYPE_TAG[type_tag]
         if struct_fmt == "?":
             struct_fmt = STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len]
         unpack_fmt = ">%s" % struct_fmt
-        value = struct.unpack(unpack_fmt, data[1 : 1 + value_len])[0]
+        value = struct.unpack_from(unpack_fmt, data, offset + 1)[0]
         accum[self.name] = {
                 "typeTag": type_tag,
                 "value": value}
-        return data[1 + value_len : ], accum
+        return offset + 1 + value_len, accum
 
     def encode(self, data, accum):
         value = data[self.name]
@@ -603,18 +2183,26 @@ class TaggedObject(object):
         self.spec = spec
         self.name = tagged_object[1]
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
-        type_tag = data[0]
+        type_tag = data[offset]
         object_id_size = self.spec.id_sizes["objectIDSize"]
-        object_id = struct.unpack(
+        object_id = struct.unpack_from(
                 ">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[object_id_size],
-                data[1 : 1 + object_id_size])[0],
+                data, offset + 1)[0]
         accum[self.name] = {
                 "typeTag": type_tag,
-                "objectID": object_id[0]}
-        return data[1 + object_id_size : ], accum
+                "objectID": object_id}
+        return offset + 1 + object_id_size, accum
+
+    def encode(self, data, accum):
+        value = data[self.name]
+        object_id_size = self.spec.id_sizes["objectIDSize"]
+        accum += bytearray(value["typeTag"])
+        accum += struct.pack(">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[object_id_size],
+                value["objectID"])
+        return data, accum
 
 
 class TypedSequence(object):
@@ -622,20 +2210,33 @@ class TypedSequence(object):
         self.spec = spec
         self.name = typed_sequence[1]
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
-        type_tag = data[0]
-        entry_count = struct.unpack(">I", data[1:5])[0]
+        type_tag = data[offset]
+        entry_count = struct.unpack_from(">I", data, offset + 1)[0]
         value_len = self.spec.lookup_value_size_by_type_tag(type_tag)
         if STRUCT_FMT_BY_TYPE_TAG[type_tag] == "?":
             value_len += 1
         value = self.spec.decode_value_bytes_for_type_tag(
                 type_tag,
-                data[5 : ],
-                count=entry_count)
+                data,
+                count=entry_count,
+                offset=offset + 5)
         accum[self.name] = value
-        return data[5 + entry_count * value_len : ], accum
+        return offset + 5 + entry_count * value_len, accum
+
+    def encode(self, data, accum):
+        type_tag, values = data[self.name]
+        accum += bytearray(type_tag)
+        accum += struct.pack(">I", len(values))
+        for value in values:
+            if STRUCT_FMT_BY_TYPE_TAG[type_tag] == "?":
+                # object values are tagged individually
+                value_tag, value = value
+                accum += bytearray(value_tag)
+            accum += self.spec.encode_value_bytes_for_type_tag(type_tag, value)
+        return data, accum
 
 
 class Primitive(object):
@@ -644,16 +2245,16 @@ class Primitive(object):
         self.type = simple[0]
         self.name = simple[1]
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
         if self.type == "binary":
-            accum[self.name] = (struct.unpack(">B", data[0])[0] != 0)
-            return data[1 : ], accum
+            accum[self.name] = (struct.unpack_from(">B", data, offset)[0] != 0)
+            return offset + 1, accum
         size = self.spec.lookup_id_size(self.type)
         fmt = ">" + STRUCT_FMTS_BY_SIZE_UNSIGNED[size]
-        accum[self.name] = struct.unpack(fmt, data[0 : size])[0]
-        return data[size:], accum
+        accum[self.name] = struct.unpack_from(fmt, data, offset)[0]
+        return offset + size, accum
 
     def encode(self, data, accum):
         value = data[self.name]
@@ -682,16 +2283,16 @@ class Repeat(object):
             _, accum = self.arg.encode(value, accum)
         return data, accum
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
-        count = struct.unpack(">I", data[0 : 4])[0]
+        count = struct.unpack_from(">I", data, offset)[0]
         accum[self.name] = []
-        data = data[4 : ]
+        offset += 4
         for i in range(count):
-            data, subaccum = self.arg.decode(data, {})
+            offset, subaccum = self.arg.decode(data, offset, {})
             accum[self.name].append(subaccum)
-        return data, accum
+        return offset, accum
 
 
 class Group(object):
@@ -705,12 +2306,12 @@ class Group(object):
             _, accum = arg.encode(data, accum)
         return data, accum
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
         for arg in self.args:
-            data, accum = arg.decode(data, accum)
-        return data, accum
+            offset, accum = arg.decode(data, offset, accum)
+        return offset, accum
 
 
 class Location(Group):
@@ -740,14 +2341,14 @@ class Select(object):
         _, accum = alt.encode(data, accum)
         return data, accum
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
         # pop the choice byte off the top
-        data, result = self.choice_arg.decode(data)
+        offset, result = self.choice_arg.decode(data, offset)
         choice = result[self.choice_arg.name]
         alt = self.alts[choice]
-        return alt.decode(data, result)
+        return alt.decode(data, offset, result)
 
 
 class Alt(object):
@@ -765,20 +2366,23 @@ class Alt(object):
             self.args.append(create_arg_from_spec(spec, arg_spec))
 
     def encode(self, data, accum):
+        # decode nests an alternative's values under its name; encoding takes
+        # them either that way or inline
+        alt_data = data.get(self.name, data)
         result = bytearray()
         for arg in self.args:
-            data, result = arg.encode(data, result)
+            alt_data, result = arg.encode(alt_data, result)
         accum += result
         return data, accum
 
-    def decode(self, data, accum=None):
+    def decode(self, data, offset=0, accum=None):
         if accum is None:
             accum = {}
         result = {}
         for arg in self.args:
-            data, result = arg.decode(data, result)
+            offset, result = arg.decode(data, offset, result)
         accum[self.name] = result
-        return data, accum
+        return offset, accum
 
 
 class ErrorRef(object):
@@ -787,17 +2391,294 @@ class ErrorRef(object):
     self.name = error[1]
 
 
-SPEC_GRAMMAR_OPEN_PAREN = pyparsing.Literal("(").suppress()
-SPEC_GRAMMAR_CLOSE_PAREN = pyparsing.Literal(")").suppress()
-SPEC_GRAMMAR_QUOTED_STRING = pyparsing.dblQuotedString
-SPEC_GRAMMAR_QUOTED_STRING = SPEC_GRAMMAR_QUOTED_STRING.suppress()
-SPEC_GRAMMAR_SPEC_STRING = pyparsing.OneOrMore(SPEC_GRAMMAR_QUOTED_STRING)
-SPEC_GRAMMAR_S_EXP = pyparsing.Forward()
-SPEC_GRAMMAR_STRING = SPEC_GRAMMAR_SPEC_STRING | pyparsing.Regex("([^()\s])+")
-SPEC_GRAMMAR_S_EXP_LIST = pyparsing.Group(SPEC_GRAMMAR_OPEN_PAREN +
-    pyparsing.ZeroOrMore(SPEC_GRAMMAR_S_EXP) + SPEC_GRAMMAR_CLOSE_PAREN)
-SPEC_GRAMMAR_S_EXP << ( SPEC_GRAMMAR_STRING | SPEC_GRAMMAR_S_EXP_LIST )
-GRAMMAR_JDWP_SPEC = pyparsing.OneOrMore(SPEC_GRAMMAR_S_EXP)
+class CodecCompiler(object):
+    """Compiles each Command's request encoder and response decoder into
+    specialised functions, for use instead of walking the tree of arg objects
+    on every call. Needs to know the spec's id sizes up front.
+
+    The compiled functions produce exactly what the arg objects do. They are
+    faster because everything that only depends on the spec is worked out
+    once: struct formats are precompiled, runs of fixed-width fields
+    (including whole Groups and Locations) are packed and unpacked with a
+    single struct call, and Select alternatives are dispatched through a dict
+    of compiled alternatives.
+
+    Compiled decode steps have the signature step(data, offset, accum) and
+    return the new offset; compiled encode steps have the signature
+    step(data, accum) and append to the bytearray accum.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.__value_structs = {}
+        for type_tag in STRUCT_FMT_BY_TYPE_TAG:
+            value_len = spec.lookup_value_size_by_type_tag(type_tag)
+            struct_fmt = STRUCT_FMT_BY_TYPE_TAG[type_tag]
+            if struct_fmt == "?":
+                struct_fmt = STRUCT_FMTS_BY_SIZE_UNSIGNED[value_len]
+            self.__value_structs[type_tag] = struct.Struct(">" + struct_fmt)
+        self.__void_tag = spec.lookup_constant("Tag", "VOID").value
+
+    def compile_command(self, command):
+        """Returns (encode, decode) functions for "command" """
+        return (self.__compile_request(command.request),
+                self.__compile_response(command.response))
+
+    def __compile_request(self, request):
+        steps = self.__compile_encode_steps(request.args)
+        def encode(data):
+            result = bytearray()
+            for step in steps:
+                step(data, result)
+            return result
+        return encode
+
+    def __compile_response(self, response):
+        steps = self.__compile_decode_steps(response.args)
+        def decode(data):
+            # slicing a str is cheap and gives us strs for the string fields
+            if not isinstance(data, str):
+                data = memoryview(data).tobytes()
+            result = {}
+            offset = 0
+            for step in steps:
+                offset = step(data, offset, result)
+            return result
+        return decode
+
+    def __flatten(self, args):
+        """Groups (and Locations) decode into and encode from the same dict as
+        their siblings, so for our purposes they're just their args. Returns
+        a list of args with all groups expanded."""
+        flattened = []
+        for arg in args:
+            if isinstance(arg, Group):
+                flattened.extend(self.__flatten(arg.args))
+            else:
+                flattened.append(arg)
+        return flattened
+
+    def __fixed_width_fmt(self, arg):
+        """Returns (decode_fmt, encode_fmt) for a fixed-width arg, or None"""
+        if not isinstance(arg, Primitive):
+            return None
+        if arg.type == "binary":
+            return ("?", "B")
+        size = self.spec.lookup_id_size(arg.type)
+        fmt = STRUCT_FMTS_BY_SIZE_UNSIGNED[size]
+        if arg.type == "int":
+            return (fmt, "i")
+        return (fmt, fmt)
+
+    def __runs(self, args):
+        """Splits args into runs of consecutive fixed-width args (lists) and
+        other args"""
+        runs = []
+        for arg in self.__flatten(args):
+            if self.__fixed_width_fmt(arg) is None:
+                runs.append(arg)
+            elif runs and isinstance(runs[-1], list):
+                runs[-1].append(arg)
+            else:
+                runs.append([arg])
+        return runs
+
+    def __compile_decode_steps(self, args):
+        steps = []
+        for run in self.__runs(args):
+            if isinstance(run, list):
+                steps.append(self.__compile_fixed_decode(run))
+            else:
+                steps.append(self.__compile_decode(run))
+        return steps
+
+    def __compile_encode_steps(self, args):
+        steps = []
+        for run in self.__runs(args):
+            if isinstance(run, list):
+                steps.append(self.__compile_fixed_encode(run))
+            else:
+                steps.append(self.__compile_encode(run))
+        return steps
+
+    def __compile_fixed_decode(self, args):
+        names = tuple(arg.name for arg in args)
+        packer = struct.Struct(
+                ">" + "".join(self.__fixed_width_fmt(arg)[0] for arg in args))
+        unpack_from = packer.unpack_from
+        size = packer.size
+        if len(names) == 1:
+            name = names[0]
+            def step(data, offset, accum):
+                accum[name] = unpack_from(data, offset)[0]
+                return offset + size
+        else:
+            def step(data, offset, accum):
+                accum.update(zip(names, unpack_from(data, offset)))
+                return offset + size
+        return step
+
+    def __compile_fixed_encode(self, args):
+        names = tuple(arg.name for arg in args)
+        binary_indexes = [i for i, arg in enumerate(args) if arg.type == "binary"]
+        pack = struct.Struct(
+                ">" + "".join(self.__fixed_width_fmt(arg)[1] for arg in args)).pack
+        def step(data, accum):
+            values = [data[name] for name in names]
+            for i in binary_indexes:
+                values[i] = int(values[i])
+            accum += pack(*values)
+        return step
+
+    def __compile_element_decode(self, arg):
+        """Compiles a decoder for a single arg decoded into a dict of its own
+        (a Repeat entry or a Select alternative), with the signature
+        decode(data, offset) -> (offset, dict)"""
+        if isinstance(arg, Select):
+            return self.__compile_select_decode(arg)
+        steps = self.__compile_decode_steps([arg])
+        if len(steps) == 1:
+            step = steps[0]
+            def decode(data, offset):
+                accum = {}
+                return step(data, offset, accum), accum
+        else:
+            def decode(data, offset):
+                accum = {}
+                for step in steps:
+                    offset = step(data, offset, accum)
+                return offset, accum
+        return decode
+
+    def __compile_select_decode(self, select):
+        choice_name = select.choice_arg.name
+        choice_decode = self.__compile_fixed_decode([select.choice_arg])
+        alts = {}
+        for position, alt in select.alts.items():
+            alts[position] = (alt.name, self.__compile_decode_steps(alt.args))
+        def decode(data, offset):
+            result = {}
+            offset = choice_decode(data, offset, result)
+            alt_name, alt_steps = alts[result[choice_name]]
+            alt_result = {}
+            for step in alt_steps:
+                offset = step(data, offset, alt_result)
+            result[alt_name] = alt_result
+            return offset, result
+        return decode
+
+    def __compile_decode(self, arg):
+        name = getattr(arg, "name", None)
+        if isinstance(arg, String):
+            unpack_len = struct.Struct(">I").unpack_from
+            def step(data, offset, accum):
+                strlen = unpack_len(data, offset)[0]
+                offset += 4
+                accum[name] = data[offset : offset + strlen].decode("UTF-8")
+                return offset + strlen
+            return step
+        if isinstance(arg, Value):
+            value_structs = self.__value_structs
+            void_tag = self.__void_tag
+            def step(data, offset, accum):
+                type_tag = data[offset]
+                if type_tag == void_tag:
+                    accum[name] = {"typeTag": void_tag, "value": None}
+                    return offset + 1
+                value_struct = value_structs[type_tag]
+                accum[name] = {
+                        "typeTag": type_tag,
+                        "value": value_struct.unpack_from(data, offset + 1)[0]}
+                return offset + 1 + value_struct.size
+            return step
+        if isinstance(arg, Repeat):
+            unpack_count = struct.Struct(">I").unpack_from
+            element_decode = self.__compile_element_decode(arg.arg)
+            def step(data, offset, accum):
+                count = unpack_count(data, offset)[0]
+                offset += 4
+                values = []
+                append = values.append
+                for i in xrange(count):
+                    offset, value = element_decode(data, offset)
+                    append(value)
+                accum[name] = values
+                return offset
+            return step
+        if isinstance(arg, Select):
+            # like Select.decode, this replaces anything decoded before it
+            select_decode = self.__compile_select_decode(arg)
+            def step(data, offset, accum):
+                offset, result = select_decode(data, offset)
+                accum.clear()
+                accum.update(result)
+                return offset
+            return step
+        # everything else is rare enough to leave to the arg itself
+        def step(data, offset, accum):
+            return arg.decode(data, offset, accum)[0]
+        return step
+
+    def __compile_encode(self, arg):
+        name = getattr(arg, "name", None)
+        if isinstance(arg, String):
+            pack_len = struct.Struct(">I").pack
+            def step(data, accum):
+                value = bytearray(data[name], "UTF-8")
+                accum += pack_len(len(value))
+                accum += value
+            return step
+        if isinstance(arg, Value):
+            encode_value = self.__compile_value_encode()
+            def step(data, accum):
+                value = data[name]
+                accum += bytearray(value["typeTag"])
+                encode_value(value["typeTag"], value["value"], accum)
+            return step
+        if isinstance(arg, UntaggedValue):
+            encode_value = self.__compile_value_encode()
+            def step(data, accum):
+                value = data["value"]
+                encode_value(value["typeTag"], value["value"], accum)
+            return step
+        if isinstance(arg, Repeat):
+            pack_count = struct.Struct(">I").pack
+            element_steps = self.__compile_encode_steps([arg.arg])
+            def step(data, accum):
+                values = data[name]
+                accum += pack_count(len(values))
+                for value in values:
+                    for element_step in element_steps:
+                        element_step(value, accum)
+            return step
+        if isinstance(arg, Select):
+            choice_name = arg.choice_arg.name
+            choice_encode = self.__compile_fixed_encode([arg.choice_arg])
+            alts = {}
+            for position, alt in arg.alts.items():
+                alts[position] = (alt.name,
+                        self.__compile_encode_steps(alt.args))
+            def step(data, accum):
+                choice_encode(data, accum)
+                alt_name, alt_steps = alts[data[choice_name]]
+                alt_data = data.get(alt_name, data)
+                for alt_step in alt_steps:
+                    alt_step(alt_data, accum)
+            return step
+        def step(data, accum):
+            arg.encode(data, accum)
+        return step
+
+    def __compile_value_encode(self):
+        value_structs = self.__value_structs
+        def encode_value(type_tag, value, accum):
+            if type_tag == "V" and value is None:
+                return
+            if type_tag == "Z":
+                value = int(value)
+            accum += value_structs[type_tag].pack(value)
+        return encode_value
+
 
 ACCESS_MODIFIER_PUBLIC = 0x0001
 ACCESS_MODIFIER_FINAL = 0x0010
@@ -0,0 +1,347 @@
+"""Benchmarks for pyjdwp's encode/decode layer. These need no jvm; run them
+with ./benchmark.sh or
+
+  PYTHONPATH="." python -m pyjdb.pyjdwp_benchmark [benchmark ...]
+
+The per-command benchmark can save its results as json (--output) and compare
+them against an earlier run's (--compare), e.g.
+
+  python -m pyjdb.pyjdwp_benchmark per-command --output before.json
+  (make changes)
+  python -m pyjdb.pyjdwp_benchmark per-command --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import pyjdwp
+import re
+import struct
+import sys
+import time
+
+
+ID_SIZES = {
+        "fieldIDSize": 8,
+        "methodIDSize": 8,
+        "objectIDSize": 8,
+        "referenceTypeIDSize": 8,
+        "frameIDSize": 8}
+
+
+def time_call(fn, min_time=.5):
+    """Returns the best-of-3 wall time of calling "fn", each run repeating the
+    call until at least "min_time" seconds have passed"""
+    best = None
+    for run in range(3):
+        calls = 0
+        start_time = time.time()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.time() - start_time
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+
+def make_all_classes_with_generic_reply(num_classes):
+    """Returns a synthetic VirtualMachine.AllClassesWithGeneric reply payload
+    for a jvm with "num_classes" loaded classes"""
+    parts = [struct.pack(">I", num_classes)]
+    for i in range(num_classes):
+        signature = "Lcom/example/generated/package%d/Class%d;" % (i % 100, i)
+        generic_signature = ""
+        parts.append(struct.pack(">BQ", 1, i + 1))
+        parts.append(struct.pack(">I", len(signature)) + signature)
+        parts.append(struct.pack(">I", len(generic_signature)) +
+                generic_signature)
+        parts.append(struct.pack(">I", 7))
+    return "".join(parts)
+
+
+def make_line_table_reply(num_lines):
+    parts = [struct.pack(">qqI", 0, num_lines * 4, num_lines)]
+    for i in range(num_lines):
+        parts.append(struct.pack(">qI", i * 4, i + 10))
+    return "".join(parts)
+
+
+def make_frames_reply(num_frames):
+    parts = [struct.pack(">I", num_frames)]
+    for i in range(num_frames):
+        parts.append(struct.pack(">QBQQQ", i + 1, 1, 100 + i, 200 + i, i * 3))
+    return "".join(parts)
+
+
+def make_class_prepare_events(num_events):
+    parts = [struct.pack(">BI", 0, num_events)]
+    for i in range(num_events):
+        signature = "Lcom/example/Class%d;" % i
+        parts.append(struct.pack(">BIQBQ", 8, 1, 2, 1, i + 1))
+        parts.append(struct.pack(">I", len(signature)) + signature)
+        parts.append(struct.pack(">I", 7))
+    return "".join(parts)
+
+
+def benchmark_compiled_codecs(spec, compiled_spec):
+    """Compares compiled codecs (see pyjdwp.CodecCompiler) against walking the
+    spec's arg objects"""
+    cases = [
+        ("decode", "VirtualMachine", "AllClassesWithGeneric",
+                make_all_classes_with_generic_reply(10000)),
+        ("decode", "Method", "LineTable", make_line_table_reply(1000)),
+        ("decode", "ThreadReference", "Frames", make_frames_reply(300)),
+        ("decode", "Event", "Composite", make_class_prepare_events(100)),
+        ("encode", "EventRequest", "Set", {
+                "eventKind": 2,
+                "suspendPolicy": 2,
+                "modifiers": [{
+                        "modKind": 7,
+                        "typeTag": 1,
+                        "classID": 1234,
+                        "methodID": 5678,
+                        "index": 9}]}),
+        ("encode", "ThreadReference", "Frames", {
+                "thread": 1234, "startFrame": 0, "length": -1}),
+    ]
+    print("Compiled vs interpreted codecs")
+    print("%-44s %14s %14s %8s" % ("command", "interpreted", "compiled", "speedup"))
+    results = []
+    for mode, command_set_name, command_name, data in cases:
+        timings = []
+        for each_spec in [spec, compiled_spec]:
+            command = each_spec.lookup_command(command_set_name, command_name)
+            codec = getattr(command, mode)
+            timings.append(time_call(lambda: codec(data), min_time=.1))
+        label = "%s %s.%s" % (mode, command_set_name, command_name)
+        results.append((label, timings[0], timings[1]))
+        print("%-44s %12.2fus %12.2fus %7.1fx" % (label, timings[0] * 1e6,
+                timings[1] * 1e6, timings[0] / timings[1]))
+    return results
+
+
+def benchmark_repeat_decode_scaling(spec, sizes=(1000, 10000, 100000)):
+    """Decodes AllClassesWithGeneric replies of increasing size. Decoding is
+    linear in the size of the reply, so the time per entry should stay flat."""
+    print("AllClassesWithGeneric decode scaling")
+    print("%10s %12s %14s" % ("classes", "seconds", "usec/class"))
+    command = spec.lookup_command("VirtualMachine", "AllClassesWithGeneric")
+    results = []
+    for size in sizes:
+        payload = make_all_classes_with_generic_reply(size)
+        elapsed = time_call(lambda: command.decode(payload), min_time=.1)
+        results.append((size, elapsed))
+        print("%10d %12.4f %14.2f" % (size, elapsed, elapsed / size * 1e6))
+    return results
+
+
+def benchmark_spec_parsing():
+    """Compares pyjdwp.parse_spec_text against the pyparsing grammar it
+    replaced, if pyparsing is installed"""
+    spec_path = os.path.join(os.path.dirname(pyjdwp.__file__),
+            "specs", "jdwp.spec_openjdk_7")
+    with open(spec_path) as spec_file:
+        jdwp_text = spec_file.read()
+    print("Spec parsing (jdwp.spec_openjdk_7)")
+    parse_time = time_call(lambda: pyjdwp.parse_spec_text(jdwp_text))
+    print("%-20s %10.2fms" % ("parse_spec_text", parse_time * 1e3))
+    try:
+        grammar = pyjdwp.pyparsing_spec_grammar()
+    except ImportError:
+        print("%-20s %12s" % ("pyparsing", "(not installed)"))
+        return
+    clean_text = re.sub("\s*=\s*", "=", jdwp_text)
+    pyparsing_time = time_call(lambda: grammar.parseString(clean_text))
+    print("%-20s %10.2fms %7.1fx slower" % ("pyparsing",
+            pyparsing_time * 1e3, pyparsing_time / parse_time))
+
+
+def make_sample_data(args, size):
+    """Returns representative data for a request's or reply's spec "args":
+    top level Repeats get "size" elements (nested ones a couple), Selects
+    cycle through their alternatives, and everything else gets small values"""
+    data = {}
+    for arg in args:
+        fill_sample_data(arg, data, size, 0, 0)
+    return data
+
+
+def fill_sample_data(arg, data, size, depth, index):
+    if isinstance(arg, pyjdwp.Repeat):
+        count = size if depth == 0 else min(size, 2)
+        elements = []
+        for i in range(count):
+            element = {}
+            fill_sample_data(arg.arg, element, size, depth + 1, i)
+            elements.append(element)
+        data[arg.name] = elements
+    elif isinstance(arg, pyjdwp.Select):
+        positions = sorted(arg.alts)
+        position = positions[index % len(positions)]
+        alt = arg.alts[position]
+        data[arg.choice_arg.name] = position
+        data[alt.name] = {}
+        for alt_arg in alt.args:
+            fill_sample_data(alt_arg, data[alt.name], size, depth, index)
+    elif isinstance(arg, pyjdwp.Group):
+        for group_arg in arg.args:
+            fill_sample_data(group_arg, data, size, depth, index)
+    elif isinstance(arg, pyjdwp.String):
+        data[arg.name] = u"sample%d" % index
+    elif isinstance(arg, pyjdwp.Value):
+        data[arg.name] = {"typeTag": "I", "value": index}
+    elif isinstance(arg, pyjdwp.UntaggedValue):
+        data["value"] = {"typeTag": "I", "value": index}
+    elif isinstance(arg, pyjdwp.TaggedObject):
+        data[arg.name] = {"typeTag": "L", "objectID": index + 1}
+    elif isinstance(arg, pyjdwp.TypedSequence):
+        data[arg.name] = ("I", range(size if depth == 0 else min(size, 2)))
+    elif arg.type in ["boolean", "binary"]:
+        data[arg.name] = index % 2
+    elif arg.type == "byte":
+        data[arg.name] = index % 256
+    else:
+        data[arg.name] = index
+
+
+def benchmark_per_command(spec, compiled_spec, sizes=(1, 100), min_time=.01,
+        command_filter=None):
+    """Times encoding a request and decoding a reply for every command in the
+    spec, with sample data (see make_sample_data) of each of "sizes". Returns
+    a dict of results keyed by "<codecs> <encode|decode> <command> n=<size>",
+    each giving seconds per op, ops per second, payload bytes and bytes per
+    second."""
+    print("Per-command codecs")
+    print("%-64s %12s %12s %12s" % ("", "usec/op", "ops/s", "MB/s"))
+    results = {}
+    skipped = []
+    for command_set_name in sorted(spec.command_sets):
+        for command_name in sorted(spec.command_sets[command_set_name].commands):
+            label = "%s.%s" % (command_set_name, command_name)
+            if command_filter and not re.search(command_filter, label):
+                continue
+            command = spec.lookup_command(command_set_name, command_name)
+            for size in sizes:
+                try:
+                    request = make_sample_data(command.request.args, size)
+                    request_bytes = len(command.encode(request))
+                    reply_payload = command.encode_reply(
+                            make_sample_data(command.response.args, size))
+                    reply = memoryview(reply_payload)
+                    command.decode(reply)
+                except (pyjdwp.Error, AttributeError, KeyError, TypeError,
+                        struct.error) as e:
+                    # e.g. untagged values, which can't be decoded without
+                    # knowing their types
+                    skipped.append((label, size, e))
+                    continue
+                for codecs, each_spec in [("interpreted", spec),
+                        ("compiled", compiled_spec)]:
+                    each_command = each_spec.lookup_command(
+                            command_set_name, command_name)
+                    cases = [
+                            ("encode", lambda: each_command.encode(request),
+                                    request_bytes),
+                            ("decode", lambda: each_command.decode(reply),
+                                    len(reply_payload))]
+                    for mode, fn, num_bytes in cases:
+                        seconds = time_call(fn, min_time)
+                        key = "%s %s %s n=%d" % (codecs, mode, label, size)
+                        results[key] = {
+                                "seconds_per_op": seconds,
+                                "ops_per_sec": 1 / seconds,
+                                "bytes": num_bytes,
+                                "bytes_per_sec": num_bytes / seconds}
+                        print("%-64s %12.2f %12.0f %12.2f" % (key, seconds * 1e6,
+                                1 / seconds, num_bytes / seconds / 1e6))
+    for label, size, e in skipped:
+        print("skipped %s n=%d: %r" % (label, size, e))
+    return results
+
+
+def write_results(path, benchmark_name, results):
+    with open(path, "w") as results_file:
+        json.dump({
+                "benchmark": benchmark_name,
+                "pyjdwp_version": pyjdwp.VERSION,
+                "python_version": platform.python_version(),
+                "time": time.time(),
+                "results": results}, results_file, indent=1, sort_keys=True)
+
+
+def compare_results(path, results, threshold=.2):
+    """Compares "results" against those saved at "path" by an earlier run and
+    prints whatever got more than "threshold" slower (or faster). Returns the
+    keys that got slower."""
+    with open(path) as results_file:
+        baseline = json.load(results_file)["results"]
+    regressions = []
+    improvements = []
+    for key in sorted(set(results) & set(baseline)):
+        ratio = (results[key]["seconds_per_op"] /
+                baseline[key]["seconds_per_op"])
+        if ratio > 1 + threshold:
+            regressions.append((key, ratio))
+        elif ratio < 1 / (1 + threshold):
+            improvements.append((key, ratio))
+    print("Compared %d results against %s" % (
+            len(set(results) & set(baseline)), path))
+    for title, changes in [("slower", regressions), ("faster", improvements)]:
+        print("%d %s by more than %d%%" % (len(changes), title, threshold * 100))
+        for key, ratio in changes:
+            print("  %-64s %6.2fx" % (key, ratio))
+    return [key for key, ratio in regressions]
+
+
+BENCHMARKS = ["decode-scaling", "compiled-codecs", "spec-parsing",
+        "per-command"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run, "
+            "of %s (default: all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100],
+            help="per-command: sizes of sample data to try")
+    parser.add_argument("--min-time", type=float, default=.01,
+            help="per-command: minimum time to spend timing each op")
+    parser.add_argument("--commands", help="per-command: regex of commands "
+            "(as CommandSet.Command) to run")
+    parser.add_argument("--output", help="per-command: write results as json "
+            "to this file")
+    parser.add_argument("--compare", help="per-command: compare results with "
+            "those in this file (from --output); exits 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=.2,
+            help="per-command: slowdown that counts as a regression")
+    args = parser.parse_args()
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % benchmark)
+    benchmarks = args.benchmarks or BENCHMARKS
+    spec = pyjdwp.JdwpSpec(7, ID_SIZES)
+    compiled_spec = pyjdwp.JdwpSpec(7, ID_SIZES, compile_codecs=True)
+    if "decode-scaling" in benchmarks:
+        benchmark_repeat_decode_scaling(spec)
+        print("")
+    if "compiled-codecs" in benchmarks:
+        benchmark_compiled_codecs(spec, compiled_spec)
+        print("")
+    if "spec-parsing" in benchmarks:
+        benchmark_spec_parsing()
+        print("")
+    if "per-command" in benchmarks:
+        results = benchmark_per_command(spec, compiled_spec, args.sizes,
+                args.min_time, args.commands)
+        if args.output:
+            write_results(args.output, "per-command", results)
+        if args.compare:
+            print("")
+            if compare_results(args.compare, results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+"""A scripted stand-in for a jvm's jdwp agent, for testing and benchmarking
+pyjdwp and pyjdb without a jvm. A FakeJvm listens on a local port, does the
+jdwp handshake, sends the VM_START event and answers commands from a
+synthetic set of classes and threads:
+
+  jvm = pyjdwp_fake.FakeJvm(rtt=.001)
+  jvm.populate(num_classes=50000, num_threads=2000)
+  jvm.start()
+  jdwp = pyjdwp.Jdwp("localhost", jvm.port)
+  jdwp.initialize()
+
+Replies are encoded with the same spec the client uses. Commands without a
+built-in handler get a NOT_IMPLEMENTED error reply; use set_handler to script
+them (or to override the built-in ones).
+"""
+import heapq
+import logging
+import os
+import pyjdwp
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+
+
+ERROR_INVALID_THREAD = 10
+ERROR_THREAD_NOT_SUSPENDED = 13
+ERROR_INVALID_OBJECT = 20
+ERROR_INVALID_CLASS = 21
+ERROR_INVALID_METHODID = 23
+ERROR_NOT_IMPLEMENTED = 99
+ERROR_ABSENT_INFORMATION = 101
+ERROR_INVALID_EVENT_TYPE = 102
+ERROR_INTERNAL = 113
+
+EVENT_KIND_THREAD_START = 6
+EVENT_KIND_THREAD_DEATH = 7
+EVENT_KIND_CLASS_PREPARE = 8
+EVENT_KIND_CLASS_UNLOAD = 9
+EVENT_KIND_VM_START = 90
+
+SUSPEND_POLICY_EVENT_THREAD = 1
+SUSPEND_POLICY_ALL = 2
+
+TYPE_TAG_CLASS = 1
+CLASS_STATUS_PREPARED = 7
+THREAD_STATUS_RUNNING = 1
+THREAD_STATUS_MONITOR = 3
+
+ID_SIZES = {
+        "fieldIDSize": 8,
+        "methodIDSize": 8,
+        "objectIDSize": 8,
+        "referenceTypeIDSize": 8,
+        "frameIDSize": 8}
+
+
+class FakeJvmError(Exception):
+    """Raised by command handlers to send an error reply"""
+
+    def __init__(self, error_code, message=""):
+        Exception.__init__(self, "jdwp error %d %s" % (error_code, message))
+        self.error_code = error_code
+
+
+class FakeJvm(object):
+    def __init__(self, version=7, id_sizes=None, rtt=0.0):
+        # artificial round trip time; each reply is held back this long after
+        # its request arrives (replies to pipelined requests aren't serialized)
+        self.rtt = rtt
+        self.version = version
+        self.id_sizes = id_sizes or dict(ID_SIZES)
+        self.spec = pyjdwp.JdwpSpec(version, self.id_sizes)
+        self.classes = []
+        self.classes_by_id = {}
+        self.threads = []
+        self.threads_by_id = {}
+        self.thread_group_id = None
+        self.event_requests = {}
+        # VirtualMachine.CapabilitiesNew; the ones not listed are False
+        self.capabilities = {"canUseSourceNameFilters": True}
+        # number of requests answered, by (command set name, command name)
+        self.request_counts = {}
+        self.__next_object_id = 0x1000
+        self.__next_request_id = 1
+        self.__all_classes_reply = None
+        self.__handlers = {}
+        self.__install_default_handlers()
+        self.__lock = threading.RLock()
+        self.__send_lock = threading.Lock()
+        self.__listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__listen_socket.bind(("localhost", 0))
+        self.__listen_socket.listen(1)
+        self.port = self.__listen_socket.getsockname()[1]
+        self.__conn = None
+        self.__running = False
+        self.__pid = None
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        self.__thread = threading.Thread(
+                target = self.__serve, name = "fake_jvm_%d" % self.port)
+        self.__thread.setDaemon(True)
+
+    def start(self):
+        self.__running = True
+        self.__thread.start()
+
+    def start_process(self):
+        """Like start, but serves from a forked child process, so the fake's
+        work doesn't compete for the GIL with the client being measured.
+        Changes made to this object after forking aren't seen by the child."""
+        self.__pid = os.fork()
+        if self.__pid == 0:
+            try:
+                self.__running = True
+                self.__serve()
+            finally:
+                os._exit(0)
+
+    def close(self):
+        if self.__pid:
+            os.kill(self.__pid, signal.SIGTERM)
+            os.waitpid(self.__pid, 0)
+            self.__pid = None
+        self.__running = False
+        os.write(self.__wakeup_write, "x")
+        if self.__thread.is_alive():
+            self.__thread.join()
+        self.__listen_socket.close()
+        os.close(self.__wakeup_read)
+        os.close(self.__wakeup_write)
+
+    def new_object_id(self):
+        with self.__lock:
+            self.__next_object_id += 1
+            return self.__next_object_id
+
+    def add_class(self, signature, source_file=None, methods=None, fields=None,
+            mod_bits=pyjdwp.ACCESS_MODIFIER_PUBLIC):
+        """Adds a loaded class. "methods" is a list of (name, signature, lines)
+        where lines is a list of (line code index, line number); by default the
+        class has a constructor with a single line."""
+        if methods is None:
+            methods = [("<init>", "()V", [(0, 1)])]
+        cls = {
+                "typeID": self.new_object_id(),
+                "refTypeTag": TYPE_TAG_CLASS,
+                "signature": signature,
+                "genericSignature": "",
+                "status": CLASS_STATUS_PREPARED,
+                "modBits": mod_bits,
+                "sourceFile": source_file,
+                "fields": [],
+                "methods": []}
+        for name, field_signature in fields or []:
+            cls["fields"].append({
+                    "fieldID": self.new_object_id(),
+                    "name": name,
+                    "signature": field_signature,
+                    "genericSignature": "",
+                    "modBits": pyjdwp.ACCESS_MODIFIER_PUBLIC})
+        for name, method_signature, lines in methods:
+            cls["methods"].append({
+                    "methodID": self.new_object_id(),
+                    "name": name,
+                    "signature": method_signature,
+                    "genericSignature": "",
+                    "modBits": pyjdwp.ACCESS_MODIFIER_PUBLIC,
+                    "lines": lines})
+        with self.__lock:
+            self.classes.append(cls)
+            self.classes_by_id[cls["typeID"]] = cls
+            self.__all_classes_reply = None
+        return cls
+
+    def add_thread(self, name, frames=None, suspended=False):
+        """Adds a live thread. "frames" is a list of (class, method) pairs, top
+        frame first, giving the thread's stack while it's suspended."""
+        with self.__lock:
+            if self.thread_group_id is None:
+                self.thread_group_id = self.new_object_id()
+            thread = {
+                    "thread": self.new_object_id(),
+                    "name": name,
+                    "group": self.thread_group_id,
+                    "status": THREAD_STATUS_RUNNING,
+                    "suspendCount": 1 if suspended else 0,
+                    "frames": frames or []}
+            self.threads.append(thread)
+            self.threads_by_id[thread["thread"]] = thread
+        return thread
+
+    def populate(self, num_classes=1000, num_threads=10, methods_per_class=4,
+            lines_per_method=8, frames_per_thread=10):
+        """Adds "num_classes" synthetic classes (spread over 100 packages, each
+        with its own source file) and "num_threads" threads"""
+        for i in range(num_classes):
+            methods = []
+            for j in range(methods_per_class):
+                first_line = 10 + j * (lines_per_method + 2)
+                methods.append(("method%d" % j, "()V", [
+                        (k * 4, first_line + k) for k in range(lines_per_method)]))
+            self.add_class("Lcom/example/package%d/Class%d;" % (i % 100, i),
+                    source_file="Class%d.java" % i, methods=methods)
+        for i in range(num_threads):
+            frames = []
+            if self.classes:
+                for j in range(frames_per_thread):
+                    cls = self.classes[(i + j) % len(self.classes)]
+                    if cls["methods"]:
+                        frames.append((cls, cls["methods"][0]))
+            self.add_thread("thread-%d" % i, frames)
+
+    def set_handler(self, command_set_name, command_name, handler):
+        """Answers "command_set_name.command_name" with "handler(request)",
+        where request is the decoded request data. The handler returns reply
+        data to encode (or an already encoded reply payload as a str), or
+        raises FakeJvmError."""
+        command = self.spec.lookup_command(command_set_name, command_name)
+        self.__handlers[(command.command_set_id, command.id)] = (
+                (command_set_name, command_name), handler)
+
+    def send_event(self, suspend_policy, events):
+        """Sends one composite event packet. Each of "events" is a dict with
+        an "eventKind" and the event's data under its spec name, e.g.
+        {"eventKind": 6, "ThreadStart": {"requestID": 2, "thread": 42}}"""
+        command = self.spec.lookup_command("Event", "Composite")
+        payload = command.encode_reply({
+                "suspendPolicy": suspend_policy,
+                "events": events})
+        self.__send_packet(0, 0, 0x4064, payload)
+
+    def prepare_class(self, signature, source_file=None, methods=None,
+            thread=None):
+        """Adds a class as add_class does, then sends a CLASS_PREPARE event
+        for it to any matching event requests"""
+        cls = self.add_class(signature, source_file, methods)
+        self.__send_matching_events(EVENT_KIND_CLASS_PREPARE, cls,
+                lambda request_id: {"ClassPrepare": {
+                        "requestID": request_id,
+                        "thread": thread or 0,
+                        "refTypeTag": cls["refTypeTag"],
+                        "typeID": cls["typeID"],
+                        "signature": cls["signature"],
+                        "status": cls["status"]}})
+        return cls
+
+    def unload_class(self, cls):
+        """Removes a class, then sends a CLASS_UNLOAD event for it (which, as
+        from a real jvm, has just its signature) to any matching event
+        requests"""
+        with self.__lock:
+            self.classes.remove(cls)
+            del self.classes_by_id[cls["typeID"]]
+            self.__all_classes_reply = None
+        self.__send_matching_events(EVENT_KIND_CLASS_UNLOAD, cls,
+                lambda request_id: {"ClassUnload": {
+                        "requestID": request_id,
+                        "signature": cls["signature"]}})
+
+    def start_thread(self, name, frames=None):
+        thread = self.add_thread(name, frames)
+        self.__send_matching_events(EVENT_KIND_THREAD_START, None,
+                lambda request_id: {"ThreadStart": {
+                        "requestID": request_id,
+                        "thread": thread["thread"]}})
+        return thread
+
+    def end_thread(self, thread):
+        with self.__lock:
+            self.threads.remove(thread)
+            del self.threads_by_id[thread["thread"]]
+        self.__send_matching_events(EVENT_KIND_THREAD_DEATH, None,
+                lambda request_id: {"ThreadDeath": {
+                        "requestID": request_id,
+                        "thread": thread["thread"]}})
+
+    def __send_matching_events(self, event_kind, cls, make_event):
+        events = []
+        suspend_policy = 0
+        with self.__lock:
+            for request_id in sorted(self.event_requests):
+                request = self.event_requests[request_id]
+                if request["eventKind"] != event_kind:
+                    continue
+                if cls is not None and not self.__class_matches(cls, request):
+                    continue
+                event = make_event(request_id)
+                event["eventKind"] = event_kind
+                events.append(event)
+                suspend_policy = max(suspend_policy, request["suspendPolicy"])
+            if events:
+                self.__suspend_for_event(suspend_policy, events[0])
+        if events:
+            self.send_event(suspend_policy, events)
+
+    def __suspend_for_event(self, suspend_policy, event):
+        # like a jvm, suspend before reporting the event; the client resumes
+        if suspend_policy == SUSPEND_POLICY_ALL:
+            for thread in self.threads:
+                thread["suspendCount"] += 1
+        elif suspend_policy == SUSPEND_POLICY_EVENT_THREAD:
+            for data in event.values():
+                if (isinstance(data, dict) and
+                        data.get("thread") in self.threads_by_id):
+                    self.threads_by_id[data["thread"]]["suspendCount"] += 1
+
+    def __class_matches(self, cls, request):
+        class_name = cls["signature"][1 : -1].replace("/", ".")
+        for modifier in request["modifiers"]:
+            if "ClassMatch" in modifier:
+                if not pattern_matches(
+                        modifier["ClassMatch"]["classPattern"], class_name):
+                    return False
+            elif "ClassExclude" in modifier:
+                if pattern_matches(
+                        modifier["ClassExclude"]["classPattern"], class_name):
+                    return False
+            elif "ClassOnly" in modifier:
+                if modifier["ClassOnly"]["clazz"] != cls["typeID"]:
+                    return False
+            elif "SourceNameMatch" in modifier:
+                if cls["sourceFile"] is None or not pattern_matches(
+                        modifier["SourceNameMatch"]["sourceNamePattern"],
+                        cls["sourceFile"]):
+                    return False
+        return True
+
+    def __serve(self):
+        while self.__running:
+            readable, _, _ = select.select(
+                    [self.__listen_socket, self.__wakeup_read], [], [])
+            if self.__wakeup_read in readable:
+                return
+            conn, _ = self.__listen_socket.accept()
+            try:
+                self.__serve_connection(conn)
+            except (socket.error, EOFError) as e:
+                logging.info("Fake jvm connection closed: %s", e)
+            finally:
+                self.__conn = None
+                conn.close()
+
+    def __serve_connection(self, conn):
+        handshake = ""
+        while len(handshake) < 14:
+            data = conn.recv(14 - len(handshake))
+            if not data:
+                raise EOFError("Connection closed during handshake")
+            handshake += data
+        if handshake != "JDWP-Handshake":
+            raise EOFError("Bad handshake: %r" % handshake)
+        conn.sendall("JDWP-Handshake")
+        self.__conn = conn
+        thread_id = self.threads[0]["thread"] if self.threads else 0
+        self.send_event(0, [{
+                "eventKind": EVENT_KIND_VM_START,
+                "VMStart": {"requestID": 0, "thread": thread_id}}])
+        buf = ""
+        scheduled = []
+        sequence = 0
+        while self.__running:
+            timeout = None
+            if scheduled:
+                timeout = max(0, scheduled[0][0] - time.time())
+            readable, _, _ = select.select(
+                    [conn, self.__wakeup_read], [], [], timeout)
+            if self.__wakeup_read in readable:
+                return
+            if conn in readable:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                buf += data
+                offset = 0
+                while len(buf) - offset >= 11:
+                    length, req_id, _, command_set_id, command_id = \
+                            struct.unpack_from(">IIBBB", buf, offset)
+                    if len(buf) - offset < length:
+                        break
+                    payload = buf[offset + 11 : offset + length]
+                    offset += length
+                    err, reply = self.__handle_command(
+                            command_set_id, command_id, payload)
+                    sequence += 1
+                    heapq.heappush(scheduled, (time.time() + self.rtt,
+                            sequence, req_id, err, reply))
+                buf = buf[offset : ]
+            now = time.time()
+            while scheduled and scheduled[0][0] <= now:
+                _, _, req_id, err, reply = heapq.heappop(scheduled)
+                self.__send_packet(req_id, 0x80, err, reply)
+
+    def __send_packet(self, req_id, flags, err, payload):
+        header = pyjdwp.JDWP_PACKET_HEADER.pack(
+                pyjdwp.JDWP_PACKET_HEADER_LENGTH + len(payload),
+                req_id, flags, err)
+        with self.__send_lock:
+            if self.__conn is None:
+                raise pyjdwp.Error("Fake jvm has no connection")
+            self.__conn.sendall(header + str(payload))
+
+    def __handle_command(self, command_set_id, command_id, payload):
+        """Returns (error code, reply payload) for a request"""
+        if (command_set_id, command_id) not in self.__handlers:
+            return ERROR_NOT_IMPLEMENTED, ""
+        key, handler = self.__handlers[(command_set_id, command_id)]
+        command = self.spec.lookup_command_by_id(command_set_id, command_id)
+        with self.__lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            try:
+                reply = handler(command.decode_request(payload))
+            except FakeJvmError as e:
+                return e.error_code, ""
+            except Exception as e:
+                logging.exception("Fake jvm failed handling %s.%s: %s",
+                        key[0], key[1], e)
+                return ERROR_INTERNAL, ""
+        if not isinstance(reply, str):
+            reply = command.encode_reply(reply or {})
+        return 0, reply
+
+    def __install_default_handlers(self):
+        handlers = {
+            ("VirtualMachine", "Version"): self.__version,
+            ("VirtualMachine", "IDSizes"): lambda request: self.id_sizes,
+            ("VirtualMachine", "AllClasses"): self.__all_classes,
+            ("VirtualMachine", "AllClassesWithGeneric"):
+                    self.__all_classes_with_generic,
+            ("VirtualMachine", "ClassesBySignature"):
+                    self.__classes_by_signature,
+            ("VirtualMachine", "AllThreads"): lambda request: {
+                    "threads": [{"thread": thread["thread"]}
+                            for thread in self.threads]},
+            ("VirtualMachine", "Suspend"): self.__suspend_all,
+            ("VirtualMachine", "Resume"): self.__resume_all,
+            ("VirtualMachine", "Dispose"): lambda request: {},
+            ("VirtualMachine", "CapabilitiesNew"): self.__capabilities_new,
+            ("ReferenceType", "Signature"): lambda request: {
+                    "signature": self.__lookup_class(request)["signature"]},
+            ("ReferenceType", "Modifiers"): lambda request: {
+                    "modBits": self.__lookup_class(request)["modBits"]},
+            ("ReferenceType", "Status"): lambda request: {
+                    "status": self.__lookup_class(request)["status"]},
+            ("ReferenceType", "SourceFile"): self.__source_file,
+            ("ReferenceType", "FieldsWithGeneric"): lambda request: {
+                    "declared": self.__lookup_class(request)["fields"]},
+            ("ReferenceType", "MethodsWithGeneric"): lambda request: {
+                    "declared": self.__lookup_class(request)["methods"]},
+            ("Method", "LineTable"): self.__line_table,
+            ("ThreadReference", "Name"): lambda request: {
+                    "threadName": self.__lookup_thread(request)["name"]},
+            ("ThreadReference", "ThreadGroup"): lambda request: {
+                    "group": self.__lookup_thread(request)["group"]},
+            ("ThreadReference", "Status"): self.__thread_status,
+            ("ThreadReference", "Suspend"): self.__suspend_thread,
+            ("ThreadReference", "Resume"): self.__resume_thread,
+            ("ThreadReference", "FrameCount"): lambda request: {"frameCount":
+                    len(self.__lookup_suspended_thread(request)["frames"])},
+            ("ThreadReference", "Frames"): self.__frames,
+            ("EventRequest", "Set"): self.__set_event_request,
+            ("EventRequest", "Clear"): self.__clear_event_request,
+        }
+        for (command_set_name, command_name), handler in handlers.items():
+            self.set_handler(command_set_name, command_name, handler)
+
+    def __lookup_class(self, request):
+        if request["refType"] not in self.classes_by_id:
+            raise FakeJvmError(ERROR_INVALID_CLASS)
+        return self.classes_by_id[request["refType"]]
+
+    def __lookup_thread(self, request):
+        if request["thread"] not in self.threads_by_id:
+            raise FakeJvmError(ERROR_INVALID_THREAD)
+        return self.threads_by_id[request["thread"]]
+
+    def __lookup_suspended_thread(self, request):
+        thread = self.__lookup_thread(request)
+        if not thread["suspendCount"]:
+            raise FakeJvmError(ERROR_THREAD_NOT_SUSPENDED)
+        return thread
+
+    def __version(self, request):
+        return {
+                "description": "pyjdwp fake jvm",
+                "jdwpMajor": 1,
+                "jdwpMinor": self.version,
+                "vmVersion": "1.%d.0" % self.version,
+                "vmName": "pyjdwp fake jvm"}
+
+    def __all_classes(self, request):
+        return {"classes": self.classes}
+
+    def __all_classes_with_generic(self, request):
+        # this reply is big and asked for a lot (by every client initializing)
+        # so we only encode it once
+        if self.__all_classes_reply is None:
+            command = self.spec.lookup_command(
+                    "VirtualMachine", "AllClassesWithGeneric")
+            self.__all_classes_reply = str(command.encode_reply(
+                    {"classes": self.classes}))
+        return self.__all_classes_reply
+
+    def __classes_by_signature(self, request):
+        return {"classes": [cls for cls in self.classes
+                if cls["signature"] == request["signature"]]}
+
+    def __capabilities_new(self, request):
+        command = self.spec.lookup_command("VirtualMachine", "CapabilitiesNew")
+        reply = dict((arg.name, False) for arg in command.response.args)
+        reply.update(self.capabilities)
+        return reply
+
+    def __source_file(self, request):
+        cls = self.__lookup_class(request)
+        if cls["sourceFile"] is None:
+            raise FakeJvmError(ERROR_ABSENT_INFORMATION)
+        return {"sourceFile": cls["sourceFile"]}
+
+    def __line_table(self, request):
+        cls = self.__lookup_class(request)
+        for method in cls["methods"]:
+            if method["methodID"] == request["methodID"]:
+                lines = method["lines"]
+                return {
+                        "start": lines[0][0] if lines else 0,
+                        "end": lines[-1][0] if lines else 0,
+                        "lines": [{"lineCodeIndex": code_index,
+                                "lineNumber": line_number}
+                                for code_index, line_number in lines]}
+        raise FakeJvmError(ERROR_INVALID_METHODID)
+
+    def __thread_status(self, request):
+        thread = self.__lookup_thread(request)
+        return {
+                "threadStatus": thread["status"],
+                "suspendStatus": 1 if thread["suspendCount"] else 0}
+
+    def __suspend_all(self, request):
+        for thread in self.threads:
+            thread["suspendCount"] += 1
+
+    def __resume_all(self, request):
+        for thread in self.threads:
+            thread["suspendCount"] = max(0, thread["suspendCount"] - 1)
+
+    def __suspend_thread(self, request):
+        self.__lookup_thread(request)["suspendCount"] += 1
+
+    def __resume_thread(self, request):
+        thread = self.__lookup_thread(request)
+        thread["suspendCount"] = max(0, thread["suspendCount"] - 1)
+
+    def __frames(self, request):
+        thread = self.__lookup_suspended_thread(request)
+        start = request["startFrame"]
+        # ints are decoded unsigned; -1 means "all remaining frames"
+        if request["length"] >= 0x80000000:
+            end = len(thread["frames"])
+        else:
+            end = start + request["length"]
+        frames = []
+        for i, (cls, method) in enumerate(thread["frames"][start : end]):
+            frames.append({
+                    "frameID": start + i + 1,
+                    "typeTag": cls["refTypeTag"],
+                    "classID": cls["typeID"],
+                    "methodID": method["methodID"],
+                    "index": method["lines"][0][0] if method["lines"] else 0})
+        return {"frames": frames}
+
+    def __set_event_request(self, request):
+        request_id = self.__next_request_id
+        self.__next_request_id += 1
+        self.event_requests[request_id] = request
+        return {"requestID": request_id}
+
+    def __clear_event_request(self, request):
+        self.event_requests.pop(request["requestID"], None)
+
+
+def pattern_matches(pattern, name):
+    """Matches jdwp class/source name patterns, which may begin or end (but not
+    both) with "*" """
+    if pattern.startswith("*"):
+        return name.endswith(pattern[1 : ])
+    if pattern.endswith("*"):
+        return name.startswith(pattern[ : -1])
+    return name == pattern
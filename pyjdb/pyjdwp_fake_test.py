@@ -0,0 +1,217 @@
+"""Tests for pyjdwp_fake, the scripted stand-in jvm. These also exercise
+pyjdwp end to end without needing a jvm."""
+import os
+import pyjdwp
+import pyjdwp_fake
+import tempfile
+import threading
+import time
+import unittest
+
+
+# so the tests don't write to the user's spec cache
+os.environ["PYJDWP_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+class FakeJvmTest(unittest.TestCase):
+    rtt = 0.0
+
+    def setUp(self):
+        self.jvm = pyjdwp_fake.FakeJvm(rtt=self.rtt)
+        self.jvm.populate(num_classes=20, num_threads=3, methods_per_class=2,
+                lines_per_method=3, frames_per_thread=4)
+        self.jvm.start()
+        self.jdwp = pyjdwp.Jdwp("localhost", self.jvm.port, timeout=5)
+        self.jdwp.initialize()
+
+    def tearDown(self):
+        self.jdwp.disconnect()
+        self.jvm.close()
+
+    def test_version(self):
+        resp = self.jdwp.VirtualMachine.Version()
+        self.assertEquals(resp["jdwpMajor"], 1)
+        self.assertEquals(resp["jdwpMinor"], 7)
+
+    def test_all_classes_with_generic(self):
+        classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()["classes"]
+        self.assertEquals(
+                [entry["signature"] for entry in classes],
+                [cls["signature"] for cls in self.jvm.classes])
+        self.assertEquals(classes[3]["typeID"], self.jvm.classes[3]["typeID"])
+
+    def test_methods_and_line_table(self):
+        cls = self.jvm.classes[0]
+        methods = self.jdwp.ReferenceType.MethodsWithGeneric({
+                "refType": cls["typeID"]})["declared"]
+        self.assertEquals([method["name"] for method in methods],
+                ["method0", "method1"])
+        line_table = self.jdwp.Method.LineTable({
+                "refType": cls["typeID"],
+                "methodID": methods[1]["methodID"]})
+        self.assertEquals(
+                [(line["lineCodeIndex"], line["lineNumber"])
+                        for line in line_table["lines"]],
+                [(0, 15), (4, 16), (8, 17)])
+
+    def test_error_replies(self):
+        self.assertRaises(pyjdwp.Error, self.jdwp.ReferenceType.SourceFile,
+                {"refType": 1})
+        cls = self.jvm.add_class("LNoSource;")
+        self.assertRaises(pyjdwp.Error, self.jdwp.ReferenceType.SourceFile,
+                {"refType": cls["typeID"]})
+        # not implemented by the fake
+        self.assertRaises(pyjdwp.Error, self.jdwp.VirtualMachine.TopLevelThreadGroups)
+
+    def test_frames(self):
+        thread_id = self.jvm.threads[0]["thread"]
+        self.assertRaises(pyjdwp.Error, self.jdwp.ThreadReference.Frames, {
+                "thread": thread_id, "startFrame": 0, "length": -1})
+        self.jdwp.VirtualMachine.Suspend()
+        status = self.jdwp.ThreadReference.Status({"thread": thread_id})
+        self.assertEquals(status["suspendStatus"], 1)
+        frames = self.jdwp.ThreadReference.Frames({
+                "thread": thread_id, "startFrame": 1, "length": -1})["frames"]
+        self.assertEquals(len(frames), 3)
+        self.assertEquals(frames[0]["classID"], self.jvm.classes[1]["typeID"])
+        self.assertEquals(self.jdwp.ThreadReference.FrameCount({
+                "thread": thread_id})["frameCount"], 4)
+
+    def test_scripted_handler(self):
+        self.jvm.set_handler("VirtualMachine", "AllThreads",
+                lambda request: {"threads": [{"thread": 42}]})
+        self.assertEquals(self.jdwp.VirtualMachine.AllThreads(),
+                {"threads": [{"thread": 42}]})
+        def fail(request):
+            raise pyjdwp_fake.FakeJvmError(pyjdwp_fake.ERROR_INVALID_THREAD)
+        self.jvm.set_handler("ThreadReference", "Name", fail)
+        self.assertRaises(pyjdwp.Error, self.jdwp.ThreadReference.Name,
+                {"thread": self.jvm.threads[0]["thread"]})
+        self.assertEquals(
+                self.jvm.request_counts[("ThreadReference", "Name")], 1)
+
+    def test_metrics(self):
+        self.jdwp.VirtualMachine.AllThreads()
+        self.assertRaises(pyjdwp.Error, self.jdwp.ReferenceType.SourceFile,
+                {"refType": 1})
+        # replies are recorded on the listener thread, maybe just after the
+        # caller wakes up
+        deadline = time.time() + 5
+        while (self.jdwp.metrics.snapshot()["in_flight"] and
+                time.time() < deadline):
+            time.sleep(.001)
+        snapshot = self.jdwp.metrics.snapshot()
+        self.assertEquals(snapshot["in_flight"], 0)
+        self.assertEquals(snapshot["errors_by_code"],
+                {pyjdwp_fake.ERROR_INVALID_CLASS: 1})
+        all_threads = snapshot["commands"]["VirtualMachine.AllThreads"]
+        self.assertEquals(all_threads["requests"], 1)
+        self.assertEquals(all_threads["replies"], 1)
+        self.assertEquals(all_threads["bytes_in"], 11 + 4 + 3 * 8)
+        self.assertEquals(sum(all_threads["latency_histogram_us"].values()), 1)
+        self.assertTrue(all_threads["decode_seconds"] > 0)
+        # handshake requests count too
+        self.assertEquals(snapshot["packets_sent"], 4)
+        self.assertEquals(snapshot["packets_received"], 5)
+
+    def test_request_pipeline(self):
+        pipeline = pyjdwp.RequestPipeline(self.jdwp, max_in_flight=2)
+        names = []
+        errors = []
+        for thread in self.jvm.threads:
+            pipeline.submit("ThreadReference", "Name",
+                    {"thread": thread["thread"]},
+                    lambda resp: names.append(resp["threadName"]))
+        pipeline.submit("ThreadReference", "Name", {"thread": 1},
+                names.append, errors.append)
+        # follow-up requests submitted from a callback run too
+        pipeline.submit("VirtualMachine", "AllThreads", None,
+                lambda resp: pipeline.submit("ThreadReference", "Name",
+                        resp["threads"][0],
+                        lambda resp: names.append(resp["threadName"])))
+        pipeline.run()
+        self.assertEquals(names,
+                ["thread-0", "thread-1", "thread-2", "thread-0"])
+        self.assertEquals(len(errors), 1)
+        pipeline.submit("ThreadReference", "Name", {"thread": 1},
+                names.append)
+        self.assertRaises(pyjdwp.Error, pipeline.run)
+
+    def test_class_prepare_events(self):
+        events = []
+        received = threading.Event()
+        def callback(event):
+            events.append(event)
+            received.set()
+        self.jdwp.register_event_callback(callback)
+        self.jdwp.EventRequest.Set({
+                "eventKind": self.jdwp.EventKind.CLASS_PREPARE,
+                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
+                "modifiers": [{"modKind": 5, "classPattern": "com.foo.*"}]})
+        self.jvm.prepare_class("Lcom/bar/Skipped;")
+        cls = self.jvm.prepare_class("Lcom/foo/Prepared;", "Prepared.java")
+        received.wait(5)
+        self.assertEquals(len(events), 1)
+        event = events[0]["events"][0]
+        self.assertEquals(event["eventKind"], self.jdwp.EventKind.CLASS_PREPARE)
+        self.assertEquals(event["ClassPrepare"]["typeID"], cls["typeID"])
+        self.assertEquals(event["ClassPrepare"]["signature"], "Lcom/foo/Prepared;")
+
+    def test_reply_cache(self):
+        self.jdwp.reply_cache = pyjdwp.ReplyCache()
+        cls = self.jvm.classes[0]
+        thread_id = self.jvm.threads[0]["thread"]
+        for i in range(2):
+            methods = self.jdwp.ReferenceType.MethodsWithGeneric({
+                    "refType": cls["typeID"]})["declared"]
+            self.assertEquals(len(methods), 2)
+            # decoded afresh, so callers may change what they get
+            methods.pop()
+            self.assertRaises(pyjdwp.Error, self.jdwp.ThreadReference.Frames,
+                    {"thread": thread_id, "startFrame": 0, "length": -1})
+        self.assertEquals(self.jvm.request_counts[
+                ("ReferenceType", "MethodsWithGeneric")], 1)
+        # errors aren't cached
+        self.assertEquals(self.jvm.request_counts[
+                ("ThreadReference", "Frames")], 2)
+        self.jdwp.VirtualMachine.Suspend()
+        for i in range(2):
+            self.assertEquals(len(self.jdwp.ThreadReference.Frames({
+                    "thread": thread_id, "startFrame": 0, "length": -1})[
+                            "frames"]), 4)
+        self.assertEquals(self.jvm.request_counts[
+                ("ThreadReference", "Frames")], 3)
+        self.jdwp.VirtualMachine.Resume()
+        self.assertRaises(pyjdwp.Error, self.jdwp.ThreadReference.Frames,
+                {"thread": thread_id, "startFrame": 0, "length": -1})
+        self.jdwp.ReferenceType.MethodsWithGeneric({"refType": cls["typeID"]})
+        self.assertEquals(self.jvm.request_counts[
+                ("ReferenceType", "MethodsWithGeneric")], 1)
+        stats = self.jdwp.reply_cache.stats()
+        self.assertEquals((stats["hits"], stats["misses"]), (3, 5))
+
+
+class FakeJvmWithRttTest(FakeJvmTest):
+    rtt = 0.05
+
+    def test_pipelined_requests_overlap(self):
+        start_time = time.time()
+        futures = [self.jdwp.command_request_async(
+                "ThreadReference", "Name", {"thread": thread["thread"]})
+                for thread in self.jvm.threads]
+        names = [resp["threadName"] for resp in pyjdwp.gather(futures)]
+        self.assertEquals(names, ["thread-0", "thread-1", "thread-2"])
+        self.assertTrue(time.time() - start_time < 2 * self.rtt)
+
+
+class PatternMatchesTest(unittest.TestCase):
+    def test_pattern_matches(self):
+        self.assertTrue(pyjdwp_fake.pattern_matches("com.foo.*", "com.foo.Bar"))
+        self.assertTrue(pyjdwp_fake.pattern_matches("*.Bar", "com.foo.Bar"))
+        self.assertTrue(pyjdwp_fake.pattern_matches("Bar.java", "Bar.java"))
+        self.assertFalse(pyjdwp_fake.pattern_matches("com.foo.*", "com.bar.Foo"))
+        self.assertFalse(pyjdwp_fake.pattern_matches("Bar.java", "Baz.java"))
+
+
+if __name__ == "__main__":
+    unittest.main()
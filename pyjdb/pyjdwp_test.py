@@ -1,18 +1,29 @@
 import logging 
 import os
 import pyjdwp
+import random
+import re
+import shutil
 import signal
 import socket
 import string
+import struct
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 import Queue
+try:
+    import pyparsing
+except ImportError:
+    pyparsing = None
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 
 
 TEST_TMP_DIRNAME = tempfile.mkdtemp()
+# so the tests don't write to the user's spec cache
+os.environ["PYJDWP_CACHE_DIR"] = os.path.join(TEST_TMP_DIRNAME, "spec_cache")
 
 class PyjdwpTestBase(unittest.TestCase):
     """Base class for pyjdwp package tests.
@@ -29,8 +40,11 @@ class PyjdwpTestBase(unittest.TestCase):
     'debug_target_code' (the java code to compile and debug) and
     'debug_target_main_class' (a class containing a public static void main
     method in the test java code) to fit the needs of a particular test case.
+    Setting 'use_multiplexer' runs the test cases over a JdwpMultiplexer.
     """
 
+    use_multiplexer = False
+
     @classmethod
     def setUpClass(cls):
         if not hasattr(cls, "debug_target_code"):
@@ -99,12 +113,17 @@ class PyjdwpTestBase(unittest.TestCase):
             # won't be called if we fail) and bail.
             self.test_target_subprocess.send_signal(signal.SIGKILL)
             raise e
-        self.jdwp = pyjdwp.Jdwp("localhost", port)
+        self.multiplexer = None
+        if self.use_multiplexer:
+            self.multiplexer = pyjdwp.JdwpMultiplexer()
+        self.jdwp = pyjdwp.Jdwp("localhost", port, multiplexer=self.multiplexer)
         self.jdwp.initialize();
 
     def tearDown(self):
         # disconnect debugger
         self.jdwp.disconnect()
+        if self.multiplexer:
+            self.multiplexer.close()
         # kill target jvm
         self.test_target_subprocess.send_signal(signal.SIGKILL)
         self.test_target_subprocess.wait()
@@ -198,6 +217,14 @@ class VirtualMachineTest(PyjdwpTestBase):
         # if they"re equal, then we"re in business!
         self.assertEquals(system_version_number, jdwp_jvm_version_number)
 
+    def test_virtual_machine_pipelined_requests(self):
+        futures = [self.jdwp.VirtualMachine.submit("Version")
+                for i in range(50)]
+        responses = pyjdwp.gather(futures)
+        self.assertEquals(len(responses), 50)
+        for response in responses:
+            self.assertEquals(response, responses[0])
+
     def test_virtual_machine_classes_by_signature(self):
         resp = self.jdwp.VirtualMachine.ClassesBySignature({
             "signature": u"Ljava/lang/String;"})
@@ -369,6 +396,9 @@ class VirtualMachineTest(PyjdwpTestBase):
         pass
 
 
+class MultiplexedVirtualMachineTest(VirtualMachineTest):
+    use_multiplexer = True
+
 class ReferenceTypeTest(PyjdwpTestBase):
     def setUp(self):
         super(ReferenceTypeTest, self).setUp()
@@ -1318,5 +1348,711 @@ class StackFrameTest(PyjdwpTestBase):
         # now there should only be 3 frames
         self.assertEquals(len(resp), 3)
 
+class ReplyDispatcherTest(unittest.TestCase):
+    def test_dispatch(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=5)
+        pending = dispatcher.register(1)
+        self.assertTrue(dispatcher.dispatch(1, 0, "payload"))
+        self.assertEquals(pending.wait(), "payload")
+        self.assertEquals(dispatcher.pending_count, 0)
+        dispatcher.close()
+
+    def test_dispatch_error(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=5)
+        pending = dispatcher.register(1)
+        dispatcher.dispatch(1, 20, "")
+        self.assertRaises(pyjdwp.Error, pending.wait)
+        dispatcher.close()
+
+    def test_timeout(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=.1)
+        pending = dispatcher.register(1)
+        self.assertRaises(pyjdwp.Timeout, pending.wait)
+        # a reply arriving after the deadline is dropped, not kept around
+        self.assertFalse(dispatcher.dispatch(1, 0, "late"))
+        self.assertEquals(dispatcher.pending_count, 0)
+        dispatcher.close()
+
+    def test_cancel(self):
+        dispatcher = pyjdwp.ReplyDispatcher()
+        pending = dispatcher.register(1)
+        self.assertTrue(dispatcher.cancel(1))
+        self.assertTrue(pending.cancelled())
+        self.assertRaises(pyjdwp.Cancelled, pending.wait)
+        self.assertFalse(dispatcher.dispatch(1, 0, "late"))
+        dispatcher.close()
+
+    def test_close_fails_pending(self):
+        dispatcher = pyjdwp.ReplyDispatcher()
+        pending = dispatcher.register(1)
+        dispatcher.close()
+        self.assertRaises(pyjdwp.Error, pending.wait)
+
+class ReplyCacheTest(unittest.TestCase):
+    def store(self, cache, command_label, data, request, reply):
+        scope = cache.scope(command_label, data)
+        cache.store(command_label, request, scope, cache.stamp(scope), reply)
+
+    def test_scope(self):
+        cache = pyjdwp.ReplyCache()
+        self.assertEquals(cache.scope("Method.LineTable",
+                {"refType": 1, "methodID": 2}), ("type", 1))
+        self.assertEquals(cache.scope("ClassType.Superclass", {"clazz": 1}),
+                ("type", 1))
+        self.assertEquals(cache.scope("ThreadReference.Frames",
+                {"thread": 3, "startFrame": 0, "length": -1}), ("thread", 3))
+        self.assertEquals(cache.scope("ThreadReference.Status",
+                {"thread": 3}), None)
+
+    def test_lookup(self):
+        cache = pyjdwp.ReplyCache()
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile",
+                bytearray("a")), None)
+        self.store(cache, "ReferenceType.SourceFile", {"refType": 1},
+                bytearray("a"), "reply")
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile",
+                bytearray("a")), "reply")
+        self.assertEquals(cache.lookup("ReferenceType.Modifiers",
+                bytearray("a")), None)
+        stats = cache.stats()
+        self.assertEquals((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEquals(stats["entries"], 1)
+        self.assertEquals(stats["bytes"], 6)
+        self.assertEquals(cache.hit_rate, 1 / 3.0)
+
+    def test_lru_eviction(self):
+        cache = pyjdwp.ReplyCache(max_entries=2, max_bytes=20)
+        for i in range(3):
+            if i == 2:
+                # used, so not the least recently used anymore
+                cache.lookup("ReferenceType.SourceFile", "0")
+            self.store(cache, "ReferenceType.SourceFile", {"refType": i},
+                    str(i), "reply")
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "1"), None)
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "0"),
+                "reply")
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "2"),
+                "reply")
+        # too big for what's left
+        self.store(cache, "ReferenceType.SourceFile", {"refType": 3}, "3",
+                "x" * 15)
+        self.assertEquals(cache.stats()["entries"], 1)
+        self.assertEquals(cache.stats()["evictions"], 3)
+
+    def test_invalidate_type(self):
+        cache = pyjdwp.ReplyCache()
+        self.store(cache, "ReferenceType.SourceFile", {"refType": 1}, "1",
+                "reply")
+        self.store(cache, "ReferenceType.SourceFile", {"refType": 2}, "2",
+                "reply")
+        scope = cache.scope("Method.LineTable", {"refType": 1})
+        stamp = cache.stamp(scope)
+        cache.invalidate_type(1)
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "1"), None)
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "2"),
+                "reply")
+        # the reply to a request sent before the type went isn't cached
+        cache.store("Method.LineTable", "1", scope, stamp, "reply")
+        self.assertEquals(cache.lookup("Method.LineTable", "1"), None)
+        self.assertEquals(cache.stats()["invalidations"], 1)
+
+    def test_resume_epoch(self):
+        cache = pyjdwp.ReplyCache()
+        self.store(cache, "ReferenceType.SourceFile", {"refType": 1}, "1",
+                "reply")
+        for thread_id in [1, 2]:
+            self.store(cache, "ThreadReference.FrameCount",
+                    {"thread": thread_id}, str(thread_id), "reply")
+        cache.command_sent("ThreadReference.Resume", {"thread": 1})
+        self.assertEquals(cache.lookup("ThreadReference.FrameCount", "1"),
+                None)
+        self.assertEquals(cache.lookup("ThreadReference.FrameCount", "2"),
+                "reply")
+        scope = cache.scope("ThreadReference.FrameCount", {"thread": 3})
+        stamp = cache.stamp(scope)
+        cache.command_sent("VirtualMachine.Resume", {})
+        self.assertEquals(cache.lookup("ThreadReference.FrameCount", "2"),
+                None)
+        cache.store("ThreadReference.FrameCount", "3", scope, stamp, "reply")
+        self.assertEquals(cache.lookup("ThreadReference.FrameCount", "3"),
+                None)
+        # immutable replies outlive resumes
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "1"),
+                "reply")
+        cache.command_sent("VirtualMachine.RedefineClasses",
+                {"classes": [{"refType": 1, "classfile": []}]})
+        self.assertEquals(cache.lookup("ReferenceType.SourceFile", "1"), None)
+        self.assertEquals(cache.stats()["resume_epoch"], 2)
+
+
+class EventNotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.notifier = pyjdwp.EventNotifier("test_event_notifier", max_batch=4)
+        self.batches = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.notifier.stop()
+
+    def notify(self, payloads):
+        self.batches.append(payloads)
+        if sum(len(batch) for batch in self.batches) == 10:
+            self.done.set()
+
+    def test_notify_batches(self):
+        for i in range(10):
+            self.notifier.put(self.notify, i)
+        self.notifier.start()
+        self.done.wait(5)
+        self.assertEquals(self.batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        stats = self.notifier.stats()
+        self.assertEquals(stats["queue_depth"], 0)
+        self.assertEquals(stats["max_queue_depth"], 10)
+        self.assertEquals(stats["dispatched"], 10)
+        self.assertEquals(stats["batches"], 3)
+        self.assertEquals(stats["max_batch_size"], 4)
+        self.assertTrue(stats["max_latency"] >= stats["mean_latency"] > 0)
+
+    def test_batches_split_by_notify(self):
+        others = []
+        self.notifier.put(self.notify, 0)
+        self.notifier.put(others.append, "a")
+        for i in range(1, 10):
+            self.notifier.put(self.notify, i)
+        self.notifier.start()
+        self.done.wait(5)
+        self.assertEquals(self.batches, [[0], [1, 2], [3, 4, 5, 6], [7, 8, 9]])
+        self.assertEquals(others, [["a"]])
+
+    def test_stop_delivers_queued_events(self):
+        self.notifier.start()
+        for i in range(10):
+            self.notifier.put(self.notify, i)
+        self.notifier.stop()
+        self.assertEquals(sum(self.batches, []), range(10))
+
+
+class PhaseProfilerTest(unittest.TestCase):
+    def test_nested_phases(self):
+        profiler = pyjdwp.PhaseProfiler()
+        self.assertFalse(profiler.active)
+        self.assertEquals(profiler.request_sent("Outside.Phase", 10), ())
+        with profiler.phase("outer"):
+            token = profiler.request_sent("VirtualMachine.Version", 11)
+            for i in range(3):
+                with profiler.phase("inner"):
+                    self.assertTrue(profiler.active)
+                    profiler.reply_received(
+                            profiler.request_sent("Method.LineTable", 20), 100)
+            profiler.reply_received(token, 50)
+        outer, inner = profiler.as_dict()["phases"]
+        self.assertEquals(outer["name"], "outer")
+        self.assertEquals(outer["count"], 1)
+        self.assertEquals(outer["requests"], 4)
+        self.assertEquals(outer["bytes_sent"], 71)
+        self.assertEquals(outer["bytes_received"], 350)
+        self.assertEquals(outer["requests_by_command"], {
+                "VirtualMachine.Version": 1, "Method.LineTable": 3})
+        self.assertEquals(inner["name"], "outer/inner")
+        self.assertEquals(inner["depth"], 1)
+        self.assertEquals(inner["count"], 3)
+        self.assertEquals(inner["requests"], 3)
+        self.assertEquals(inner["bytes_received"], 300)
+        self.assertTrue(outer["seconds"] >= inner["seconds"])
+        report = profiler.report()
+        self.assertIn("outer", report)
+        self.assertIn("  inner", report)
+        profiler.reset()
+        self.assertEquals(profiler.as_dict(), {"phases": []})
+
+
+class JdwpMetricsTest(unittest.TestCase):
+    def test_counters(self):
+        metrics = pyjdwp.JdwpMetrics()
+        metrics.record_request("Method.LineTable", 27, .001)
+        metrics.record_request("Method.LineTable", 27, .001)
+        metrics.record_request("Method.LineTable", 27, .001)
+        self.assertEquals(metrics.snapshot()["in_flight"], 3)
+        metrics.record_reply("Method.LineTable", .0015, 100)
+        metrics.record_reply("Method.LineTable", .0001, 11, 23)
+        metrics.record_no_reply("Method.LineTable", True)
+        metrics.record_decode("Method.LineTable", .002)
+        metrics.record_event(8)
+        metrics.record_event(8)
+        metrics.record_packet_sent(27)
+        metrics.record_packets_received([(1, 0x80, 0, "x" * 89)])
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot["in_flight"], 0)
+        self.assertEquals(snapshot["max_in_flight"], 3)
+        self.assertEquals(snapshot["packets_sent"], 1)
+        self.assertEquals(snapshot["bytes_received"], 100)
+        self.assertEquals(snapshot["events_by_kind"], {8: 2})
+        self.assertEquals(snapshot["errors_by_code"], {23: 1})
+        command = snapshot["commands"]["Method.LineTable"]
+        self.assertEquals(command["requests"], 3)
+        self.assertEquals(command["replies"], 2)
+        self.assertEquals(command["errors"], 1)
+        self.assertEquals(command["timeouts"], 1)
+        self.assertEquals(command["bytes_out"], 81)
+        self.assertEquals(command["bytes_in"], 111)
+        self.assertAlmostEquals(command["encode_seconds"], .003)
+        self.assertAlmostEquals(command["decode_seconds"], .002)
+        # 1500us is in (1024, 2048], 100us in (64, 128]
+        self.assertEquals(command["latency_histogram_us"], {2048: 1, 128: 1})
+        self.assertIn("Method.LineTable", metrics.report())
+        metrics.reset()
+        self.assertEquals(metrics.snapshot()["commands"], {})
+
+    def test_periodic_dump(self):
+        metrics = pyjdwp.JdwpMetrics()
+        snapshots = Queue.Queue()
+        metrics.start_periodic_dump(.01, snapshots.put)
+        metrics.record_event(6)
+        try:
+            while snapshots.get(timeout=5)["events_by_kind"] != {6: 1}:
+                pass
+        finally:
+            metrics.stop_periodic_dump()
+
+
+class CommandFutureTest(unittest.TestCase):
+    class FakeCommand(object):
+        def decode(self, data):
+            return {"data": data}
+
+    def test_result(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=5)
+        future = pyjdwp.CommandFuture(
+                dispatcher, self.FakeCommand(), dispatcher.register(1))
+        done = []
+        future.add_done_callback(done.append)
+        self.assertFalse(future.done())
+        dispatcher.dispatch(1, 0, "payload")
+        self.assertEquals(done, [future])
+        self.assertEquals(future.result(), {"data": "payload"})
+        dispatcher.close()
+
+    def test_gather(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=5)
+        futures = [pyjdwp.CommandFuture(dispatcher, self.FakeCommand(),
+                dispatcher.register(req_id)) for req_id in range(1, 4)]
+        # replies may come back in any order
+        for req_id in [3, 1, 2]:
+            dispatcher.dispatch(req_id, 0, str(req_id))
+        self.assertEquals(pyjdwp.gather(futures),
+                [{"data": "1"}, {"data": "2"}, {"data": "3"}])
+        dispatcher.close()
+
+    def test_gather_error(self):
+        dispatcher = pyjdwp.ReplyDispatcher(timeout=5)
+        futures = [pyjdwp.CommandFuture(dispatcher, self.FakeCommand(),
+                dispatcher.register(req_id)) for req_id in range(1, 3)]
+        dispatcher.dispatch(1, 0, "")
+        dispatcher.dispatch(2, 20, "")
+        self.assertRaises(pyjdwp.Error, pyjdwp.gather, futures)
+        dispatcher.close()
+
+class PacketReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.jvm_socket, self.debugger_socket = socket.socketpair()
+        self.reader = pyjdwp.PacketReader(self.debugger_socket, buffer_size=64)
+
+    def tearDown(self):
+        self.jvm_socket.close()
+        self.debugger_socket.close()
+
+    def packet(self, req_id, payload):
+        return struct.pack(">IIBH", 11 + len(payload), req_id, 0x80, 0) + payload
+
+    def read_packets(self, count):
+        packets = []
+        while len(packets) < count:
+            packets.extend(self.reader.read())
+        return [(req_id, payload.tobytes())
+                for req_id, flags, err, payload in packets]
+
+    def test_many_packets_in_one_read(self):
+        self.jvm_socket.sendall(self.packet(1, "abc") + self.packet(2, "") +
+                self.packet(3, "defg"))
+        self.assertEquals(self.read_packets(3),
+                [(1, "abc"), (2, ""), (3, "defg")])
+
+    def test_partial_header(self):
+        data = self.packet(1, "abc") * 6
+        packets = []
+        for i in range(len(data)):
+            self.jvm_socket.sendall(data[i])
+            # (payloads are views of the buffer, so copy them as we go)
+            packets.extend((req_id, payload.tobytes())
+                    for req_id, flags, err, payload in self.reader.read())
+        self.assertEquals(packets, [(1, "abc")] * 6)
+        self.jvm_socket.sendall(self.packet(2, "x"))
+        self.assertEquals(self.read_packets(1), [(2, "x")])
+
+    def test_packets_spanning_buffer(self):
+        packets = [self.packet(i, chr(ord("a") + i) * 20) for i in range(10)]
+        self.jvm_socket.sendall("".join(packets))
+        self.assertEquals(self.read_packets(10),
+                [(i, chr(ord("a") + i) * 20) for i in range(10)])
+
+    def test_large_packet(self):
+        payload = "".join(chr(i % 256) for i in range(100000))
+        self.jvm_socket.sendall(self.packet(1, "small") +
+                self.packet(2, payload) + self.packet(3, "after"))
+        self.assertEquals(self.read_packets(3),
+                [(1, "small"), (2, payload), (3, "after")])
+
+    def test_eof(self):
+        self.jvm_socket.close()
+        self.assertRaises(EOFError, self.reader.read)
+
+class CodecTest(unittest.TestCase):
+    compile_codecs = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spec = pyjdwp.JdwpSpec(7, {
+                "fieldIDSize": 8,
+                "methodIDSize": 8,
+                "objectIDSize": 8,
+                "referenceTypeIDSize": 8,
+                "frameIDSize": 4}, compile_codecs=cls.compile_codecs)
+
+    def string(self, value):
+        return struct.pack(">I", len(value)) + value
+
+    def test_decode_repeat(self):
+        payload = struct.pack(">I", 2)
+        for type_id, signature in [(1, "LFoo;"), (2, "LBar;")]:
+            payload += struct.pack(">BQ", 1, type_id) + self.string(signature)
+            payload += self.string("") + struct.pack(">I", 7)
+        command = self.spec.lookup_command(
+                "VirtualMachine", "AllClassesWithGeneric")
+        for data in [payload, memoryview(bytearray(payload))]:
+            classes = command.decode(data)["classes"]
+            self.assertEquals([entry["typeID"] for entry in classes], [1, 2])
+            self.assertEquals(classes[1]["signature"], "LBar;")
+            self.assertEquals(classes[1]["status"], 7)
+
+    def test_decode_composite_event(self):
+        payload = struct.pack(">BI", 2, 2)
+        payload += struct.pack(">BIQ", 6, 3, 4)  # thread start
+        payload += struct.pack(">BIQBQ", 8, 5, 4, 1, 9)  # class prepare
+        payload += self.string("LFoo;") + struct.pack(">I", 7)
+        command = self.spec.lookup_command("Event", "Composite")
+        event = command.decode(payload)
+        self.assertEquals(event["suspendPolicy"], 2)
+        self.assertEquals(event["events"][0]["ThreadStart"],
+                {"requestID": 3, "thread": 4})
+        self.assertEquals(event["events"][1]["ClassPrepare"]["typeID"], 9)
+        self.assertEquals(
+                event["events"][1]["ClassPrepare"]["signature"], "LFoo;")
+
+    def test_decode_values(self):
+        payload = struct.pack(">I", 3) + "I" + struct.pack(">i", -3)
+        payload += "Z" + struct.pack(">B", 1)
+        payload += "L" + struct.pack(">Q", 12)
+        command = self.spec.lookup_command("StackFrame", "GetValues")
+        values = [entry["slotValue"] for entry in command.decode(payload)["values"]]
+        self.assertEquals(values, [
+                {"typeTag": "I", "value": -3},
+                {"typeTag": "Z", "value": 1},
+                {"typeTag": "L", "value": 12}])
+
+    def test_decode_locations(self):
+        payload = struct.pack(">I", 2)
+        payload += struct.pack(">IBQQQ", 1, 1, 2, 3, 4)
+        payload += struct.pack(">IBQQQ", 5, 1, 6, 7, 8)
+        command = self.spec.lookup_command("ThreadReference", "Frames")
+        frames = command.decode(payload)["frames"]
+        self.assertEquals(frames[1], {
+                "frameID": 5,
+                "typeTag": 1,
+                "classID": 6,
+                "methodID": 7,
+                "index": 8})
+
+    def test_encode_select(self):
+        command = self.spec.lookup_command("EventRequest", "Set")
+        payload = command.encode({
+                "eventKind": 8,
+                "suspendPolicy": 0,
+                "modifiers": [
+                        {"modKind": 1, "count": 2},
+                        {"modKind": 5, "classPattern": "Foo*"}]})
+        self.assertEquals(str(payload), struct.pack(">BBIBiB", 8, 0, 2, 1, 2, 5)
+                + self.string("Foo*"))
+
+    def test_encode_values(self):
+        command = self.spec.lookup_command("StackFrame", "SetValues")
+        payload = command.encode({
+                "thread": 1,
+                "frame": 2,
+                "slotValues": [
+                        {"slot": 0, "slotValue": {"typeTag": "I", "value": -3}},
+                        {"slot": 1, "slotValue": {"typeTag": "Z", "value": True}},
+                        {"slot": 2, "slotValue": {"typeTag": "C", "value": 65}}]})
+        self.assertEquals(str(payload), struct.pack(">QII", 1, 2, 3) +
+                struct.pack(">ici", 0, "I", -3) +
+                struct.pack(">icB", 1, "Z", 1) +
+                struct.pack(">icH", 2, "C", 65))
+
+    def test_encode_unicode_string(self):
+        command = self.spec.lookup_command("VirtualMachine", "CreateString")
+        payload = command.encode({"utf": u"\xe9t\xe9"})
+        self.assertEquals(str(payload), self.string(u"\xe9t\xe9".encode("UTF-8")))
+
+
+class CompiledCodecTest(CodecTest):
+    compile_codecs = True
+
+    def test_random_parity_with_interpreted(self):
+        """Encodes random requests and decodes random replies of every command
+        with compiled and interpreted codecs, which must agree byte for
+        byte"""
+        for version in [6, 7]:
+            for id_size in [4, 8]:
+                id_sizes = {
+                        "fieldIDSize": id_size,
+                        "methodIDSize": id_size,
+                        "objectIDSize": id_size,
+                        "referenceTypeIDSize": id_size,
+                        "frameIDSize": id_size}
+                self.check_random_parity(
+                        pyjdwp.JdwpSpec(version, id_sizes),
+                        pyjdwp.JdwpSpec(version, id_sizes, compile_codecs=True))
+
+    def check_random_parity(self, spec, compiled_spec):
+        for command_set_name in sorted(spec.command_sets):
+            command_set = spec.command_sets[command_set_name]
+            for command_name in sorted(command_set.commands):
+                command = spec.lookup_command(command_set_name, command_name)
+                compiled_command = compiled_spec.lookup_command(
+                        command_set_name, command_name)
+                for seed in range(20):
+                    rng = random.Random(seed)
+                    message = "%s.%s seed %d" % (command_set_name,
+                            command_name, seed)
+                    request = self.random_data(command.request.args, rng)
+                    self.assertEquals(
+                            bytes(compiled_command.encode(request)),
+                            bytes(command.encode(request)), message)
+                    payload = bytes(command.encode_reply(
+                            self.random_data(command.response.args, rng)))
+                    self.assertEquals(compiled_command.decode(payload),
+                            command.decode(payload), message)
+
+    # value type tags and their ranges
+    VALUE_RANGES = {
+            "B": (0, 0xff),
+            "C": (0, 0xffff),
+            "S": (-0x8000, 0x7fff),
+            "I": (-0x80000000, 0x7fffffff),
+            "J": (-0x8000000000000000, 0x7fffffffffffffff),
+            "Z": (0, 1)}
+    OBJECT_TAGS = "L[stglc"
+
+    def random_data(self, args, rng):
+        """Returns random data for a request's or reply's spec "args":
+        Repeats get a few elements, Selects a random alternative and
+        everything else a random value from its type's full range"""
+        data = {}
+        for arg in args:
+            self.fill_random_data(arg, data, 0, rng)
+        return data
+
+    def fill_random_data(self, arg, data, depth, rng):
+        def random_value(type_tag):
+            if type_tag in self.VALUE_RANGES:
+                return rng.randint(*self.VALUE_RANGES[type_tag])
+            if type_tag in "FD":
+                # exactly representable as a float, so it decodes to itself
+                return rng.randint(-1 << 20, 1 << 20) / 4.0
+            return rng.randint(0,
+                    (1 << 8 * arg.spec.id_sizes["objectIDSize"]) - 1)
+        max_count = 4 if depth == 0 else 2
+        if isinstance(arg, pyjdwp.Repeat):
+            elements = []
+            for i in range(rng.randint(0, max_count)):
+                element = {}
+                self.fill_random_data(arg.arg, element, depth + 1, rng)
+                elements.append(element)
+            data[arg.name] = elements
+        elif isinstance(arg, pyjdwp.Select):
+            position = rng.choice(sorted(arg.alts))
+            alt = arg.alts[position]
+            data[arg.choice_arg.name] = position
+            data[alt.name] = {}
+            for alt_arg in alt.args:
+                self.fill_random_data(alt_arg, data[alt.name], depth, rng)
+        elif isinstance(arg, pyjdwp.Group):
+            for group_arg in arg.args:
+                self.fill_random_data(group_arg, data, depth, rng)
+        elif isinstance(arg, pyjdwp.String):
+            data[arg.name] = u"".join(rng.choice(u"az09 /;$\xe9\u4e2d")
+                    for i in range(rng.randint(0, 12)))
+        elif isinstance(arg, (pyjdwp.Value, pyjdwp.UntaggedValue)):
+            type_tag = rng.choice(list(self.VALUE_RANGES) + list("FD") +
+                    list(self.OBJECT_TAGS))
+            name = arg.name if isinstance(arg, pyjdwp.Value) else "value"
+            data[name] = {"typeTag": type_tag, "value": random_value(type_tag)}
+        elif isinstance(arg, pyjdwp.TaggedObject):
+            data[arg.name] = {"typeTag": rng.choice(self.OBJECT_TAGS),
+                    "objectID": random_value("L")}
+        elif isinstance(arg, pyjdwp.TypedSequence):
+            type_tag = rng.choice(list(self.VALUE_RANGES) + list("FDL"))
+            count = rng.randint(0, max_count)
+            if type_tag == "L":
+                # object values are tagged individually
+                values = [(rng.choice(self.OBJECT_TAGS), random_value("L"))
+                        for i in range(count)]
+            else:
+                values = [random_value(type_tag) for i in range(count)]
+            data[arg.name] = (type_tag, values)
+        elif arg.type in ["boolean", "binary"]:
+            data[arg.name] = rng.randint(0, 1)
+        elif arg.type == "int":
+            data[arg.name] = rng.randint(*self.VALUE_RANGES["I"])
+        else:
+            data[arg.name] = rng.randint(0,
+                    (1 << 8 * arg.spec.lookup_id_size(arg.type)) - 1)
+
+
+class LazySpecTest(unittest.TestCase):
+    def test_commands_built_on_lookup(self):
+        spec = pyjdwp.JdwpSpec(7, {
+                "fieldIDSize": 8,
+                "methodIDSize": 8,
+                "objectIDSize": 8,
+                "referenceTypeIDSize": 8,
+                "frameIDSize": 8})
+        self.assertIn("ThreadReference", spec.command_sets)
+        self.assertEquals(spec.command_sets.built_keys, [])
+        command = spec.lookup_command("ThreadReference", "Name")
+        self.assertEquals(command.id, 1)
+        self.assertEquals(spec.command_sets.built_keys, ["ThreadReference"])
+        command_set = spec.command_sets["ThreadReference"]
+        self.assertIn("Frames", command_set.commands)
+        self.assertEquals(command_set.commands.built_keys, ["Name"])
+        self.assertIs(command, spec.lookup_command("ThreadReference", "Name"))
+
+    def test_generic_service_binds_on_use(self):
+        spec = pyjdwp.JdwpSpec(7, {
+                "fieldIDSize": 8,
+                "methodIDSize": 8,
+                "objectIDSize": 8,
+                "referenceTypeIDSize": 8,
+                "frameIDSize": 8})
+        requests = []
+        class FakeJdwp(object):
+            def command_request(self, command_set, command, data):
+                requests.append((command_set, command, data))
+        service = pyjdwp.GenericService(
+                FakeJdwp(), spec.command_sets["VirtualMachine"])
+        self.assertIn("AllThreads", dir(service))
+        service.AllThreads()
+        service.Version({})
+        self.assertEquals(requests, [
+                ("VirtualMachine", "AllThreads", {}),
+                ("VirtualMachine", "Version", {})])
+        self.assertRaises(AttributeError, getattr, service, "NoSuchCommand")
+
+
+class SpecCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = pyjdwp.SpecCache(self.cache_dir)
+        self.spec_text = """
+            JDWP "Java(tm) Debug Wire Protocol"
+            (CommandSet VirtualMachine = 1
+                (Command Version=1 "Returns the JDWP version."
+                    (Out)
+                    (Reply (int jdwpMajor "Major JDWP Version number"))
+                    (ErrorSet (Error VM_DEAD))))
+            """
+        self.cache_path = os.path.join(self.cache_dir, "spec.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_load(self):
+        spec = self.cache.load("specs/spec", self.spec_text)
+        self.assertEquals(spec, pyjdwp.parse_spec_text(self.spec_text))
+        self.assertTrue(os.path.exists(self.cache_path))
+        self.assertEquals(self.cache.load("specs/spec", self.spec_text), spec)
+
+    def test_load_cached(self):
+        self.cache.load("specs/spec", self.spec_text)
+        # make parsing blow up, to be sure we don't parse again
+        parse_spec_text = pyjdwp.parse_spec_text
+        pyjdwp.parse_spec_text = None
+        try:
+            spec = self.cache.load("specs/spec", self.spec_text)
+        finally:
+            pyjdwp.parse_spec_text = parse_spec_text
+        self.assertEquals(spec, pyjdwp.parse_spec_text(self.spec_text))
+
+    def test_spec_changed(self):
+        self.cache.load("specs/spec", self.spec_text)
+        changed_text = self.spec_text.replace("Version=1", "Version=2")
+        spec = self.cache.load("specs/spec", changed_text)
+        self.assertEquals(spec[1][2][1], "Version=2")
+
+    def test_failed_write_leaves_no_temp_file(self):
+        # renaming a file over a directory fails
+        os.mkdir(self.cache_path)
+        spec = self.cache.load("specs/spec", self.spec_text)
+        self.assertEquals(spec, pyjdwp.parse_spec_text(self.spec_text))
+        self.assertEquals(os.listdir(self.cache_dir), ["spec.cache"])
+        self.assertTrue(os.path.isdir(self.cache_path))
+
+    def test_corrupt_cache(self):
+        spec = self.cache.load("specs/spec", self.spec_text)
+        with open(self.cache_path, "r+b") as cache_file:
+            cache_file.seek(-4, os.SEEK_END)
+            cache_file.write("junk")
+        self.assertEquals(self.cache.load("specs/spec", self.spec_text), spec)
+
+class SpecParserTest(unittest.TestCase):
+    def spec_entries(self, spec):
+        return [entry for entry in spec if isinstance(entry, list) and
+                entry[0] in ("CommandSet", "ConstantSet")]
+
+    def test_parse(self):
+        spec = pyjdwp.parse_spec_text("""
+            /* a (header) with "quotes" */
+            JDWP "Java(tm) Debug Wire Protocol"
+            (CommandSet Foo = 1
+                (Command Bar=2 "doc" "more doc "
+                              "with \\"escaped\\" quotes"
+                    (Out (int x "an int"))
+                    (Reply)))
+            (ConstantSet Tag
+                (Constant VOID = 'V' "void"))
+            """)
+        self.assertEquals(spec, [
+                "JDWP",
+                ["CommandSet", "Foo=1",
+                        ["Command", "Bar=2", ["Out", ["int", "x"]], ["Reply"]]],
+                ["ConstantSet", "Tag", ["Constant", "VOID='V'"]]])
+
+    def test_parse_errors(self):
+        for text in ["(CommandSet Foo=1", "(Out))", "/* header", "(a \x0b)"]:
+            self.assertRaises(pyjdwp.Error, pyjdwp.parse_spec_text, text)
+
+    @unittest.skipIf(pyparsing is None, "needs pyparsing")
+    def test_parity_with_pyparsing_grammar(self):
+        grammar = pyjdwp.pyparsing_spec_grammar()
+        for version in [6, 7]:
+            spec_path = os.path.join(os.path.dirname(pyjdwp.__file__),
+                    "specs", "jdwp.spec_openjdk_%d" % version)
+            with open(spec_path) as spec_file:
+                jdwp_text = spec_file.read()
+            expected = grammar.parseString(
+                    re.sub("\\s*=\\s*", "=", jdwp_text)).asList()
+            self.assertEquals(
+                    self.spec_entries(pyjdwp.parse_spec_text(jdwp_text)),
+                    self.spec_entries(expected))
+
 if __name__ == "__main__":
     unittest.main()